@@ -1,17 +1,53 @@
 import asyncio
 import logging
+import signal
 import sys
+import time
 from aiogram import Bot, Dispatcher, types, F
-from aiogram.filters import Command
+from aiogram.filters import Command, CommandObject
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.fsm.context import FSMContext
-from aiogram.types import Message, CallbackQuery, KeyboardButton, ReplyKeyboardMarkup
+from aiogram.types import (
+    Message, CallbackQuery, KeyboardButton, ReplyKeyboardMarkup, InlineKeyboardMarkup, InlineKeyboardButton,
+    BufferedInputFile,
+)
 from aiogram.client.default import DefaultBotProperties
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
 from aiogram.enums import ParseMode
+from aiogram.exceptions import TelegramBadRequest
+from aiogram.utils.text_decorations import html_decoration as html
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+from aiohttp import web
 
-from config import BOT_TOKEN, ADMIN_IDS
-from database import Database
-from keyboards import get_main_keyboard, get_registration_keyboard, create_activities_keyboard
+from config import (
+    BOT_TOKEN, ADMIN_IDS, BOT_MODE, WEBHOOK_BASE_URL, WEBHOOK_PATH, WEBHOOK_SECRET,
+    WEBAPP_HOST, WEBAPP_PORT, MAX_CONCURRENT_UPDATES, SHUTDOWN_TIMEOUT, RECENT_SIGNUPS_MINUTES,
+    METRICS_HOST, METRICS_PORT, PROFILE_MAX_SECONDS, TELEGRAM_API_URL, WORKERS, WORKER_INDEX,
+    ADMISSION_RESERVE_LIMIT, ADMISSION_REGISTER_LIMIT, ADMISSION_VIEW_LIMIT, ADMISSION_VIEW_QUEUE,
+    ADMISSION_VIEW_MAX_WAIT,
+)
+from database import Database, ReserveResult, WaitlistResult
+from storage import CatalogError
+from export import export_roster, export_votes
+from middlewares import AdmissionControlMiddleware, Lane
+from outbound import OutboundLimiter
+from broadcast import Broadcaster, parse_target, describe_target
+from keyboards import (
+    get_main_keyboard, get_registration_keyboard, create_activities_keyboard, get_users_pager_keyboard,
+    get_live_stats_keyboard, get_waitlist_keyboard, get_roster_keyboard,
+)
+from render import get_slots_summary, get_statistics_text, build_attempts_summary, build_full_stats, render_cache
+from live import LiveStats
+from refresh import RefreshGuard
+from dedupe import VoteDeduplicator
+from journal import JournalStats, SlotReconciler
+from waitlist import WaitlistNotifier
+from catalog import CatalogWatcher, describe_diff
+from fsm_storage import DatabaseStorage
+from tracing import Profiler, setup_tracing
+from workers import CacheSync, PrimaryElection, Supervisor, feed_from_queue
+import metrics
 
 # Настройка логирования
 logging.basicConfig(
@@ -27,9 +63,129 @@ if not BOT_TOKEN or BOT_TOKEN == "тут_твой_токен_от_BotFather":
     sys.exit(1)
 
 # Инициализация бота и диспетчера
-bot = Bot(token=BOT_TOKEN, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
-dp = Dispatcher()
+session = AiohttpSession(api=TelegramAPIServer.from_base(TELEGRAM_API_URL)) if TELEGRAM_API_URL else None
+bot = Bot(token=BOT_TOKEN, session=session, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
+outbound_limiter = OutboundLimiter()
+bot.session.middleware(outbound_limiter)
+# Регистрируется после лимитера: замеряем сам запрос, без ожидания токенов
+bot.session.middleware(metrics.ApiMetricsMiddleware())
 db = Database()
+# Состояния FSM хранятся в той же базе и переживают перезапуск
+fsm_storage = DatabaseStorage(db)
+dp = Dispatcher(storage=fsm_storage)
+broadcaster = Broadcaster(bot, db)
+live_stats = LiveStats(bot, db, get_statistics_text)
+refresh_guard = RefreshGuard()
+
+
+def is_final_vote(outcome) -> bool:
+    """Итог записи (ReserveResult, (WaitlistResult, место) или None) не временный: база не была занята"""
+    result, waitlisted = outcome
+    return result is not ReserveResult.BUSY and (waitlisted is None or waitlisted[0] is not WaitlistResult.BUSY)
+
+
+# Повторные нажатия записи ждут начатую запись и получают ее итог
+vote_dedupe = VoteDeduplicator(is_final=is_final_vote)
+waitlist_notifier = WaitlistNotifier(bot, db)
+# Каталог активностей из ACTIVITIES_FILE применяется без перезапуска
+catalog_watcher = CatalogWatcher(db)
+# Места и пользователи, измененные другими процессами, подтягиваются из базы. Один процесс
+# с SQLite меняет базу сам, и сверять ему нечего. Журнал чистит ведущий процесс
+cache_sync = CacheSync(db, sync=WORKERS > 1 or db.backend.shared, prune=False)
+# Полная статистика досчитывается по журналу попыток записи, а не пересчетом votes
+journal_stats = JournalStats(db)
+# Счетчики мест сверяет с записями один процесс
+slot_reconciler = SlotReconciler(db)
+
+
+async def start_primary_jobs():
+    """Задачи в одном экземпляре на всю базу: запускает процесс, ставший ведущим"""
+    if await broadcaster.resume():
+        logger.info("Unfinished broadcasts resumed")
+    waitlist_notifier.start()
+    catalog_watcher.start()
+    slot_reconciler.start()
+    cache_sync.prune = True
+
+
+async def stop_primary_jobs():
+    """Останавливает задачи ведущего, когда роль перешла к другому процессу"""
+    cache_sync.prune = False
+    await broadcaster.stop()
+    await waitlist_notifier.stop()
+    await catalog_watcher.stop()
+    await slot_reconciler.stop()
+
+
+# Кандидат в ведущие — обработчик 0; на общей базе роль достается одному из экземпляров бота
+primary_election = PrimaryElection(db, start_primary_jobs, stop_primary_jobs, candidate=WORKER_INDEX in (None, 0))
+
+# Кнопки и команды, которые ведут к записи: их не откладываем ради просмотров
+REGISTRATION_TEXTS = {"📱 Отправить номер телефона", "🎯 Выбрать активность", "↩️ Назад"}
+BUSY_TEXT = "⏳ Бот сейчас перегружен, попробуйте через пару секунд"
+
+
+def classify_update(update: types.Update) -> str:
+    """Класс приоритета апдейта: reserve — запись и лист ожидания, register — регистрация
+    и действия админов, view — просмотры, которые можно отклонить при перегрузке"""
+    if update.callback_query:
+        data = update.callback_query.data or ""
+        if data.startswith(("vote_", "full")) or data == "wait_leave":
+            return "reserve"
+        return "register" if is_admin(update.callback_query.from_user.id) else "view"
+    message = update.message
+    if message is None:
+        return "register"
+    if message.contact or (message.text or "").startswith("/start") or message.text in REGISTRATION_TEXTS:
+        return "register"
+    if message.from_user and is_admin(message.from_user.id):
+        return "register"
+    return "view"
+
+
+async def answer_overloaded(lane: Lane, update: types.Update, data: dict):
+    """Быстрый ответ на отклоненный апдейт: без базы, из кэша или «бот занят»"""
+    metrics.UPDATES_SHED.inc(lane.name)
+    if update.callback_query:
+        await bot.answer_callback_query(update.callback_query.id, BUSY_TEXT)
+        return
+    message = update.message
+    if message is None:
+        return
+    if message.text == "📊 Статистика" and (text := render_cache.latest("statistics_text")):
+        await bot.send_message(message.chat.id, f"{text}\n\n<i>{BUSY_TEXT}, данные могут быть устаревшими</i>")
+    elif message.text == "🆘 Помощь":
+        await bot.send_message(message.chat.id, HELP_TEXT)
+    else:
+        await bot.send_message(message.chat.id, BUSY_TEXT)
+
+
+# Запись на активность важнее регистрации, регистрация — просмотров
+admission = AdmissionControlMiddleware(
+    MAX_CONCURRENT_UPDATES,
+    [
+        Lane("reserve", ADMISSION_RESERVE_LIMIT),
+        Lane("register", ADMISSION_REGISTER_LIMIT),
+        Lane("view", ADMISSION_VIEW_LIMIT, queue_limit=ADMISSION_VIEW_QUEUE, max_wait=ADMISSION_VIEW_MAX_WAIT),
+    ],
+    classify_update,
+    on_shed=answer_overloaded,
+)
+dp.update.outer_middleware(admission)
+dp.message.middleware(metrics.HandlerMetricsMiddleware())
+dp.callback_query.middleware(metrics.HandlerMetricsMiddleware())
+# Трассировка включается через TRACE_ENABLED
+setup_tracing(dp, bot.session)
+metrics.UPDATES_IN_FLIGHT.set_function(lambda: admission.pending)
+metrics.ADMISSION_IN_FLIGHT.set_function(lambda: {(lane.name,): lane.in_flight for lane in admission.lanes.values()})
+metrics.ADMISSION_QUEUE_DEPTH.set_function(lambda: {(lane.name,): lane.queued for lane in admission.lanes.values()})
+metrics.ACTIVITY_SLOTS_USED.set_function(
+    lambda: {(name,): used_slots for name, used_slots, max_slots, is_full in db.slot_fill()}
+)
+metrics.ACTIVITY_SLOTS_MAX.set_function(
+    lambda: {(name,): max_slots for name, used_slots, max_slots, is_full in db.slot_fill()}
+)
+metrics_runner = None
 
 # Состояния
 class UserStates(StatesGroup):
@@ -80,60 +236,222 @@ async def cmd_admin(message: Message):
     admin_keyboard = ReplyKeyboardMarkup(keyboard=keyboard, resize_keyboard=True)
     
     total_users = await db.get_total_users()
-    stats = await db.get_statistics()
-    
-    text = "🛠️ <b>Админ-панель</b>\n\n"
-    text += f"👥 <b>Всего пользователей:</b> {total_users}\n\n"
+    summary = await get_slots_summary(db)
     
-    for name, used_slots, max_slots, is_full in stats:
-        text += f"• {name}: {used_slots}/{max_slots}\n"
+    text = (
+        "🛠️ <b>Админ-панель</b>\n\n"
+        f"👥 <b>Всего пользователей:</b> {total_users}\n\n"
+        f"{summary}\n\n"
+        f"🔄 <b>Обновления списка:</b> правок {refresh_guard.edits}, "
+        f"без изменений {refresh_guard.skipped}, слишком часто {refresh_guard.throttled}\n"
+        f"🔁 <b>Повторные нажатия записи:</b> дождались первого {vote_dedupe.joined}, "
+        f"ответ из кэша {vote_dedupe.cached}\n"
+        f"🚦 <b>Отклонено при перегрузке:</b> "
+        f"{', '.join(f'{lane.name} {lane.shed}' for lane in admission.lanes.values())}\n"
+        f"🧮 <b>Сверок счетчиков мест:</b> {slot_reconciler.runs}, исправлено {slot_reconciler.repaired}\n\n"
+        "📣 Рассылка: /broadcast\n"
+        "🗂 Все списки одним файлом: /roster\n"
+        "🗑 Удалить запись: /unvote ID пользователя\n"
+        "🧮 Сверить счетчики мест с записями: /reconcile\n"
+        "🔬 Профиль: /profile секунды"
+    )
     
     await message.answer(text, reply_markup=admin_keyboard, parse_mode="HTML")
 
 @dp.message(Command("update_activities"))
 async def cmd_update_activities(message: Message):
-    """Обновляет список активностей в базе данных"""
+    """Перечитывает файл каталога активностей и применяет его сразу"""
     if not is_admin(message.from_user.id):
         await message.answer("❌ Доступ запрещен")
         return
     
     try:
-        await db.update_activities()
-        await message.answer("✅ Список активностей обновлен в базе данных!")
+        diff = await catalog_watcher.reload()
+        await message.answer(f"✅ Список активностей обновлен!\n\n{html.quote(describe_diff(diff, db.activities))}")
+    except CatalogError as e:
+        await message.answer(f"❌ {html.quote(str(e))}")
     except Exception as e:
         await message.answer(f"❌ Ошибка при обновлении: {e}")
 
-@dp.message(F.text == "👥 Все пользователи")
-async def show_all_users(message: Message):
-    """Показывает всех зарегистрированных пользователей"""
+@dp.message(Command("unvote"))
+async def cmd_unvote(message: Message, command: CommandObject):
+    """Удаляет запись пользователя: /unvote ID. Место получает первый из листа ожидания"""
+    if not is_admin(message.from_user.id):
+        await message.answer("❌ Доступ запрещен")
+        return
+    
+    if not (command.args or "").strip().isdigit():
+        await message.answer("Использование: <code>/unvote ID пользователя</code>")
+        return
+    
+    user_id = int(command.args.strip())
+    activity_id, promoted = await db.remove_vote(user_id)
+    # Повторные нажатия этих пользователей не должны получить старый итог записи
+    for changed_id in (user_id, *promoted):
+        vote_dedupe.forget(changed_id)
+    if activity_id is None:
+        await message.answer(f"📭 У пользователя {user_id} нет записи")
+        return
+    
+    name = db.activities.get(activity_id, {}).get("name", activity_id)
+    text = f"🗑 Запись пользователя {user_id} на «{html.quote(str(name))}» удалена"
+    if promoted:
+        text += "\n⏳ Из листа ожидания записаны: " + ", ".join(str(promoted_id) for promoted_id in promoted)
+    await message.answer(text)
+
+@dp.message(Command("reconcile"))
+async def cmd_reconcile(message: Message):
+    """Сверяет счетчики занятых мест с записями и исправляет расхождения"""
+    if not is_admin(message.from_user.id):
+        await message.answer("❌ Доступ запрещен")
+        return
+    
+    drift, promoted = await slot_reconciler.reconcile()
+    for promoted_id in promoted:
+        vote_dedupe.forget(promoted_id)
+    if not drift:
+        await message.answer("✅ Счетчики мест совпадают с записями")
+        return
+    
+    lines = ["🧮 <b>Исправлены счетчики мест:</b>"]
+    for activity_id, old, new in drift:
+        name = db.activities.get(activity_id, {}).get("name", activity_id)
+        lines.append(f"• {html.quote(str(name))}: было {old}, записей {new}")
+    if promoted:
+        lines.append("⏳ Из листа ожидания записаны: " + ", ".join(str(promoted_id) for promoted_id in promoted))
+    await message.answer("\n".join(lines))
+
+@dp.message(Command("broadcast"))
+async def cmd_broadcast(message: Message, command: CommandObject):
+    """Рассылка: /broadcast all|novote|<id активности> текст"""
+    if not is_admin(message.from_user.id):
+        await message.answer("❌ Доступ запрещен")
+        return
+    
+    parts = (command.args or "").split(maxsplit=1)
+    target = parse_target(parts[0], db.activities) if parts else None
+    if target is None or len(parts) < 2:
+        activities = "\n".join(f"{activity_id} — {html.quote(data['name'])}" for activity_id, data in db.activities.items())
+        await message.answer(
+            "📣 <b>Рассылка</b>\n\n"
+            "<code>/broadcast all текст</code> — всем пользователям\n"
+            "<code>/broadcast novote текст</code> — тем, кто еще не записался\n"
+            "<code>/broadcast id текст</code> — участникам активности:\n"
+            f"{activities}"
+        )
+        return
+    
+    # Текст берем с разметкой исходного сообщения, без команды и цели
+    text = message.html_text.split(maxsplit=2)[2]
+    broadcast_id, total = await broadcaster.start(message.from_user.id, target, text)
+    if not total:
+        await message.answer(f"📭 Рассылка #{broadcast_id}: некому отправлять ({describe_target(target, db.activities)})")
+
+@dp.message(Command("profile"))
+async def cmd_profile(message: Message, command: CommandObject):
+    """Сэмплирующий профиль бота за N секунд: /profile N"""
     if not is_admin(message.from_user.id):
+        await message.answer("❌ Доступ запрещен")
         return
     
-    users = await db.get_all_users()
+    try:
+        seconds = int(command.args or 10)
+    except ValueError:
+        await message.answer(f"Использование: <code>/profile секунды</code> (1–{PROFILE_MAX_SECONDS})")
+        return
+    seconds = max(1, min(seconds, PROFILE_MAX_SECONDS))
     
-    if not users:
-        await message.answer("📭 Нет зарегистрированных пользователей")
+    await message.answer(f"🔬 Снимаю профиль {seconds} с...")
+    # Сэмплы снимает отдельный поток, цикл событий в это время работает как обычно
+    profiler = Profiler()
+    await asyncio.to_thread(profiler.run, seconds)
+    if not profiler.samples:
+        await message.answer("📭 Не удалось снять ни одного сэмпла")
         return
     
-    text = "👥 <b>Все зарегистрированные пользователи:</b>\n\n"
+    stamp = time.strftime('%Y-%m-%d_%H-%M-%S')
+    document = BufferedInputFile(profiler.collapsed().encode(), filename=f"profile_{stamp}.txt")
+    await message.answer_document(
+        document, caption=f"🔬 {profiler.samples} сэмплов за {seconds} с (collapsed stacks для flamegraph/speedscope)"
+    )
+
+def format_users_page(rows, query: str = None) -> str:
+    """Текст страницы списка пользователей"""
+    title = f"🔎 <b>Поиск «{html.quote(query)}»:</b>" if query else "👥 <b>Все зарегистрированные пользователи:</b>"
+    lines = [title, ""]
     
-    for i, (user_id, username, full_name, phone, registered_at) in enumerate(users, 1):
+    for user_id, username, full_name, phone, registered_at in rows:
         username_display = f"@{username}" if username else "нет username"
         phone_display = phone if phone else "не указан"
-        
-        text += f"<b>{i}.</b> {full_name}\n"
-        text += f"   ID: {user_id}\n"
-        text += f"   Username: {username_display}\n"
-        text += f"   Телефон: {phone_display}\n"
-        text += f"   Дата: {registered_at}\n\n"
-        
-        # Разбиваем сообщение если слишком длинное
-        if len(text) > 3000:
-            await message.answer(text, parse_mode="HTML")
-            text = ""
-    
-    if text:
-        await message.answer(text, parse_mode="HTML")
+        lines.append(
+            f"• <b>{html.quote(full_name or '')}</b>\n"
+            f"   ID: {user_id}\n"
+            f"   Username: {username_display}\n"
+            f"   Телефон: {phone_display}\n"
+            f"   Дата: {registered_at}\n"
+        )
+    return "\n".join(lines)
+
+async def send_users_page(message: Message, state: FSMContext, query: str = None):
+    """Отправляет первую страницу пользователей (с поиском, если задан)"""
+    await state.update_data(users_query=query)
+    rows, has_next = await db.get_users_page("first", query=query)
+    
+    if not rows:
+        await message.answer("📭 Никого не найдено" if query else "📭 Нет зарегистрированных пользователей")
+        return
+    
+    await message.answer(
+        format_users_page(rows, query),
+        reply_markup=get_users_pager_keyboard(rows, has_prev=False, has_next=has_next),
+        parse_mode="HTML"
+    )
+
+@dp.message(F.text == "👥 Все пользователи")
+async def show_all_users(message: Message, state: FSMContext):
+    """Показывает зарегистрированных пользователей постранично"""
+    if not is_admin(message.from_user.id):
+        return
+    
+    await send_users_page(message, state)
+
+@dp.message(Command("users"))
+async def search_users(message: Message, command: CommandObject, state: FSMContext):
+    """Поиск пользователей по началу имени, username или телефона: /users Иван"""
+    if not is_admin(message.from_user.id):
+        return
+    
+    await send_users_page(message, state, query=(command.args or "").strip() or None)
+
+@dp.callback_query(F.data.startswith("users_"))
+async def page_users(callback: CallbackQuery, state: FSMContext):
+    """Листание списка пользователей"""
+    if not is_admin(callback.from_user.id):
+        await callback.answer()
+        return
+    
+    _, direction, *rest = callback.data.split("_", 2)
+    cursor = None
+    if rest:
+        registered_at, telegram_id = rest[0].rsplit("_", 1)
+        cursor = (registered_at, int(telegram_id))
+    
+    query = (await state.get_data()).get("users_query")
+    rows, has_more = await db.get_users_page(direction, cursor, query)
+    
+    if not rows:
+        await callback.answer("Это край списка")
+        return
+    
+    has_prev = has_more if direction in ("prev", "last") else direction == "next"
+    has_next = has_more if direction in ("next", "first") else direction == "prev"
+    
+    await callback.message.edit_text(
+        format_users_page(rows, query),
+        reply_markup=get_users_pager_keyboard(rows, has_prev, has_next),
+        parse_mode="HTML"
+    )
+    await callback.answer()
 
 @dp.message(F.text == "📋 Списки по активностям")
 async def show_activity_lists(message: Message):
@@ -141,151 +459,222 @@ async def show_activity_lists(message: Message):
     if not is_admin(message.from_user.id):
         return
     
-    # Создаем клавиатуру с активностями
-    keyboard = await create_activities_keyboard()
+    keyboard = get_roster_keyboard(await db.get_activities())
     
     await message.answer(
-        "🎯 <b>Выберите активность для просмотра списка участников:</b>",
+        "🎯 <b>Выберите активность для просмотра списка участников</b> "
+        "или выгрузите все списки одним файлом:",
         reply_markup=keyboard,
         parse_mode="HTML"
     )
 
-@dp.callback_query(F.data.startswith("vote_"))
-async def process_vote(callback: CallbackQuery, state: FSMContext):
-    """Обработка выбора активности"""
-    activity_id = int(callback.data.split("_")[1])
-    user_id = callback.from_user.id
+async def send_roster(message: Message):
+    """Отправляет списки всех активностей одним документом"""
+    document, activities, total = await export_roster(db)
+    try:
+        await message.answer_document(
+            document, caption=f"📋 Списки участников: {total} записей, активностей: {activities}"
+        )
+    finally:
+        document.close()
+
+@dp.message(Command("roster"))
+async def cmd_roster(message: Message):
+    """Все списки участников одним файлом"""
+    if not is_admin(message.from_user.id):
+        return
     
-    # Если это админ и он смотрит списки
-    if is_admin(user_id) and callback.message.text and "список участников" in callback.message.text:
-        # Получаем информацию о активности
-        activities = await db.get_activities()
-        activity_info = next((a for a in activities if a[0] == activity_id), None)
-        
-        if not activity_info:
-            await callback.answer("Ошибка: активность не найдена")
-            return
-        
-        act_id, act_name, max_slots, used_slots = activity_info
-        
-        # Получаем участников
-        participants = await db.get_activity_participants(activity_id)
-        
-        text = f"📋 <b>Участники активности:</b> {act_name}\n"
-        text += f"👥 <b>Записано:</b> {len(participants)}/{max_slots}\n\n"
-        
-        if not participants:
-            text += "📭 Нет записавшихся участников"
-        else:
-            for i, (user_id, username, full_name, phone, voted_at) in enumerate(participants, 1):
-                username_display = f"@{username}" if username else "нет username"
-                text += f"<b>{i}.</b> {full_name}\n"
-                text += f"   ID: {user_id} | {username_display}\n"
-                if phone:
-                    text += f"   📞 {phone}\n"
-                text += f"   🕐 {voted_at}\n\n"
-        
-        await callback.message.answer(text, parse_mode="HTML")
+    await send_roster(message)
+
+@dp.callback_query(F.data.startswith("roster_"))
+async def roster_callback(callback: CallbackQuery):
+    """Список участников одной активности или все списки файлом"""
+    if not is_admin(callback.from_user.id):
         await callback.answer()
         return
     
-    # Обычное голосование для пользователей
-    success = await db.try_reserve_slot(activity_id, user_id)
-    
-    if success:
-        activities = await db.get_activities()
-        activity_info = next((a for a in activities if a[0] == activity_id), None)
-        
-        if activity_info:
-            act_id, act_name, max_slots, used_slots = activity_info
-            await callback.message.edit_text(
-                f"🎉 <b>Поздравляем с успешной записью!</b>\n\n"
-                f"🏆 <b>Активность:</b> {act_name}\n"
-                f"📅 <b>Место забронировано:</b> ✅\n"
-                f"👥 <b>Записано:</b> {used_slots + 1}/{max_slots} человек\n\n"
-                f"Ждем вас на активности!",
-                parse_mode="HTML"
+    if callback.data == "roster_all":
+        await callback.answer("📁 Готовлю файл...")
+        await send_roster(callback.message)
+        return
+    
+    await send_activity_participants(callback, int(callback.data.split("_")[1]))
+
+async def send_activity_participants(callback: CallbackQuery, activity_id: int):
+    """Список участников активности для админа"""
+    # Получаем информацию о активности
+    activities = await db.get_activities()
+    activity_info = next((a for a in activities if a[0] == activity_id), None)
+    
+    if not activity_info:
+        await callback.answer("Ошибка: активность не найдена")
+        return
+    
+    act_id, act_name, max_slots, used_slots = activity_info
+    
+    # Получаем участников
+    participants = await db.get_activity_participants(activity_id)
+    
+    text = f"📋 <b>Участники активности:</b> {act_name}\n"
+    text += f"👥 <b>Записано:</b> {len(participants)}/{max_slots}\n\n"
+    
+    if not participants:
+        text += "📭 Нет записавшихся участников"
+    else:
+        for i, (user_id, username, full_name, phone, voted_at) in enumerate(participants, 1):
+            username_display = f"@{username}" if username else "нет username"
+            text += f"<b>{i}.</b> {full_name}\n"
+            text += f"   ID: {user_id} | {username_display}\n"
+            if phone:
+                text += f"   📞 {phone}\n"
+            text += f"   🕐 {voted_at}\n\n"
+    
+    await callback.message.answer(text, parse_mode="HTML")
+    await callback.answer()
+
+async def show_vote_success(callback: CallbackQuery, activity_id: int):
+    """Заменяет список активностей сообщением об успешной записи"""
+    activities = await db.get_activities()
+    activity_info = next((a for a in activities if a[0] == activity_id), None)
+    
+    if activity_info:
+        act_id, act_name, max_slots, used_slots = activity_info
+        await callback.message.edit_text(
+            f"🎉 <b>Поздравляем с успешной записью!</b>\n\n"
+            f"🏆 <b>Активность:</b> {act_name}\n"
+            f"📅 <b>Место забронировано:</b> ✅\n"
+            f"👥 <b>Записано:</b> {used_slots}/{max_slots} человек\n\n"
+            f"Ждем вас на активности!",
+            parse_mode="HTML"
+        )
+        refresh_guard.forget(callback.message.chat.id, callback.message.message_id)
+    await callback.answer()
+
+async def reserve_or_wait(activity_id: int, user_id: int):
+    """Запись на активность, а если мест нет — в лист ожидания. Итог для VoteDeduplicator"""
+    result = await db.try_reserve_slot(activity_id, user_id)
+    if result is ReserveResult.FULL:
+        return result, await db.join_waitlist(activity_id, user_id)
+    return result, None
+
+async def wait_for_slot(activity_id: int, user_id: int):
+    """Запись в лист ожидания по кнопке заполненной активности"""
+    return ReserveResult.FULL, await db.join_waitlist(activity_id, user_id)
+
+async def answer_vote(callback: CallbackQuery, activity_id: int, outcome, repeated: bool):
+    """Отвечает на нажатие записи по ее итогу.
+
+    Повторное нажатие получает тот же итог всплывающим сообщением: список
+    уже заменило сообщение об успехе в ответ на первое нажатие.
+    """
+    result, waitlisted = outcome
+    if result is ReserveResult.FULL:
+        waitlist_result, place = waitlisted
+        if waitlist_result is WaitlistResult.WAITING:
+            await callback.answer(
+                f"❌ Свободных мест нет.\n\n"
+                f"⏳ Вы в листе ожидания, ваш номер: {place}. "
+                f"Как только место освободится, мы запишем вас автоматически и пришлем сообщение.",
+                show_alert=True
             )
-        await callback.answer()
+            return
+        # Место освободилось, пока пользователь смотрел на старый список
+        result = {
+            WaitlistResult.PROMOTED: ReserveResult.SUCCESS,
+            WaitlistResult.ALREADY_VOTED: ReserveResult.ALREADY_VOTED,
+            WaitlistResult.NOT_FOUND: ReserveResult.NOT_FOUND,
+        }.get(waitlist_result, ReserveResult.BUSY)
+    
+    if result is ReserveResult.SUCCESS and repeated:
+        name = db.activities.get(activity_id, {}).get("name", activity_id)
+        await callback.answer(f"🎉 Вы записаны на «{name}», место за вами", show_alert=True)
+    elif result is ReserveResult.SUCCESS:
+        await show_vote_success(callback, activity_id)
+    elif result is ReserveResult.ALREADY_VOTED:
+        await callback.answer(
+            "❌ Вы уже записаны на другую активность. Один пользователь может записаться только на одну.",
+            show_alert=True
+        )
+    elif result is ReserveResult.NOT_FOUND:
+        # Кнопка из списка, отправленного до перезагрузки каталога
+        await callback.answer("❌ Активность не найдена, обновите список", show_alert=True)
     else:
         await callback.answer(
-            "❌ Не удалось записаться. Возможно, места уже закончились или вы уже записаны на другую активность.",
+            "⏳ Сейчас очень много желающих, попробуйте нажать ещё раз через пару секунд.",
             show_alert=True
         )
+
+@dp.callback_query(F.data.startswith("vote_"))
+async def process_vote(callback: CallbackQuery, state: FSMContext):
+    """Обработка выбора активности"""
+    activity_id = int(callback.data.split("_")[1])
+    user_id = callback.from_user.id
     
+    # Повторные нажатия не начинают свою запись
+    outcome, repeated = await vote_dedupe.run(user_id, activity_id, lambda: reserve_or_wait(activity_id, user_id))
+    await answer_vote(callback, activity_id, outcome, repeated)
     await state.clear()
 
 @dp.message(F.text == "📊 Полная статистика")
 async def show_full_stats(message: Message):
-    """Показывает полную статистику"""
+    """Показывает полную статистику (сводка записей — из журнала попыток записи)"""
     if not is_admin(message.from_user.id):
         return
     
-    stats = await db.get_statistics()
     total_users = await db.get_total_users()
-    votes_details = await db.get_votes_details()
-    
-    text = "📊 <b>Полная статистика:</b>\n\n"
-    text += f"👥 <b>Всего пользователей:</b> {total_users}\n"
-    text += f"🎯 <b>Всего записей на активности:</b> {len(votes_details)}\n\n"
-    
-    for name, used_slots, max_slots, is_full in stats:
-        percentage = (used_slots / max_slots) * 100 if max_slots > 0 else 0
-        bar = "█" * int(percentage / 10) + "░" * (10 - int(percentage / 10))
-        
-        text += f"<b>{name}</b>\n"
-        text += f"{bar} {used_slots}/{max_slots} ({percentage:.1f}%)\n\n"
-    
-    # Список всех записей
-    text += "<b>Все записи:</b>\n"
-    for i, (user_id, username, full_name, phone, activity_name, voted_at) in enumerate(votes_details, 1):
-        username_display = f"@{username}" if username else "нет username"
-        text += f"{i}. {full_name} → {activity_name}\n"
+    summary = await journal_stats.vote_summary()
+    activities = await db.get_activities()
+    waiting = await db.get_waitlist_counts()
+    
+    # Список всех записей не помещается в сообщение — он выгружается файлом
+    keyboard = InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="📄 Все записи (CSV)", callback_data="export_votes")]
+    ])
+    await message.answer(
+        build_full_stats(activities, summary, total_users, RECENT_SIGNUPS_MINUTES, waiting)
+        + "\n\n" + build_attempts_summary(journal_stats.attempts),
+        reply_markup=keyboard,
+        parse_mode="HTML"
+    )
+
+async def send_votes_export(message: Message, compress: bool = False, split: bool = False):
+    """Отправляет выгрузку записей в чат сообщения"""
+    sent = 0
+    async for document, count, title in export_votes(db, compress=compress, split=split):
+        try:
+            if count:
+                await message.answer_document(document, caption=f"📁 {title}: {count} записей")
+                sent += 1
+        finally:
+            document.close()
     
-    await message.answer(text, parse_mode="HTML")
+    if sent:
+        await message.answer("📁 Экспорт данных завершен")
+    else:
+        await message.answer("📭 Нет данных для экспорта")
 
 @dp.message(F.text == "📁 Экспорт в CSV")
+@dp.message(Command("export"))
 async def export_to_csv(message: Message):
-    """Экспортирует данные в CSV формат"""
+    """Экспортирует данные в CSV формат.
+    
+    /export gz — сжать gzip, /export split — отдельный файл на каждую активность.
+    """
     if not is_admin(message.from_user.id):
         return
     
-    import csv
-    import io
-    from datetime import datetime
-    
-    # Получаем данные
-    votes_details = await db.get_votes_details()
-    
-    if not votes_details:
-        await message.answer("📭 Нет данных для экспорта")
+    options = (message.text or "").split()[1:]
+    await send_votes_export(message, compress="gz" in options, split="split" in options)
+
+@dp.callback_query(F.data == "export_votes")
+async def export_votes_callback(callback: CallbackQuery):
+    """Выгрузка всех записей из полной статистики"""
+    if not is_admin(callback.from_user.id):
+        await callback.answer()
         return
     
-    # Создаем CSV в памяти
-    output = io.StringIO()
-    writer = csv.writer(output)
-    
-    # Заголовки
-    writer.writerow(['ID', 'Username', 'ФИО', 'Телефон', 'Активность', 'Дата записи'])
-    
-    # Данные
-    for user_id, username, full_name, phone, activity_name, voted_at in votes_details:
-        writer.writerow([user_id, username or '', full_name, phone or '', activity_name, voted_at])
-    
-    # Создаем файл
-    csv_data = output.getvalue()
-    output.close()
-    
-    # Отправляем файл
-    file_name = f"activities_export_{datetime.now().strftime('%Y-%m-%d_%H-%M')}.csv"
-    
-    await message.answer_document(
-        types.BufferedInputFile(
-            csv_data.encode('utf-8'),
-            filename=file_name
-        ),
-        caption="📁 Экспорт данных завершен"
-    )
+    await callback.answer("📁 Готовлю файл...")
+    await send_votes_export(callback.message)
 
 @dp.message(F.text == "🔄 Обновить данные")
 async def refresh_admin_data(message: Message):
@@ -340,69 +729,113 @@ async def show_activities(message: Message, state: FSMContext):
         return
     
     # Проверяем, не голосовал ли уже пользователь
-    if await db.has_user_voted(user_id):
-        vote_info = await db.get_user_vote(user_id)
-        if vote_info:
-            activity_name, voted_at = vote_info
-            await message.answer(
-                f"❌ Вы уже записаны на активность!\n\n"
-                f"🎯 Ваш выбор: {activity_name}\n"
-                f"📅 Запись создана: {voted_at}\n\n"
-                f"Один пользователь может записаться только на одну активность.",
-                reply_markup=get_main_keyboard()
-            )
+    vote_info = await db.get_user_vote(user_id)
+    if vote_info:
+        activity_name, voted_at = vote_info
+        await message.answer(
+            f"❌ Вы уже записаны на активность!\n\n"
+            f"🎯 Ваш выбор: {activity_name}\n"
+            f"📅 Запись создана: {voted_at}\n\n"
+            f"Один пользователь может записаться только на одну активность.",
+            reply_markup=get_main_keyboard()
+        )
         return
     
-    keyboard = await create_activities_keyboard()
+    version = db.slots_version
+    keyboard = await create_activities_keyboard(db)
     
-    await message.answer(
+    sent = await message.answer(
         "🎯 <b>Выберите активность:</b>\n\n"
         "✅ - есть свободные места\n"
-        "❌ - мест нет\n\n"
+        "❌ - мест нет, можно встать в лист ожидания\n\n"
         "<i>Нажмите на кнопку с названием активности для записи</i>",
         reply_markup=keyboard,
         parse_mode="HTML"
     )
+    refresh_guard.remember(sent.chat.id, sent.message_id, version)
     await state.set_state(UserStates.waiting_vote)
 
 @dp.callback_query(F.data == "refresh")
 async def refresh_list(callback: CallbackQuery):
     """Обновление списка активностей"""
-    keyboard = await create_activities_keyboard()
+    if refresh_guard.throttle(callback.from_user.id):
+        await callback.answer("⏳ Список только что обновлялся, подождите пару секунд")
+        return
+    
+    chat_id, message_id = callback.message.chat.id, callback.message.message_id
+    # Клавиатура меняется только вместе с версией мест
+    version = db.slots_version
+    if refresh_guard.is_current(chat_id, message_id, version):
+        await callback.answer("✅ Список актуален")
+        return
     
+    keyboard = await create_activities_keyboard(db)
     try:
         await callback.message.edit_reply_markup(reply_markup=keyboard)
-        await callback.answer("✅ Список обновлен")
-    except:
+    except TelegramBadRequest as e:
+        if "not modified" not in str(e):
+            raise
+        refresh_guard.remember(chat_id, message_id, version)
+        refresh_guard.skipped += 1
         await callback.answer("✅ Список актуален")
+        return
+    
+    refresh_guard.remember(chat_id, message_id, version)
+    refresh_guard.edits += 1
+    await callback.answer("✅ Список обновлен")
 
-@dp.callback_query(F.data == "full")
-async def handle_full(callback: CallbackQuery):
-    """Обработка нажатия на заполненную активность"""
-    await callback.answer("❌ На эту активность уже нет свободных мест", show_alert=True)
+@dp.callback_query(F.data.startswith("full"))
+async def handle_full(callback: CallbackQuery, state: FSMContext):
+    """Обработка нажатия на заполненную активность: запись в лист ожидания"""
+    if callback.data == "full":
+        # Клавиатура, отправленная до появления листа ожидания
+        await callback.answer("❌ На эту активность уже нет свободных мест", show_alert=True)
+        return
+    
+    activity_id = int(callback.data.split("_")[1])
+    user_id = callback.from_user.id
+    outcome, repeated = await vote_dedupe.run(user_id, activity_id, lambda: wait_for_slot(activity_id, user_id))
+    await answer_vote(callback, activity_id, outcome, repeated)
+    await state.clear()
+
+@dp.callback_query(F.data == "wait_leave")
+async def leave_waitlist(callback: CallbackQuery):
+    """Выход из листа ожидания"""
+    if await db.leave_waitlist(callback.from_user.id):
+        await callback.message.edit_text("🚪 Вы больше не в листе ожидания")
+        await callback.answer()
+    else:
+        await callback.answer("Вы не в листе ожидания", show_alert=True)
 
 @dp.message(F.text == "📊 Статистика")
 async def show_statistics(message: Message):
     """Показывает статистику записей"""
-    stats = await db.get_statistics()
-    total_users = await db.get_total_users()
+    text = await get_statistics_text(db)
     
-    if not stats:
+    if not text:
         await message.answer("Статистика временно недоступна")
         return
     
-    text = "📊 <b>Статистика записей на активности:</b>\n\n"
-    
-    for name, used_slots, max_slots, is_full in stats:
-        percentage = (used_slots / max_slots) * 100
-        bar = "█" * int(percentage / 10) + "░" * (10 - int(percentage / 10))
-        
-        text += f"<b>{name}</b>\n"
-        text += f"{bar} {used_slots}/{max_slots} ({percentage:.1f}%)\n\n"
-    
-    text += f"👥 <b>Всего зарегистрированных пользователей:</b> {total_users}"
+    await message.answer(text, reply_markup=get_live_stats_keyboard(False), parse_mode="HTML")
+
+@dp.callback_query(F.data == "live_on")
+async def start_live_stats(callback: CallbackQuery):
+    """Включает автообновление сообщения со статистикой"""
+    text = await get_statistics_text(db)
+    if not text:
+        await callback.answer("Статистика временно недоступна")
+        return
     
-    await message.answer(text, parse_mode="HTML")
+    live_stats.watch(callback.message.chat.id, callback.message.message_id, text)
+    await callback.message.edit_text(text, reply_markup=get_live_stats_keyboard(True))
+    await callback.answer("🔴 Статистика будет обновляться сама")
+
+@dp.callback_query(F.data == "live_off")
+async def stop_live_stats(callback: CallbackQuery):
+    """Выключает автообновление сообщения со статистикой"""
+    live_stats.unwatch(callback.message.chat.id, callback.message.message_id)
+    await callback.message.edit_reply_markup(reply_markup=get_live_stats_keyboard(False))
+    await callback.answer("⏹ Обновление остановлено")
 
 @dp.message(F.text == "ℹ️ Моя запись")
 async def show_my_vote(message: Message):
@@ -425,26 +858,41 @@ async def show_my_vote(message: Message):
             parse_mode="HTML"
         )
     else:
+        waitlist_place = await db.get_waitlist_place(user_id)
+        if waitlist_place:
+            activity_name, place = waitlist_place
+            await message.answer(
+                f"⏳ <b>Вы в листе ожидания</b>\n\n"
+                f"🎯 <b>Активность:</b> {activity_name}\n"
+                f"🔢 <b>Ваш номер в очереди:</b> {place}\n\n"
+                f"Как только место освободится, мы запишем вас автоматически и пришлем сообщение.",
+                reply_markup=get_waitlist_keyboard(),
+                parse_mode="HTML"
+            )
+            return
         await message.answer(
             "❌ Вы еще не записаны ни на одну активность.\n\n"
             "Нажмите «🎯 Выбрать активность» чтобы сделать запись."
         )
 
+HELP_TEXT = (
+    "🆘 <b>Помощь по боту:</b>\n\n"
+    "🎯 <b>Выбрать активность</b> - записаться на одну из доступных активностей\n"
+    "📊 <b>Статистика</b> - посмотреть текущую статистику записей\n"
+    "ℹ️ <b>Моя запись</b> - информация о вашей текущей записи\n\n"
+    "<b>Правила:</b>\n"
+    "• Один пользователь может записаться только на ОДНУ активность\n"
+    "• Отмена записи невозможна\n"
+    "• Количество мест ограничено\n"
+    "• Если мест нет, нажмите на активность, чтобы встать в лист ожидания: "
+    "когда место освободится, бот запишет вас сам\n\n"
+    "По всем вопросам обращайтесь к организаторам."
+)
+
 @dp.message(F.text == "🆘 Помощь")
 async def show_help(message: Message):
     """Показывает справку"""
-    help_text = (
-        "🆘 <b>Помощь по боту:</b>\n\n"
-        "🎯 <b>Выбрать активность</b> - записаться на одну из доступных активностей\n"
-        "📊 <b>Статистика</b> - посмотреть текущую статистику записей\n"
-        "ℹ️ <b>Моя запись</b> - информация о вашей текущей записи\n\n"
-        "<b>Правила:</b>\n"
-        "• Один пользователь может записаться только на ОДНУ активность\n"
-        "• Отмена записи невозможна\n"
-        "• Количество мест ограничено\n\n"
-        "По всем вопросам обращайтесь к организаторам."
-    )
-    await message.answer(help_text, parse_mode="HTML")
+    await message.answer(HELP_TEXT, parse_mode="HTML")
 
 @dp.message(F.text == "↩️ Назад")
 async def back_to_main(message: Message, state: FSMContext):
@@ -453,15 +901,137 @@ async def back_to_main(message: Message, state: FSMContext):
     await message.answer("Главное меню:", reply_markup=get_main_keyboard())
 
 # Запуск бота
-async def main():
-    logger.info("Starting bot...")
-    
-    # Инициализация базы данных
-    await db.init_db()
+async def on_startup(bot: Bot):
+    global metrics_runner
+    await db.init_db(catalog_watcher.load())
     logger.info("Database initialized")
+    fsm_storage.start()
     
-    # Запуск бота
+    if METRICS_PORT:
+        metrics_runner = await metrics.start_metrics_server(METRICS_HOST, METRICS_PORT)
+    
+    await primary_election.start()
+    live_stats.start()
+    cache_sync.start()
+    # Сводка берется из journal_snapshot, журнал дочитывается с ее места
+    await journal_stats.catch_up()
+    journal_stats.start()
+    
+    # При нескольких процессах вебхук ставит супервизор
+    if BOT_MODE == "webhook" and WORKER_INDEX is None:
+        await set_webhook()
+
+async def set_webhook():
+    await bot.set_webhook(
+        f"{WEBHOOK_BASE_URL.rstrip('/')}{WEBHOOK_PATH}",
+        secret_token=WEBHOOK_SECRET,
+        allowed_updates=dp.resolve_used_update_types(),
+        max_connections=min(MAX_CONCURRENT_UPDATES * WORKERS, 100),
+    )
+    logger.info("Webhook set")
+
+async def on_shutdown(bot: Bot):
+    # Даем начатым апдейтам завершиться, прежде чем закрыть базу
+    await admission.wait_idle(SHUTDOWN_TIMEOUT)
+    await primary_election.stop()
+    await broadcaster.stop()
+    await live_stats.stop()
+    await waitlist_notifier.stop()
+    await catalog_watcher.stop()
+    await cache_sync.stop()
+    await slot_reconciler.stop()
+    await journal_stats.stop()
+    # Диспетчер уже закрыл хранилище, но начатые апдейты могли успеть изменить состояния
+    await fsm_storage.close()
+    await db.close()
+    logger.info("Database closed")
+    if metrics_runner is not None:
+        await metrics_runner.cleanup()
+
+async def run_polling():
     await dp.start_polling(bot)
 
+def run_webhook():
+    app = web.Application()
+    # Хуки диспетчера регистрируем раньше обработчика вебхука: aiohttp вызывает
+    # on_shutdown по порядку, а обработчик закрывает сессию бота
+    setup_application(app, dp, bot=bot)
+    SimpleRequestHandler(
+        dispatcher=dp,
+        bot=bot,
+        secret_token=WEBHOOK_SECRET,
+        handle_in_background=True,
+    ).register(app, path=WEBHOOK_PATH)
+    web.run_app(app, host=WEBAPP_HOST, port=WEBAPP_PORT, shutdown_timeout=SHUTDOWN_TIMEOUT)
+
+def worker_main(queue, ready):
+    """Точка входа процесса-обработчика, который запускает Supervisor"""
+    # Останавливает обработчик супервизор, когда дошлет ему все апдейты
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    dp.startup.register(on_startup)
+    dp.shutdown.register(on_shutdown)
+    asyncio.run(run_worker(queue, ready))
+
+async def run_worker(queue, ready):
+    logger.info(f"Worker {WORKER_INDEX} starting...")
+    await dp.emit_startup(bot=bot, dispatcher=dp, bots=[bot])
+    ready.set()
+    try:
+        await feed_from_queue(dp, bot, queue)
+    finally:
+        await dp.emit_shutdown(bot=bot, dispatcher=dp, bots=[bot])
+        await bot.session.close()
+
+async def run_supervisor_polling():
+    supervisor = Supervisor(worker_main)
+    # SIGINT/SIGTERM в любой момент, даже во время запуска, ведут к штатной остановке обработчиков
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, asyncio.current_task().cancel)
+    try:
+        await supervisor.start()
+        await supervisor.run_polling(bot, allowed_updates=dp.resolve_used_update_types())
+    except asyncio.CancelledError:
+        logger.info("Supervisor stopping...")
+    finally:
+        await supervisor.stop()
+        await bot.session.close()
+
+def run_supervisor_webhook():
+    supervisor = Supervisor(worker_main)
+    
+    async def start(app):
+        await supervisor.start()
+        await set_webhook()
+    
+    async def stop(app):
+        await supervisor.stop()
+        await bot.session.close()
+    
+    app = web.Application()
+    app.on_startup.append(start)
+    app.on_shutdown.append(stop)
+    app.router.add_post(WEBHOOK_PATH, supervisor.webhook_handler(WEBHOOK_SECRET))
+    web.run_app(app, host=WEBAPP_HOST, port=WEBAPP_PORT, shutdown_timeout=SHUTDOWN_TIMEOUT)
+
+def main():
+    if WORKERS > 1:
+        logger.info(f"Starting supervisor with {WORKERS} workers in {BOT_MODE} mode...")
+        if BOT_MODE == "webhook":
+            run_supervisor_webhook()
+        else:
+            asyncio.run(run_supervisor_polling())
+        return
+    
+    logger.info(f"Starting bot in {BOT_MODE} mode...")
+    dp.startup.register(on_startup)
+    dp.shutdown.register(on_shutdown)
+    
+    if BOT_MODE == "webhook":
+        run_webhook()
+    else:
+        asyncio.run(run_polling())
+
 if __name__ == "__main__":
-    asyncio.run(main())
+    main()
@@ -0,0 +1,164 @@
+"""Рассылки администратора.
+
+Получатели рассылки сохраняются в базе вместе с текстом, отправка идет
+пачками, и после каждой пачки статусы получателей записываются в базу.
+После перезапуска незавершенные рассылки продолжаются с неотправленных
+получателей (сообщения последней незаписанной пачки могут уйти повторно).
+Скорость рассылки ограничена BROADCAST_RATE, общие лимиты Bot API
+соблюдает OutboundLimiter сессии бота.
+"""
+import asyncio
+import logging
+import time
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramAPIError, TelegramNetworkError, TelegramRetryAfter
+
+from config import BROADCAST_RATE, BROADCAST_CHUNK_SIZE, BROADCAST_PROGRESS_INTERVAL
+from outbound import TokenBucket
+
+logger = logging.getLogger(__name__)
+
+TARGET_ALL = "all"
+TARGET_NOT_VOTED = "novote"
+
+
+def parse_target(value: str, activities: dict):
+    """all, novote или id активности из каталога activities -> цель рассылки; None, если не распознана"""
+    value = value.lower()
+    if value in (TARGET_ALL, TARGET_NOT_VOTED):
+        return value
+    if value.isdigit() and int(value) in activities:
+        return f"activity:{int(value)}"
+    return None
+
+
+def describe_target(target: str, activities: dict) -> str:
+    if target == TARGET_ALL:
+        return "всем пользователям"
+    if target == TARGET_NOT_VOTED:
+        return "пользователям без записи"
+    activity = activities.get(int(target.split(":")[1]))
+    return f"участникам «{activity['name'] if activity else target}»"
+
+
+async def collect_recipients(db, target: str) -> list:
+    """chat_id получателей рассылки"""
+    if target == TARGET_ALL:
+        rows = db.iter_all_users()
+    elif target == TARGET_NOT_VOTED:
+        rows = db.iter_users_without_vote()
+    else:
+        rows = db.iter_activity_participants(int(target.split(":")[1]))
+    return [row[0] async for row in rows]
+
+
+class Broadcaster:
+    """Запускает, продолжает и останавливает рассылки"""
+
+    def __init__(self, bot: Bot, db, rate: float = BROADCAST_RATE, chunk_size: int = BROADCAST_CHUNK_SIZE,
+                 progress_interval: float = BROADCAST_PROGRESS_INTERVAL):
+        self.bot = bot
+        self.db = db
+        # Без запаса: рассылка идет ровным темпом и не съедает общий лимит рывками
+        self.bucket = TokenBucket(rate, 1)
+        self.chunk_size = chunk_size
+        self.progress_interval = progress_interval
+        self._tasks = {}
+
+    @property
+    def active(self) -> list:
+        return list(self._tasks)
+
+    async def start(self, admin_id: int, target: str, text: str):
+        """Сохраняет рассылку и запускает ее. Возвращает (id, число получателей)"""
+        chat_ids = await collect_recipients(self.db, target)
+        broadcast_id = await self.db.create_broadcast(admin_id, target, text, chat_ids)
+        logger.info(f"Рассылка {broadcast_id} ({target}): {len(chat_ids)} получателей")
+        self._spawn(broadcast_id, admin_id, target, text)
+        return broadcast_id, len(chat_ids)
+
+    async def resume(self) -> int:
+        """Продолжает незавершенные рассылки после перезапуска"""
+        broadcasts = await self.db.get_unfinished_broadcasts()
+        # Процесс мог снова стать ведущим, не прервав свои рассылки
+        broadcasts = [broadcast for broadcast in broadcasts if broadcast[0] not in self._tasks]
+        for broadcast_id, admin_id, target, text in broadcasts:
+            logger.info(f"Продолжаем рассылку {broadcast_id}")
+            self._spawn(broadcast_id, admin_id, target, text)
+        return len(broadcasts)
+
+    async def stop(self):
+        """Прерывает рассылки; отправленное уже записано в базу"""
+        tasks = list(self._tasks.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def _spawn(self, broadcast_id, admin_id, target, text):
+        task = asyncio.create_task(self._run(broadcast_id, admin_id, target, text))
+        self._tasks[broadcast_id] = task
+        task.add_done_callback(lambda _: self._tasks.pop(broadcast_id, None))
+
+    async def _send(self, chat_id: int, text: str) -> str:
+        await self.bucket.acquire()
+        try:
+            await self.bot.send_message(chat_id, text)
+        except (TelegramRetryAfter, TelegramNetworkError) as e:
+            # Получатель останется pending и попадет в следующую пачку
+            logger.warning(f"Рассылка в чат {chat_id} отложена: {e}")
+            return "pending"
+        except TelegramAPIError as e:
+            # Бот заблокирован, чат не найден и т.п. — повтор не поможет
+            logger.info(f"Рассылка в чат {chat_id} не доставлена: {e}")
+            return "failed"
+        return "sent"
+
+    async def _progress_text(self, broadcast_id: int, target: str, finished: bool = False) -> str:
+        progress = await self.db.get_broadcast_progress(broadcast_id)
+        sent, failed = progress.get("sent", 0), progress.get("failed", 0)
+        total = sum(progress.values())
+        status = "✅ завершена" if finished else "⏳ идет"
+        return (
+            f"📣 Рассылка #{broadcast_id} {describe_target(target, self.db.activities)}: {status}\n"
+            f"Отправлено: {sent} из {total}, не доставлено: {failed}"
+        )
+
+    async def _report(self, admin_id, message_id, text):
+        try:
+            if message_id is None:
+                return (await self.bot.send_message(admin_id, text)).message_id
+            await self.bot.edit_message_text(text, chat_id=admin_id, message_id=message_id)
+        except TelegramAPIError as e:
+            logger.warning(f"Не удалось обновить прогресс рассылки: {e}")
+        return message_id
+
+    async def _run(self, broadcast_id: int, admin_id: int, target: str, text: str):
+        message_id = await self._report(admin_id, None, await self._progress_text(broadcast_id, target))
+        reported_at = time.monotonic()
+        try:
+            while True:
+                chat_ids = await self.db.get_pending_recipients(broadcast_id, self.chunk_size)
+                if not chat_ids:
+                    break
+
+                results = await asyncio.gather(*(self._send(chat_id, text) for chat_id in chat_ids))
+                done = [(chat_id, status) for chat_id, status in zip(chat_ids, results) if status != "pending"]
+                if done:
+                    await self.db.mark_broadcast_recipients(broadcast_id, done)
+                else:
+                    # Вся пачка отложена — даем Bot API передохнуть
+                    await asyncio.sleep(1)
+
+                if time.monotonic() - reported_at >= self.progress_interval:
+                    await self._report(admin_id, message_id, await self._progress_text(broadcast_id, target))
+                    reported_at = time.monotonic()
+
+            await self.db.finish_broadcast(broadcast_id)
+            await self._report(admin_id, message_id, await self._progress_text(broadcast_id, target, finished=True))
+            logger.info(f"Рассылка {broadcast_id} завершена")
+        except asyncio.CancelledError:
+            logger.info(f"Рассылка {broadcast_id} прервана, продолжим после перезапуска")
+            raise
+        except Exception:
+            logger.exception(f"Ошибка в рассылке {broadcast_id}")
@@ -0,0 +1,145 @@
+"""Каталог активностей из файла с перезагрузкой на лету.
+
+Файл ACTIVITIES_FILE (JSON или TOML, формат — в config.py) читается при
+запуске, а CatalogWatcher раз в CATALOG_POLL_INTERVAL секунд сверяет его
+время изменения и размер. Новый каталог применяет Database.update_activities:
+отличия от таблицы activities пишутся одной транзакцией, после коммита
+таблица мест, кэши и клавиатуры переключаются разом. Каталог с ошибкой
+(в том числе max_slots меньше уже занятых мест) не применяется целиком,
+ошибка пишется в лог один раз на каждую версию файла.
+"""
+import asyncio
+import json
+import logging
+import os
+import tomllib
+
+from storage import CatalogError
+from config import ACTIVITIES_FILE, CATALOG_POLL_INTERVAL
+
+logger = logging.getLogger(__name__)
+
+
+def parse_catalog(data) -> dict:
+    """Проверяет разобранный файл и возвращает каталог {id: {'name', 'max_slots'}}"""
+    entries = data.get("activities") if isinstance(data, dict) else None
+    if not isinstance(entries, list) or not entries:
+        raise CatalogError("В файле нет списка activities")
+
+    activities = {}
+    for number, entry in enumerate(entries, 1):
+        if not isinstance(entry, dict):
+            raise CatalogError(f"Активность №{number}: ожидается объект с id, name и max_slots")
+        activity_id, name, max_slots = entry.get("id"), entry.get("name"), entry.get("max_slots")
+        # bool — подкласс int, но true вместо числа почти наверняка опечатка
+        if type(activity_id) is not int or activity_id <= 0:
+            raise CatalogError(f"Активность №{number}: id должен быть положительным целым")
+        if activity_id in activities:
+            raise CatalogError(f"Активность №{number}: id {activity_id} уже встречался")
+        if not isinstance(name, str) or not name.strip():
+            raise CatalogError(f"Активность id {activity_id}: пустое название")
+        if type(max_slots) is not int or max_slots < 0:
+            raise CatalogError(f"Активность id {activity_id}: max_slots должен быть неотрицательным целым")
+        activities[activity_id] = {"name": name.strip(), "max_slots": max_slots}
+    return activities
+
+
+def read_catalog(path: str) -> dict:
+    """Читает каталог из .json или .toml"""
+    with open(path, "rb") as f:
+        raw = f.read()
+    try:
+        if path.endswith(".toml"):
+            data = tomllib.loads(raw.decode("utf-8"))
+        else:
+            data = json.loads(raw)
+    except (UnicodeDecodeError, json.JSONDecodeError, tomllib.TOMLDecodeError) as e:
+        raise CatalogError(f"Не удалось разобрать {path}: {e}") from e
+    return parse_catalog(data)
+
+
+def describe_diff(diff, activities: dict) -> str:
+    """Итог примененного каталога для админа (названия — из уже обновленного каталога activities)"""
+    if not diff:
+        return "Каталог не изменился"
+
+    def names(ids):
+        return ", ".join(activities.get(activity_id, {}).get("name", str(activity_id)) for activity_id in ids)
+
+    lines = []
+    if diff.added:
+        lines.append(f"➕ Добавлены: {names(diff.added)}")
+    if diff.changed:
+        lines.append(f"✏️ Изменены: {names(diff.changed)}")
+    if diff.removed:
+        lines.append(f"➖ Удалены: {', '.join(map(str, diff.removed))}")
+    return "\n".join(lines)
+
+
+class CatalogWatcher:
+    """Фоновая задача, которая применяет изменения файла каталога"""
+
+    def __init__(self, db, path: str = ACTIVITIES_FILE, interval: float = CATALOG_POLL_INTERVAL):
+        self.db = db
+        self.path = path
+        self.interval = interval
+        self._stamp = None
+        self._task = None
+        # Счетчики для наблюдения
+        self.reloads = 0
+        self.errors = 0
+
+    def _file_stamp(self):
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
+    def load(self):
+        """Каталог из файла или None, если файла нет. Запоминает версию файла"""
+        self._stamp = self._file_stamp()
+        if self._stamp is None:
+            return None
+        return read_catalog(self.path)
+
+    async def reload(self):
+        """Перечитывает файл (без файла — config.ACTIVITIES) и применяет. Возвращает CatalogDiff"""
+        activities = self.load()
+        diff = await self.db.update_activities(activities)
+        if diff:
+            self.reloads += 1
+            logger.info(f"Каталог активностей обновлен: {describe_diff(diff, self.db.activities)}")
+        return diff
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            stamp = self._file_stamp()
+            # Удаленный файл не отменяет примененный каталог
+            if stamp is None or stamp == self._stamp:
+                continue
+            try:
+                await self.reload()
+            except (CatalogError, OSError) as e:
+                self.errors += 1
+                logger.error(f"Каталог активностей из {self.path} не применен: {e}")
+            except Exception:
+                self.errors += 1
+                # Файл в порядке, не удалась запись — повторим при следующей проверке
+                self._stamp = None
+                logger.exception("Ошибка при обновлении каталога активностей")
@@ -1,4 +1,5 @@
 import os
+import socket
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -9,10 +10,142 @@ if not BOT_TOKEN:
 
 DATABASE_URL = os.getenv('DATABASE_URL', 'sqlite:///votes.db')
 
+# Режим получения апдейтов: polling (локальный запуск) или webhook
+BOT_MODE = os.getenv('BOT_MODE', 'polling')
+WEBHOOK_BASE_URL = os.getenv('WEBHOOK_BASE_URL', '')  # например https://my-bot.up.railway.app
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', '/webhook')
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET', '')
+WEBAPP_HOST = os.getenv('WEBAPP_HOST', '0.0.0.0')
+WEBAPP_PORT = int(os.getenv('PORT', '8080'))
+# Сколько апдейтов обрабатываем одновременно, остальные ждут своей очереди
+MAX_CONCURRENT_UPDATES = int(os.getenv('MAX_CONCURRENT_UPDATES', '100'))
+# Классы приоритета апдейтов (см. middlewares.AdmissionControlMiddleware): сколько апдейтов
+# каждого класса обрабатываем одновременно в пределах MAX_CONCURRENT_UPDATES. Запись на
+# активность и регистрация ждут очереди сколько нужно; просмотры (статистика, помощь,
+# обновление списка) ждут не больше ADMISSION_VIEW_MAX_WAIT секунд и не больше
+# ADMISSION_VIEW_QUEUE штук, остальным бот сразу отвечает «занят» или ответом из кэша
+ADMISSION_RESERVE_LIMIT = int(os.getenv('ADMISSION_RESERVE_LIMIT', str(MAX_CONCURRENT_UPDATES)))
+ADMISSION_REGISTER_LIMIT = int(os.getenv('ADMISSION_REGISTER_LIMIT', '50'))
+ADMISSION_VIEW_LIMIT = int(os.getenv('ADMISSION_VIEW_LIMIT', '20'))
+ADMISSION_VIEW_QUEUE = int(os.getenv('ADMISSION_VIEW_QUEUE', '50'))
+ADMISSION_VIEW_MAX_WAIT = float(os.getenv('ADMISSION_VIEW_MAX_WAIT', '2'))
+# Сколько секунд ждем завершения начатых апдейтов при остановке
+SHUTDOWN_TIMEOUT = float(os.getenv('SHUTDOWN_TIMEOUT', '10'))
+
+# Несколько процессов-обработчиков (см. workers.py): при WORKERS > 1 bot.py запускает
+# супервизор, который получает апдейты и раздает их WORKERS процессам по from_user.id.
+# WORKER_INDEX супервизор выставляет сам своим процессам, вручную его не задают
+WORKERS = int(os.getenv('WORKERS', '1'))
+WORKER_INDEX = int(os.getenv('WORKER_INDEX')) if os.getenv('WORKER_INDEX') else None
+# Имя экземпляра бота, если на одной базе (Postgres) их несколько, например реплики
+# вебхука. Под ним и номером обработчика процесс хранит позицию в журнале сброса кэшей;
+# пусто — имя машины и pid процесса
+INSTANCE_ID = os.getenv('INSTANCE_ID', '')
+CACHE_READER_ID = f"{INSTANCE_ID or f'{socket.gethostname()}:{os.getpid()}'}/{WORKER_INDEX or 0}"
+# Сколько секунд супервизор ждет готовности процесса-обработчика при запуске
+WORKER_START_TIMEOUT = float(os.getenv('WORKER_START_TIMEOUT', '60'))
+# Как часто процесс сверяет кэш мест и пользователей с базой (секунды), 0 — не сверять
+CACHE_SYNC_INTERVAL = float(os.getenv('CACHE_SYNC_INTERVAL', '1'))
+# Свой адрес Bot API (например, локальный telegram-bot-api), пусто — api.telegram.org
+TELEGRAM_API_URL = os.getenv('TELEGRAM_API_URL', '')
+
+if WORKERS < 1:
+    raise ValueError("WORKERS must be at least 1")
+if min(ADMISSION_RESERVE_LIMIT, ADMISSION_REGISTER_LIMIT, ADMISSION_VIEW_LIMIT) < 1:
+    raise ValueError("ADMISSION_*_LIMIT must be at least 1")
+if BOT_MODE not in ('polling', 'webhook'):
+    raise ValueError("BOT_MODE must be 'polling' or 'webhook'")
+if BOT_MODE == 'webhook' and not (WEBHOOK_BASE_URL and WEBHOOK_SECRET):
+    raise ValueError("WEBHOOK_BASE_URL and WEBHOOK_SECRET are required in webhook mode!")
+
+# Пул соединений SQLite
+DB_POOL_SIZE = int(os.getenv('DB_POOL_SIZE', '4'))
+DB_BUSY_TIMEOUT_MS = int(os.getenv('DB_BUSY_TIMEOUT_MS', '5000'))
+DB_WRITE_RETRIES = int(os.getenv('DB_WRITE_RETRIES', '3'))
+# Сколько заявок на бронь писатель коммитит одной транзакцией
+RESERVE_BATCH_SIZE = int(os.getenv('RESERVE_BATCH_SIZE', '200'))
+# Сколько пользователей держим в кэше регистрации/записи
+USER_CACHE_SIZE = int(os.getenv('USER_CACHE_SIZE', '50000'))
+
+# Экспорт: строк за одно чтение из базы и сколько байт держим в памяти до сброса на диск
+EXPORT_CHUNK_SIZE = int(os.getenv('EXPORT_CHUNK_SIZE', '500'))
+EXPORT_SPOOL_MAX_BYTES = int(os.getenv('EXPORT_SPOOL_MAX_BYTES', str(1024 * 1024)))
+
+# Пользователей на одной странице в админке
+USERS_PAGE_SIZE = int(os.getenv('USERS_PAGE_SIZE', '10'))
+# Окно «записались за последние N минут» в полной статистике
+RECENT_SIGNUPS_MINUTES = int(os.getenv('RECENT_SIGNUPS_MINUTES', '15'))
+
+# Исходящие запросы к Bot API: сообщений в секунду на весь бот и на один чат.
+# Глобальные скорости здесь и у рассылок делятся поровну между процессами-обработчиками;
+# чат одного пользователя всегда обслуживает один процесс
+OUTBOUND_GLOBAL_RATE = float(os.getenv('OUTBOUND_GLOBAL_RATE', '30')) / WORKERS
+OUTBOUND_CHAT_RATE = float(os.getenv('OUTBOUND_CHAT_RATE', '1'))
+OUTBOUND_CHAT_BURST = int(os.getenv('OUTBOUND_CHAT_BURST', '3'))
+# Сколько раз повторяем запрос после 429 Too Many Requests
+OUTBOUND_RETRIES = int(os.getenv('OUTBOUND_RETRIES', '3'))
+
+# Рассылки: скорость (меньше глобальной, чтобы оставался запас на ответы пользователям),
+# получателей за одно чтение из базы и как часто обновлять сообщение о прогрессе (секунды)
+BROADCAST_RATE = float(os.getenv('BROADCAST_RATE', '20')) / WORKERS
+BROADCAST_CHUNK_SIZE = int(os.getenv('BROADCAST_CHUNK_SIZE', '50'))
+BROADCAST_PROGRESS_INTERVAL = float(os.getenv('BROADCAST_PROGRESS_INTERVAL', '5'))
+
+# Метрики Prometheus: http://METRICS_HOST:METRICS_PORT/metrics, 0 — не запускать сервер.
+# Процесс-обработчик с номером i отдает метрики на METRICS_PORT + i
+METRICS_HOST = os.getenv('METRICS_HOST', '127.0.0.1')
+METRICS_PORT = int(os.getenv('METRICS_PORT', '9100'))
+if METRICS_PORT and WORKER_INDEX:
+    METRICS_PORT += WORKER_INDEX
+
+# Трассировка: дерево спанов каждого апдейта, апдейты дольше TRACE_SLOW_MS пишутся в лог JSON-строкой
+TRACE_ENABLED = os.getenv('TRACE_ENABLED', '0').lower() in ('1', 'true', 'yes')
+TRACE_SLOW_MS = float(os.getenv('TRACE_SLOW_MS', '500'))
+# Профилировщик /profile: шаг сэмплирования и предельная длительность
+PROFILE_INTERVAL_MS = float(os.getenv('PROFILE_INTERVAL_MS', '5'))
+PROFILE_MAX_SECONDS = int(os.getenv('PROFILE_MAX_SECONDS', '60'))
+
+# «🔄 Обновить список» одним пользователем не чаще раза в N секунд
+REFRESH_THROTTLE_SECONDS = float(os.getenv('REFRESH_THROTTLE_SECONDS', '3'))
+
+# Повторные нажатия vote_<id> дожидаются начатой записи, а N секунд после нее
+# получают ее итог без обращения к базе (0 — не хранить итоги)
+VOTE_OUTCOME_TTL = float(os.getenv('VOTE_OUTCOME_TTL', '10'))
+
+# Живая статистика: не чаще одной правки сообщения в N секунд, сколько секунд
+# сообщение обновляется после включения и сколько таких сообщений держим одновременно
+LIVE_EDIT_INTERVAL = float(os.getenv('LIVE_EDIT_INTERVAL', '5'))
+LIVE_VIEW_TTL = float(os.getenv('LIVE_VIEW_TTL', '900'))
+LIVE_MAX_VIEWERS = int(os.getenv('LIVE_MAX_VIEWERS', '1000'))
+
+# Состояния FSM пишутся в базу пачкой раз в N секунд (и при остановке)
+FSM_FLUSH_INTERVAL = float(os.getenv('FSM_FLUSH_INTERVAL', '1'))
+
+# Журнал попыток записи (см. journal.py): события пишутся в базу пачкой раз в N секунд,
+# статистика дочитывает журнал раз в JOURNAL_STATS_INTERVAL секунд по JOURNAL_READ_CHUNK строк
+JOURNAL_FLUSH_INTERVAL = float(os.getenv('JOURNAL_FLUSH_INTERVAL', '1'))
+JOURNAL_STATS_INTERVAL = float(os.getenv('JOURNAL_STATS_INTERVAL', '5'))
+JOURNAL_READ_CHUNK = int(os.getenv('JOURNAL_READ_CHUNK', '1000'))
+# Как часто сверяем счетчики занятых мест с записями (секунды), 0 — только по /reconcile
+RECONCILE_INTERVAL = float(os.getenv('RECONCILE_INTERVAL', '300'))
+
+# Лист ожидания: сколько уведомлений о переводе отправляем за проход и как часто
+# проверяем переведенных другими процессами (секунды)
+WAITLIST_NOTIFY_CHUNK = int(os.getenv('WAITLIST_NOTIFY_CHUNK', '50'))
+WAITLIST_POLL_INTERVAL = float(os.getenv('WAITLIST_POLL_INTERVAL', '30'))
+
+# Каталог активностей в файле (.json или .toml), изменения подхватываются без перезапуска:
+# файл проверяется раз в CATALOG_POLL_INTERVAL секунд. Без файла используется ACTIVITIES ниже.
+# Формат: {"activities": [{"id": 1, "name": "Квиз", "max_slots": 40}, ...]}
+# или в TOML — таблицы [[activities]] с теми же полями
+ACTIVITIES_FILE = os.getenv('ACTIVITIES_FILE', 'activities.json')
+CATALOG_POLL_INTERVAL = float(os.getenv('CATALOG_POLL_INTERVAL', '5'))
+
 # ID администраторов (замени на свои Telegram ID)
 ADMIN_IDS = [801181185]  # ЗАМЕНИ ЭТОТ ID НА СВОЙ РЕАЛЬНЫЙ!
 
-# Конфигурация активностей
+# Каталог активностей по умолчанию (без ACTIVITIES_FILE); при работе не меняется,
+# текущий каталог — Database.activities
 ACTIVITIES = {
     1: {"name": "Настольный теннис", "max_slots": 10},
     2: {"name": "Квиз", "max_slots": 40},
@@ -1,227 +1,741 @@
-import aiosqlite
-from config import ACTIVITIES
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
 
-class Database:
-    def __init__(self, db_path='votes.db'):
-        self.db_path = db_path
-    
-    async def init_db(self):
-        """Инициализация базы данных"""
-        async with aiosqlite.connect(self.db_path) as db:
-            # Таблица пользователей
-            await db.execute('''
-                CREATE TABLE IF NOT EXISTS users (
-                    telegram_id INTEGER PRIMARY KEY,
-                    username TEXT,
-                    full_name TEXT,
-                    phone TEXT,
-                    registered_at DATETIME DEFAULT CURRENT_TIMESTAMP
-                )
-            ''')
-            
-            # Таблица активностей
-            await db.execute('''
-                CREATE TABLE IF NOT EXISTS activities (
-                    id INTEGER PRIMARY KEY,
-                    name TEXT NOT NULL,
-                    max_slots INTEGER NOT NULL,
-                    used_slots INTEGER DEFAULT 0
-                )
-            ''')
-            
-            # Таблица голосов
-            await db.execute('''
-                CREATE TABLE IF NOT EXISTS votes (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    user_id INTEGER NOT NULL,
-                    activity_id INTEGER NOT NULL,
-                    voted_at DATETIME DEFAULT CURRENT_TIMESTAMP,
-                    FOREIGN KEY (user_id) REFERENCES users (telegram_id),
-                    FOREIGN KEY (activity_id) REFERENCES activities (id),
-                    UNIQUE(user_id, activity_id)
-                )
-            ''')
+from storage import ReserveResult, StorageBusyError, WaitlistResult, create_backend
+from metrics import DB_METHOD_SECONDS, RESERVATIONS, SLOT_REPAIRS, timed
+from tracing import traced
+from journal import ReservationJournal
+from sqlite_storage import SQLiteBackend
+from config import (
+    ACTIVITIES, DATABASE_URL, RESERVE_BATCH_SIZE, USER_CACHE_SIZE,
+    EXPORT_CHUNK_SIZE, USERS_PAGE_SIZE,
+)
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class ActivitySlots:
+    """Состояние мест активности в памяти процесса"""
+    id: int
+    name: str
+    max_slots: int
+    used_slots: int
+
+    @property
+    def is_full(self) -> bool:
+        return self.used_slots >= self.max_slots
+
+
+@dataclass
+class UserStatus:
+    """Кэшируемое состояние пользователя: регистрация и запись"""
+    registered: bool
+    activity_name: str = None
+    voted_at: str = None
+
+    @property
+    def has_voted(self) -> bool:
+        return self.activity_name is not None
+
+
+@dataclass
+class _ReserveRequest:
+    activity_id: int
+    user_id: int
+    future: asyncio.Future
+    voted_at: str = None
+
+
+@dataclass
+class _WaitlistRequest:
+    activity_id: int
+    user_id: int
+    future: asyncio.Future
+
+
+@dataclass
+class _WriteJob:
+    func: object
+    on_commit: object
+    future: asyncio.Future
+
+
+class ReservationWriter:
+    """Единственный писатель в votes и activities.
+
+    Заявки на бронь и в лист ожидания складываются в очередь; задача-писатель
+    забирает их пачками, решает каждую в порядке поступления внутри одной
+    транзакции и коммитит один раз на пачку. Прочие записи в эти таблицы
+    (синхронизация активностей, удаление записи) выполняются как отдельные
+    задания в той же очереди.
+    """
+
+    def __init__(self, db, batch_size: int = RESERVE_BATCH_SIZE):
+        self.db = db
+        self.batch_size = batch_size
+        self._queue = asyncio.Queue()
+        self._task = None
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Дожидается обработки очереди и останавливает писателя"""
+        if self._task is None:
+            return
+        self._queue.put_nowait(None)
+        await self._task
+        self._task = None
+
+    async def reserve(self, activity_id: int, user_id: int) -> ReserveResult:
+        """Ставит заявку в очередь и ждет решения"""
+        future = asyncio.get_running_loop().create_future()
+        self._queue.put_nowait(_ReserveRequest(activity_id, user_id, future))
+        return await future
+
+    async def join_waitlist(self, activity_id: int, user_id: int):
+        """Ставит заявку в лист ожидания в очередь и ждет (WaitlistResult, место)"""
+        future = asyncio.get_running_loop().create_future()
+        self._queue.put_nowait(_WaitlistRequest(activity_id, user_id, future))
+        return await future
+
+    async def run(self, func, on_commit=None):
+        """Выполняет await func() в очереди писателя, между пачками броней.
+
+        on_commit(result) вызывается сразу после коммита, до следующей пачки.
+        """
+        future = asyncio.get_running_loop().create_future()
+        self._queue.put_nowait(_WriteJob(func, on_commit, future))
+        return await future
+
+    async def _run(self):
+        while True:
+            items = [await self._queue.get()]
+            while len(items) < self.batch_size and not self._queue.empty():
+                items.append(self._queue.get_nowait())
             
-            await db.commit()
+            # Пачка — подряд идущие заявки одного вида
+            batch = []
+            for item in items:
+                if isinstance(item, (_ReserveRequest, _WaitlistRequest)):
+                    if batch and type(batch[0]) is not type(item):
+                        await self._commit(batch)
+                        batch = []
+                    batch.append(item)
+                    continue
+                if batch:
+                    await self._commit(batch)
+                    batch = []
+                if item is None:
+                    self._drain()
+                    return
+                await self._run_job(item)
+            if batch:
+                await self._commit(batch)
+
+    def _drain(self):
+        """Отвечает BUSY на заявки, пришедшие после остановки"""
+        while not self._queue.empty():
+            item = self._queue.get_nowait()
+            if isinstance(item, _ReserveRequest):
+                item.future.set_result(ReserveResult.BUSY)
+            elif isinstance(item, _WaitlistRequest):
+                item.future.set_result((WaitlistResult.BUSY, None))
+            elif item is not None:
+                item.future.set_exception(RuntimeError("ReservationWriter остановлен"))
+
+    async def _run_job(self, job):
+        try:
+            result = await job.func()
+            if job.on_commit:
+                job.on_commit(result)
+        except Exception as e:
+            if not job.future.done():
+                job.future.set_exception(e)
+        else:
+            if not job.future.done():
+                job.future.set_result(result)
+
+    async def _commit(self, batch):
+        if isinstance(batch[0], _ReserveRequest):
+            await self._commit_batch(batch)
+        else:
+            await self._commit_waitlist(batch)
+
+    async def _commit_waitlist(self, batch):
+        try:
+            decided, promoted = await self.db.backend.join_waitlist(
+                [(request.activity_id, request.user_id) for request in batch]
+            )
+        except StorageBusyError:
+            logger.warning(f"Пачка из {len(batch)} заявок в лист ожидания не записана: база занята")
+            decided = [(WaitlistResult.BUSY, None)] * len(batch)
+            promoted = []
+        except Exception as e:
+            logger.exception("Ошибка при записи пачки заявок в лист ожидания")
+            for request in batch:
+                if not request.future.done():
+                    request.future.set_exception(e)
+            return
         
-        # Синхронизируем с config.py
-        await self.update_activities()
-    
-    async def update_activities(self):
-        """Обновляет список активностей в базе данных"""
-        async with aiosqlite.connect(self.db_path) as db:
-            for activity_id, activity_data in ACTIVITIES.items():
-                # Проверяем, существует ли уже эта активность
-                cursor = await db.execute(
-                    'SELECT 1 FROM activities WHERE id = ?', 
-                    (activity_id,)
-                )
-                exists = await cursor.fetchone()
-                
-                if exists:
-                    # Обновляем существующую
-                    await db.execute('''
-                        UPDATE activities 
-                        SET name = ?, max_slots = ?
-                        WHERE id = ?
-                    ''', (activity_data['name'], activity_data['max_slots'], activity_id))
-                else:
-                    # Добавляем новую
-                    await db.execute('''
-                        INSERT INTO activities (id, name, max_slots)
-                        VALUES (?, ?, ?)
-                    ''', (activity_id, activity_data['name'], activity_data['max_slots']))
-            
-            await db.commit()
+        self.db._apply_promotions(promoted)
+        for request, result in zip(batch, decided):
+            if not request.future.done():
+                request.future.set_result(result)
+
+    async def _commit_batch(self, batch):
+        try:
+            decided = await self.db.backend.reserve_batch(
+                [(request.activity_id, request.user_id) for request in batch]
+            )
+        except StorageBusyError:
+            logger.warning(f"Пачка из {len(batch)} броней не записана: база занята")
+            for request in batch:
+                if not request.future.done():
+                    request.future.set_result(ReserveResult.BUSY)
+            return
+        except Exception as e:
+            logger.exception("Ошибка при записи пачки броней")
+            for request in batch:
+                if not request.future.done():
+                    request.future.set_exception(e)
+            return
+        
+        results = []
+        for request, (result, voted_at) in zip(batch, decided):
+            request.voted_at = voted_at
+            results.append(result)
+        self.db._apply_results(batch, results)
+        for request, result in zip(batch, results):
+            if not request.future.done():
+                request.future.set_result(result)
+
+
+class Database:
+    def __init__(self, db_path: str = None, database_url: str = DATABASE_URL):
+        # Явный путь — SQLite-файл, иначе хранилище выбирается по DATABASE_URL
+        self.backend = SQLiteBackend(db_path) if db_path else create_backend(database_url)
+        self.writer = ReservationWriter(self)
+        # Таблица мест в памяти: id -> ActivitySlots, источник истины для чтений
+        self._slots = {}
+        # Текущий каталог {id: {'name', 'max_slots'}}: при изменении заменяется целиком,
+        # поэтому вызывающий может держать ссылку на снимок и через await
+        self.activities = {}
+        # Версия состояния мест: растет при успешной записи и синхронизации активностей
+        self.slots_version = 0
+        # LRU-кэш состояния пользователей: telegram_id -> UserStatus
+        self._user_cache = OrderedDict()
+        self.user_cache_size = USER_CACHE_SIZE
+        # Взводится, когда кого-то перевели из листа ожидания и его пора уведомить
+        self.promotions_pending = asyncio.Event()
+        # Последняя прочитанная строка журнала cache_invalidations (см. sync_caches)
+        self._invalidation_seq = 0
+        # Число зарегистрированных: считается в базе один раз, затем растет с регистрациями
+        # этого процесса и пересчитывается в sync_caches. None — еще не считали
+        self.total_users = None
+        # События записи для reservation_journal, пишутся пачками в фоне
+        self.journal = ReservationJournal(self)
+    
+    async def init_db(self, activities: dict = None):
+        """Инициализация базы данных.
+
+        activities — каталог из файла (см. catalog.py), без него берется config.ACTIVITIES.
+        """
+        await self.backend.open()
+        
+        await self.backend.migrate()
+        self.writer.start()
+        self.journal.start()
+        
+        # Свои изменения до запуска кэш уже учтет: журнал читаем с текущего конца
+        self._invalidation_seq = await self.backend.last_invalidation()
+        await self.update_activities(activities)
+    
+    async def close(self):
+        """Закрывает соединения с базой данных"""
+        await self.writer.stop()
+        await self.journal.close()
+        await self.backend.close()
+    
+    @timed(DB_METHOD_SECONDS)
+    @traced
+    async def update_activities(self, activities: dict = None):
+        """Приводит активности в базе к каталогу (по умолчанию config.ACTIVITIES).
+
+        Возвращает CatalogDiff. Если каталог нельзя применить (max_slots меньше
+        занятых мест, удаление активности с записанными), бросает CatalogError
+        и ничего не меняет.
+        """
+        if activities is None:
+            activities = dict(ACTIVITIES)
+        result = await self.writer.run(
+            lambda: self.backend.sync_activities(activities),
+            on_commit=self._apply_slots,
+        )
+        return result[2]
+    
+    def _apply_slots(self, result):
+        """Заменяет таблицу мест и каталог в памяти после синхронизации активностей"""
+        rows, promoted, diff, drift = result
+        self._apply_reconcile((rows, promoted, drift))
+    
+    @timed(DB_METHOD_SECONDS)
+    @traced
+    async def reconcile_slots(self):
+        """Сверяет счетчики занятых мест с записями в votes и исправляет расхождения.
+        
+        Возвращает ([(activity_id, было, стало)], [user_id переведенных на освободившиеся места]).
+        """
+        rows, promoted, drift = await self.writer.run(self.backend.reconcile_slots, on_commit=self._apply_reconcile)
+        return drift, [user_id for _, user_id, _ in promoted]
+    
+    def _apply_reconcile(self, result):
+        rows, promoted, drift = result
+        self._replace_slots(rows)
+        for activity_id, old, new in drift:
+            # Активность могла быть удалена той же синхронизацией каталога
+            slot = self._slots.get(activity_id)
+            name = slot.name if slot else str(activity_id)
+            logger.warning(f"Счетчик мест «{name}» (id {activity_id}) разошелся с записями: {old}, а записей {new}")
+            SLOT_REPAIRS.inc(name)
+        for activity_id, user_id, voted_at in promoted:
+            # used_slots в rows уже учитывают переведенных
+            self._cache_user(user_id, UserStatus(True, self._slots[activity_id].name, voted_at))
+        if promoted:
+            self.promotions_pending.set()
+    
+    def _replace_slots(self, rows):
+        """Заменяет таблицу мест строками [(id, name, max_slots, used_slots)] из базы.
+
+        Вызывается писателем сразу после его коммита (или чтения), поэтому
+        кэши, клавиатуры (через slots_version) и каталог activities видят
+        новое состояние разом.
+        """
+        slots = {
+            activity_id: ActivitySlots(activity_id, name, max_slots, used_slots)
+            for activity_id, name, max_slots, used_slots in rows
+        }
+        if slots == self._slots:
+            return
+        if {i: s.name for i, s in slots.items()} != {i: s.name for i, s in self._slots.items()}:
+            # В кэше пользователей лежат названия активностей
+            self._user_cache.clear()
+        self.activities = {
+            activity_id: {"name": slot.name, "max_slots": slot.max_slots}
+            for activity_id, slot in slots.items()
+        }
+        self._slots = slots
+        self.slots_version += 1
     
+    @timed(DB_METHOD_SECONDS)
+    @traced
+    async def sync_caches(self):
+        """Сверяет кэши процесса с базой, которую меняют и другие процессы.
+        
+        Таблица мест заменяется строками из базы, пользователи из журнала
+        cache_invalidations (переведенные из листа ожидания, снятые /unvote)
+        удаляются из кэша, число пользователей пересчитывается. Чтение идет в очереди писателя, поэтому не
+        перетирает более свежие записи этого же процесса. Возвращает число
+        строк журнала, прочитанных за этот раз.
+        """
+        _, invalidations = await self.writer.run(
+            lambda: self.backend.cache_changes(self._invalidation_seq),
+            on_commit=self._apply_cache_changes,
+        )
+        # Регистрации других процессов в журнал не попадают
+        self.total_users = await self.backend.count_users()
+        return len(invalidations)
+    
+    def _apply_cache_changes(self, result):
+        rows, invalidations = result
+        self._replace_slots(rows)
+        for seq, user_id in invalidations:
+            self._user_cache.pop(user_id, None)
+            self._invalidation_seq = seq
+        if invalidations:
+            # Переводы из листа ожидания могли сделать другие процессы
+            self.promotions_pending.set()
+    
+    @timed(DB_METHOD_SECONDS)
+    @traced
+    async def save_cache_position(self, reader: str):
+        """Сохраняет позицию процесса в журнале cache_invalidations (см. prune_cache_invalidations)"""
+        await self.backend.save_cache_position(reader, self._invalidation_seq, time.time())
+    
+    @timed(DB_METHOD_SECONDS)
+    @traced
+    async def prune_cache_invalidations(self, reader_ttl: float = None):
+        """Удаляет строки журнала cache_invalidations, прочитанные всеми живыми процессами.
+        
+        Живые — сохранившие позицию за последние reader_ttl секунд. reader_ttl=None —
+        журнал никто не читает (один процесс, база не разделяется).
+        """
+        seen_after = None if reader_ttl is None else time.time() - reader_ttl
+        await self.backend.prune_invalidations(seen_after)
+    
+    @timed(DB_METHOD_SECONDS)
+    @traced
+    async def claim_primary(self) -> bool:
+        """Берет или подтверждает роль ведущего экземпляра (см. StorageBackend.claim_primary)"""
+        return await self.backend.claim_primary()
+    
+    @property
+    def invalidation_seq(self) -> int:
+        return self._invalidation_seq
+
+    def _apply_promotions(self, promoted):
+        """Учитывает в памяти записи, сделанные из листа ожидания"""
+        for activity_id, user_id, voted_at in promoted:
+            slot = self._slots.get(activity_id)
+            if slot is not None:
+                slot.used_slots += 1
+                self._cache_user(user_id, UserStatus(True, slot.name, voted_at))
+        if promoted:
+            self.slots_version += 1
+            self.promotions_pending.set()
+    
+    def _apply_results(self, batch, results):
+        """Учитывает в памяти закоммиченные записи пачки"""
+        changed = False
+        for request, result in zip(batch, results):
+            slot = self._slots.get(request.activity_id)
+            if slot is not None and result is ReserveResult.SUCCESS:
+                slot.used_slots += 1
+                changed = True
+                self._cache_user(request.user_id, UserStatus(True, slot.name, request.voted_at))
+            elif slot is not None and result is ReserveResult.FULL and not slot.is_full:
+                # Места заняли другие процессы: не ждем sync_caches, чтобы не гонять заявки в базу
+                slot.used_slots = slot.max_slots
+                changed = True
+            elif result is ReserveResult.ALREADY_VOTED:
+                # Запись сделана не через этот кэш (перевод из листа ожидания в другом процессе)
+                self._user_cache.pop(request.user_id, None)
+        if changed:
+            self.slots_version += 1
+    
+    @timed(DB_METHOD_SECONDS)
+    @traced
     async def register_user(self, telegram_id: int, username: str, full_name: str, phone: str = None):
         """Регистрация пользователя"""
-        async with aiosqlite.connect(self.db_path) as db:
-            await db.execute('''
-                INSERT OR REPLACE INTO users (telegram_id, username, full_name, phone)
-                VALUES (?, ?, ?, ?)
-            ''', (telegram_id, username, full_name, phone))
-            await db.commit()
+        created = await self.backend.register_user(telegram_id, username, full_name, phone)
+        if created and self.total_users is not None:
+            self.total_users += 1
+        
+        status = self._user_cache.get(telegram_id)
+        if status is not None:
+            status.registered = True
+        else:
+            self._cache_user(telegram_id, UserStatus(True))
+    
+    def _cache_user(self, telegram_id: int, status: UserStatus):
+        """Кладет состояние пользователя в LRU-кэш"""
+        self._user_cache[telegram_id] = status
+        self._user_cache.move_to_end(telegram_id)
+        if len(self._user_cache) > self.user_cache_size:
+            self._user_cache.popitem(last=False)
+    
+    @timed(DB_METHOD_SECONDS)
+    @traced
+    async def get_user_status(self, telegram_id: int) -> UserStatus:
+        """Регистрация и запись пользователя: из кэша или одним запросом"""
+        return await self._user_status(telegram_id)
     
+    async def _user_status(self, telegram_id: int) -> UserStatus:
+        # Без декораторов: is_user_registered и другие обертки замеряются сами по себе
+        status = self._user_cache.get(telegram_id)
+        if status is not None:
+            self._user_cache.move_to_end(telegram_id)
+            return status
+        
+        row = await self.backend.get_user_status(telegram_id)
+        
+        # Пока шел запрос, регистрация или запись могли уже обновить кэш
+        status = self._user_cache.get(telegram_id)
+        if status is None:
+            status = UserStatus(True, *row) if row else UserStatus(False)
+            self._cache_user(telegram_id, status)
+        return status
+    
+    @timed(DB_METHOD_SECONDS)
+    @traced
     async def is_user_registered(self, telegram_id: int) -> bool:
         """Проверка регистрации пользователя"""
-        async with aiosqlite.connect(self.db_path) as db:
-            cursor = await db.execute(
-                'SELECT 1 FROM users WHERE telegram_id = ?', 
-                (telegram_id,)
-            )
-            return await cursor.fetchone() is not None
+        return (await self._user_status(telegram_id)).registered
     
+    @timed(DB_METHOD_SECONDS)
+    @traced
     async def has_user_voted(self, telegram_id: int) -> bool:
         """Проверяет, голосовал ли уже пользователь"""
-        async with aiosqlite.connect(self.db_path) as db:
-            cursor = await db.execute(
-                'SELECT 1 FROM votes WHERE user_id = ?', 
-                (telegram_id,)
-            )
-            return await cursor.fetchone() is not None
+        return (await self._user_status(telegram_id)).has_voted
     
+    @timed(DB_METHOD_SECONDS)
+    @traced
     async def get_user_vote(self, telegram_id: int):
-        """Получает информацию о голосе пользователя"""
-        async with aiosqlite.connect(self.db_path) as db:
-            cursor = await db.execute('''
-                SELECT a.name, v.voted_at 
-                FROM votes v
-                JOIN activities a ON v.activity_id = a.id
-                WHERE v.user_id = ?
-            ''', (telegram_id,))
-            return await cursor.fetchone()
+        """Получает информацию о голосе пользователя: (название, время) или None"""
+        status = await self._user_status(telegram_id)
+        if not status.has_voted:
+            return None
+        return status.activity_name, status.voted_at
     
+    @timed(DB_METHOD_SECONDS)
+    @traced
     async def get_activities(self):
-        """Получает список всех активностей"""
-        async with aiosqlite.connect(self.db_path) as db:
-            cursor = await db.execute('''
-                SELECT id, name, max_slots, used_slots 
-                FROM activities 
-                ORDER BY id
-            ''')
-            return await cursor.fetchall()
-    
-    async def try_reserve_slot(self, activity_id: int, user_id: int) -> bool:
-        """Пытается забронировать место (с транзакцией)"""
-        async with aiosqlite.connect(self.db_path) as db:
-            # Начинаем транзакцию
-            await db.execute('BEGIN TRANSACTION')
-            
-            try:
-                # Проверяем, не голосовал ли уже пользователь
-                cursor = await db.execute(
-                    'SELECT 1 FROM votes WHERE user_id = ?', 
-                    (user_id,)
-                )
-                if await cursor.fetchone():
-                    await db.execute('ROLLBACK')
-                    return False
-                
-                # Пытаемся занять место
-                cursor = await db.execute('''
-                    UPDATE activities 
-                    SET used_slots = used_slots + 1 
-                    WHERE id = ? AND used_slots < max_slots
-                    RETURNING id
-                ''', (activity_id,))
-                
-                if await cursor.fetchone():
-                    # Если место занято, записываем голос
-                    await db.execute(
-                        'INSERT INTO votes (user_id, activity_id) VALUES (?, ?)',
-                        (user_id, activity_id)
-                    )
-                    await db.execute('COMMIT')
-                    return True
-                else:
-                    await db.execute('ROLLBACK')
-                    return False
-                    
-            except Exception as e:
-                await db.execute('ROLLBACK')
-                print(f"Error in transaction: {e}")
-                return False
+        """Получает список всех активностей (из памяти)"""
+        return [
+            (slot.id, slot.name, slot.max_slots, slot.used_slots)
+            for slot in self._slots.values()
+        ]
+    
+    @timed(DB_METHOD_SECONDS)
+    @traced
+    async def try_reserve_slot(self, activity_id: int, user_id: int) -> ReserveResult:
+        """Пытается забронировать место: сначала в памяти, затем через писателя"""
+        slot = self._slots.get(activity_id)
+        if slot is None:
+            RESERVATIONS.inc(ReserveResult.NOT_FOUND.value)
+            return ReserveResult.NOT_FOUND
+        if slot.is_full:
+            result = ReserveResult.FULL
+        else:
+            # Окончательное решение принимает писатель по данным в базе
+            result = await self.writer.reserve(activity_id, user_id)
+        RESERVATIONS.inc(result.value)
+        if result is not ReserveResult.SUCCESS:
+            # Успешную бронь хранилище записало в журнал в ее же транзакции
+            self.journal.record("reserve", activity_id, user_id, result.value)
+        return result
+    
+    @timed(DB_METHOD_SECONDS)
+    @traced
+    async def join_waitlist(self, activity_id: int, user_id: int):
+        """Ставит пользователя в лист ожидания активности.
+        
+        Возвращает (WaitlistResult, место в очереди или None). Если место
+        уже освободилось, пользователь сразу записывается (PROMOTED), а если
+        активность убрали из каталога — NOT_FOUND.
+        """
+        if activity_id not in self._slots:
+            return WaitlistResult.NOT_FOUND, None
+        result, place = await self.writer.join_waitlist(activity_id, user_id)
+        self.journal.record("waitlist", activity_id, user_id, result.value)
+        return result, place
+    
+    @timed(DB_METHOD_SECONDS)
+    @traced
+    async def leave_waitlist(self, user_id: int) -> bool:
+        """Убирает пользователя из листа ожидания"""
+        return await self.backend.leave_waitlist(user_id)
+    
+    @timed(DB_METHOD_SECONDS)
+    @traced
+    async def get_waitlist_place(self, user_id: int):
+        """(название активности, место в очереди) или None"""
+        row = await self.backend.waitlist_place(user_id)
+        if row is None:
+            return None
+        activity_id, place = row
+        slot = self._slots.get(activity_id)
+        return (slot.name if slot else str(activity_id)), place
+    
+    @timed(DB_METHOD_SECONDS)
+    @traced
+    async def get_waitlist_counts(self) -> dict:
+        """{activity_id: число ожидающих}"""
+        return dict(await self.backend.waitlist_counts())
+    
+    @timed(DB_METHOD_SECONDS)
+    @traced
+    async def remove_vote(self, user_id: int):
+        """Удаляет запись пользователя; освободившееся место получает первый в очереди.
+        
+        Возвращает (activity_id или None, если записи не было, [user_id переведенных]).
+        """
+        activity_id, promoted = await self.writer.run(
+            lambda: self.backend.remove_vote(user_id),
+            on_commit=lambda result: self._apply_removal(user_id, *result),
+        )
+        return activity_id, [promoted_user for _, promoted_user, _ in promoted]
+    
+    def _apply_removal(self, user_id: int, activity_id: int, promoted):
+        """Учитывает в памяти удаленную запись и переведенных на ее место"""
+        if activity_id is None:
+            return
+        slot = self._slots.get(activity_id)
+        if slot is not None:
+            slot.used_slots = max(0, slot.used_slots - 1)
+        self._cache_user(user_id, UserStatus(True))
+        self.slots_version += 1
+        self._apply_promotions(promoted)
+    
+    @timed(DB_METHOD_SECONDS)
+    @traced
+    async def get_pending_promotions(self, limit: int):
+        """[(user_id, activity_id)] переведенных из листа ожидания, которых еще не уведомили"""
+        return await self.backend.pending_promotions(limit)
+    
+    @timed(DB_METHOD_SECONDS)
+    @traced
+    async def mark_promotions_notified(self, user_ids):
+        """Снимает переведенных с уведомления"""
+        await self.backend.mark_promotions_notified(list(user_ids))
+    
+    @timed(DB_METHOD_SECONDS)
+    @traced
+    async def load_fsm_state(self, key: str):
+        """(state, data в JSON) состояния FSM или None"""
+        return await self.backend.load_fsm_state(key)
+    
+    @timed(DB_METHOD_SECONDS)
+    @traced
+    async def save_fsm_states(self, rows):
+        """Записывает пачку состояний FSM [(key, state, data в JSON)]"""
+        await self.backend.save_fsm_states(list(rows))
+    
+    @timed(DB_METHOD_SECONDS)
+    @traced
+    async def append_journal(self, rows):
+        """Дописывает пачку событий [(at, event, activity_id, user_id, result, detail)] в журнал"""
+        await self.backend.append_journal(list(rows))
     
+    @timed(DB_METHOD_SECONDS)
+    @traced
+    async def read_journal(self, after_seq: int, limit: int):
+        """До limit [(seq, at, event, activity_id, user_id, result, detail)] журнала после after_seq"""
+        return await self.backend.journal_since(after_seq, limit)
+    
+    @timed(DB_METHOD_SECONDS)
+    @traced
+    async def read_journal_before(self, before_seq: int, limit: int):
+        """До limit строк журнала с seq не больше before_seq, от новых к старым"""
+        return await self.backend.journal_before(before_seq, limit)
+    
+    @timed(DB_METHOD_SECONDS)
+    @traced
+    async def load_journal_snapshot(self):
+        """Сохраненная сводка журнала [(kind, key, value)]"""
+        return await self.backend.journal_snapshot()
+    
+    @timed(DB_METHOD_SECONDS)
+    @traced
+    async def save_journal_snapshot(self, offset: int, rows):
+        """Сохраняет сводку журнала, посчитанную до seq offset. False — в базе сводка новее"""
+        return await self.backend.save_journal_snapshot(offset, list(rows))
+    
+    @timed(DB_METHOD_SECONDS)
+    @traced
     async def get_statistics(self):
-        """Получает статистику по всем активностям"""
-        async with aiosqlite.connect(self.db_path) as db:
-            cursor = await db.execute('''
-                SELECT name, used_slots, max_slots,
-                       CASE WHEN used_slots >= max_slots THEN 1 ELSE 0 END as is_full
-                FROM activities 
-                ORDER BY id
-            ''')
-            return await cursor.fetchall()
+        """Получает статистику по всем активностям (из памяти)"""
+        return self.slot_fill()
+    
+    def slot_fill(self):
+        """(название, занято, всего, заполнена ли) по активностям — синхронно, для метрик"""
+        return [
+            (slot.name, slot.used_slots, slot.max_slots, 1 if slot.used_slots >= slot.max_slots else 0)
+            for slot in self._slots.values()
+        ]
     
+    @timed(DB_METHOD_SECONDS)
+    @traced
     async def get_total_users(self):
-        """Получает общее количество пользователей"""
-        async with aiosqlite.connect(self.db_path) as db:
-            cursor = await db.execute('SELECT COUNT(*) FROM users')
-            result = await cursor.fetchone()
-            return result[0] if result else 0
+        """Общее количество пользователей (из памяти, кроме первого вызова)"""
+        if self.total_users is None:
+            self.total_users = await self.backend.count_users()
+        return self.total_users
 
+    @timed(DB_METHOD_SECONDS)
+    @traced
     async def get_all_users(self):
         """Получает всех зарегистрированных пользователей"""
-        async with aiosqlite.connect(self.db_path) as db:
-            cursor = await db.execute('''
-                SELECT telegram_id, username, full_name, phone, registered_at 
-                FROM users 
-                ORDER BY registered_at
-            ''')
-            return await cursor.fetchall()
+        return [row async for row in self.iter_all_users()]
+
+    def iter_all_users(self, chunk_size: int = EXPORT_CHUNK_SIZE):
+        """Асинхронный итератор по всем зарегистрированным пользователям"""
+        return self.backend.iter_all_users(chunk_size)
 
+    @timed(DB_METHOD_SECONDS)
+    @traced
+    async def get_users_page(self, direction: str = "first", cursor=None, query: str = None,
+                             limit: int = USERS_PAGE_SIZE):
+        """Страница пользователей с keyset-пагинацией по (registered_at, telegram_id).
+        
+        direction: first, last, next (после cursor) или prev (до cursor),
+        cursor — (registered_at, telegram_id) крайней строки текущей страницы,
+        query — префикс имени, username или телефона.
+        Возвращает (строки по возрастанию, есть ли еще строки в направлении движения).
+        """
+        rows = list(await self.backend.users_page(direction, cursor, query, limit))
+        
+        has_more = len(rows) > limit
+        rows = rows[:limit]
+        if direction in ("prev", "last"):
+            rows.reverse()
+        return rows, has_more
+
+    @timed(DB_METHOD_SECONDS)
+    @traced
     async def get_votes_details(self):
         """Получает детальную информацию о всех записях"""
-        async with aiosqlite.connect(self.db_path) as db:
-            cursor = await db.execute('''
-                SELECT 
-                    u.telegram_id,
-                    u.username,
-                    u.full_name,
-                    u.phone,
-                    a.name as activity_name,
-                    v.voted_at
-                FROM votes v
-                JOIN users u ON v.user_id = u.telegram_id
-                JOIN activities a ON v.activity_id = a.id
-                ORDER BY v.voted_at
-            ''')
-            return await cursor.fetchall()
+        return [row async for row in self.iter_votes_details()]
+
+    def iter_votes_details(self, chunk_size: int = EXPORT_CHUNK_SIZE):
+        """Асинхронный итератор по всем записям"""
+        return self.backend.iter_votes_details(chunk_size)
 
+    @timed(DB_METHOD_SECONDS)
+    @traced
     async def get_activity_participants(self, activity_id: int):
         """Получает участников конкретной активности"""
-        async with aiosqlite.connect(self.db_path) as db:
-            cursor = await db.execute('''
-                SELECT 
-                    u.telegram_id,
-                    u.username,
-                    u.full_name,
-                    u.phone,
-                    v.voted_at
-                FROM votes v
-                JOIN users u ON v.user_id = u.telegram_id
-                WHERE v.activity_id = ?
-                ORDER BY v.voted_at
-            ''', (activity_id,))
-            return await cursor.fetchall()
+        return [row async for row in self.iter_activity_participants(activity_id)]
+
+    def iter_activity_participants(self, activity_id: int, chunk_size: int = EXPORT_CHUNK_SIZE):
+        """Асинхронный итератор по участникам конкретной активности"""
+        return self.backend.iter_activity_participants(activity_id, chunk_size)
+
+    def iter_roster(self, chunk_size: int = EXPORT_CHUNK_SIZE):
+        """Асинхронный итератор по спискам всех активностей одним запросом (см. StorageBackend.iter_roster)"""
+        return self.backend.iter_roster(chunk_size)
+
+    def iter_users_without_vote(self, chunk_size: int = EXPORT_CHUNK_SIZE):
+        """Асинхронный итератор по зарегистрированным пользователям без записи"""
+        return self.backend.iter_users_without_vote(chunk_size)
+
+    @timed(DB_METHOD_SECONDS)
+    @traced
+    async def create_broadcast(self, admin_id: int, target: str, text: str, chat_ids) -> int:
+        """Сохраняет рассылку и ее получателей, возвращает id рассылки"""
+        return await self.backend.create_broadcast(admin_id, target, text, list(chat_ids))
+
+    @timed(DB_METHOD_SECONDS)
+    @traced
+    async def get_unfinished_broadcasts(self):
+        """Незавершенные рассылки: [(id, admin_id, target, text)]"""
+        return await self.backend.unfinished_broadcasts()
+
+    @timed(DB_METHOD_SECONDS)
+    @traced
+    async def get_pending_recipients(self, broadcast_id: int, limit: int):
+        """Следующие chat_id, которым рассылка еще не отправлена"""
+        return await self.backend.pending_recipients(broadcast_id, limit)
+
+    @timed(DB_METHOD_SECONDS)
+    @traced
+    async def mark_broadcast_recipients(self, broadcast_id: int, results):
+        """Сохраняет результаты отправки [(chat_id, статус)]"""
+        await self.backend.mark_recipients(broadcast_id, list(results))
+
+    @timed(DB_METHOD_SECONDS)
+    @traced
+    async def get_broadcast_progress(self, broadcast_id: int) -> dict:
+        """{'pending' | 'sent' | 'failed': число получателей}"""
+        return await self.backend.broadcast_progress(broadcast_id)
+
+    @timed(DB_METHOD_SECONDS)
+    @traced
+    async def finish_broadcast(self, broadcast_id: int):
+        """Отмечает рассылку завершенной"""
+        await self.backend.finish_broadcast(broadcast_id)
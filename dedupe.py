@@ -0,0 +1,86 @@
+"""Повторные нажатия кнопок записи на активность.
+
+На медленной связи пользователь жмет vote_<id> несколько раз подряд, и
+каждое нажатие приходит отдельным апдейтом. VoteDeduplicator выполняет
+запись пользователя в один поток: пока его запись идет, повторные нажатия
+той же активности дожидаются ее итога, а не начинают свою транзакцию.
+Итог хранится VOTE_OUTCOME_TTL секунд, и нажатия после записи получают
+его без обращения к базе. Нажатие другой активности ждет текущую запись
+и выполняется как обычно.
+"""
+import asyncio
+import time
+from collections import OrderedDict
+
+from config import USER_CACHE_SIZE, VOTE_OUTCOME_TTL
+
+
+class VoteDeduplicator:
+    """Запись в один поток на пользователя и кэш ее итогов"""
+
+    def __init__(self, ttl: float = VOTE_OUTCOME_TTL, max_entries: int = USER_CACHE_SIZE, is_final=None):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        # Временные итоги (база занята) не кэшируются: следующее нажатие пробует снова
+        self.is_final = is_final or (lambda outcome: True)
+        self._in_flight = {}  # user_id -> (activity_id, future с итогом или None при ошибке)
+        self._outcomes = OrderedDict()  # user_id -> (activity_id, итог, time.monotonic() истечения)
+        # Счетчики для админ-панели
+        self.joined = 0
+        self.cached = 0
+
+    def _cached(self, user_id: int, activity_id: int):
+        entry = self._outcomes.get(user_id)
+        if entry is None:
+            return None
+        cached_activity, outcome, expires = entry
+        if expires <= time.monotonic():
+            del self._outcomes[user_id]
+            return None
+        return outcome if cached_activity == activity_id else None
+
+    def _remember(self, user_id: int, activity_id: int, outcome):
+        self._outcomes[user_id] = (activity_id, outcome, time.monotonic() + self.ttl)
+        self._outcomes.move_to_end(user_id)
+        if len(self._outcomes) > self.max_entries:
+            self._outcomes.popitem(last=False)
+
+    def forget(self, user_id: int):
+        """Сбрасывает итог пользователя (например, после удаления его записи админом)"""
+        self._outcomes.pop(user_id, None)
+
+    async def run(self, user_id: int, activity_id: int, reserve) -> tuple:
+        """Итог записи и признак повторного нажатия: (итог, repeated).
+
+        reserve() — корутина записи, вызывается, только если у пользователя
+        нет ни идущей записи, ни свежего итога для этой активности.
+        """
+        while True:
+            outcome = self._cached(user_id, activity_id)
+            if outcome is not None:
+                self.cached += 1
+                return outcome, True
+
+            flight = self._in_flight.get(user_id)
+            if flight is None:
+                break
+            flight_activity, future = flight
+            # shield: отмена этого апдейта не должна отменять чужую запись
+            outcome = await asyncio.shield(future)
+            if flight_activity == activity_id and outcome is not None:
+                self.joined += 1
+                return outcome, True
+            # Другая активность или первая запись не удалась — проверяем заново
+
+        future = asyncio.get_running_loop().create_future()
+        self._in_flight[user_id] = (activity_id, future)
+        outcome = None
+        try:
+            outcome = await reserve()
+        finally:
+            del self._in_flight[user_id]
+            # При исключении ждущие получают None и пробуют записаться сами
+            future.set_result(outcome)
+        if self.ttl and self.is_final(outcome):
+            self._remember(user_id, activity_id, outcome)
+        return outcome, False
@@ -0,0 +1,155 @@
+import csv
+import gzip
+import html
+import io
+import tempfile
+from datetime import datetime
+
+from aiogram.types.input_file import DEFAULT_CHUNK_SIZE, InputFile
+
+from config import EXPORT_SPOOL_MAX_BYTES
+
+VOTES_CSV_HEADER = ['ID', 'Username', 'ФИО', 'Телефон', 'Активность', 'Дата записи']
+
+ROSTER_HTML_HEAD = '''<!DOCTYPE html>
+<html lang="ru">
+<head>
+<meta charset="utf-8">
+<title>{title}</title>
+<style>
+body {{ font-family: sans-serif; font-size: 11pt; }}
+section + section {{ page-break-before: always; }}
+table {{ border-collapse: collapse; width: 100%; }}
+th, td {{ border: 1px solid #999; padding: 2px 6px; text-align: left; }}
+</style>
+</head>
+<body>
+<h1>{title}</h1>
+'''
+ROSTER_TABLE_HEAD = '<table>\n<tr><th>№</th><th>ФИО</th><th>Username</th><th>Телефон</th><th>Дата записи</th><th>ID</th></tr>\n'
+
+
+class SpooledInputFile(InputFile):
+    """Файл для отправки в Telegram, читается кусками из временного файла"""
+
+    def __init__(self, file, filename: str, chunk_size: int = DEFAULT_CHUNK_SIZE):
+        super().__init__(filename=filename, chunk_size=chunk_size)
+        self.file = file
+
+    async def read(self, bot):
+        self.file.seek(0)
+        while chunk := self.file.read(self.chunk_size):
+            yield chunk
+
+    def close(self):
+        self.file.close()
+
+
+async def write_csv(rows, header, compress: bool = False):
+    """Пишет строки асинхронного итератора в CSV во временный файл.
+
+    Файл держится в памяти до EXPORT_SPOOL_MAX_BYTES, дальше уходит на диск.
+    Возвращает (файл, число строк).
+    """
+    spool = tempfile.SpooledTemporaryFile(max_size=EXPORT_SPOOL_MAX_BYTES)
+    raw = gzip.GzipFile(fileobj=spool, mode='wb') if compress else spool
+    text = io.TextIOWrapper(raw, encoding='utf-8', newline='')
+    writer = csv.writer(text)
+    writer.writerow(header)
+    
+    count = 0
+    async for row in rows:
+        writer.writerow(row)
+        count += 1
+    
+    text.flush()
+    text.detach()  # не закрываем spool вместе с оберткой
+    if compress:
+        raw.close()
+    return spool, count
+
+
+async def write_roster_html(rows, title: str):
+    """Пишет списки участников в один HTML-документ для печати во временный файл.
+
+    rows — строки iter_roster: активности по порядку, участники внутри по
+    времени записи. Каждая активность — раздел с таблицей и числом
+    записавшихся, раздел пишется по мере чтения строк. Возвращает
+    (файл, число активностей, число участников).
+    """
+    spool = tempfile.SpooledTemporaryFile(max_size=EXPORT_SPOOL_MAX_BYTES)
+    text = io.TextIOWrapper(spool, encoding='utf-8', newline='')
+    text.write(ROSTER_HTML_HEAD.format(title=html.escape(title)))
+    
+    def end_section(count, max_slots):
+        if count:
+            text.write('</table>\n')
+        else:
+            text.write('<p>Нет записавшихся участников</p>\n')
+        text.write(f'<p><b>Записано:</b> {count} из {max_slots}</p>\n</section>\n')
+    
+    current = section_slots = None
+    activities = total = count = 0
+    async for activity_id, name, max_slots, user_id, username, full_name, phone, voted_at in rows:
+        if activity_id != current:
+            if current is not None:
+                end_section(count, section_slots)
+            current, section_slots, count = activity_id, max_slots, 0
+            activities += 1
+            text.write(f'<section>\n<h2>{html.escape(name)}</h2>\n')
+        if user_id is None:
+            continue
+        if not count:
+            text.write(ROSTER_TABLE_HEAD)
+        count += 1
+        total += 1
+        cells = (count, full_name, f'@{username}' if username else '', phone or '', voted_at, user_id)
+        text.write('<tr>' + ''.join(f'<td>{html.escape(str(cell))}</td>' for cell in cells) + '</tr>\n')
+    if current is not None:
+        end_section(count, section_slots)
+    
+    text.write(f'<p><b>Всего:</b> {total} участников в {activities} активностях</p>\n</body>\n</html>\n')
+    text.flush()
+    text.detach()  # не закрываем spool вместе с оберткой
+    return spool, activities, total
+
+
+async def _vote_rows(db):
+    async for user_id, username, full_name, phone, activity_name, voted_at in db.iter_votes_details():
+        yield [user_id, username or '', full_name, phone or '', activity_name, voted_at]
+
+
+async def _participant_rows(db, activity_id: int, activity_name: str):
+    async for user_id, username, full_name, phone, voted_at in db.iter_activity_participants(activity_id):
+        yield [user_id, username or '', full_name, phone or '', activity_name, voted_at]
+
+
+async def export_votes(db, compress: bool = False, split: bool = False):
+    """Выгружает записи в CSV.
+
+    Отдает (SpooledInputFile, число строк, название) по одному файлу на все
+    записи или, при split, по файлу на каждую активность.
+    """
+    stamp = datetime.now().strftime('%Y-%m-%d_%H-%M')
+    suffix = '.csv.gz' if compress else '.csv'
+    
+    if not split:
+        spool, count = await write_csv(_vote_rows(db), VOTES_CSV_HEADER, compress)
+        yield SpooledInputFile(spool, f"activities_export_{stamp}{suffix}"), count, "Все активности"
+        return
+    
+    for activity_id, name, max_slots, used_slots in await db.get_activities():
+        spool, count = await write_csv(_participant_rows(db, activity_id, name), VOTES_CSV_HEADER, compress)
+        yield SpooledInputFile(spool, f"activity_{activity_id}_{stamp}{suffix}"), count, name
+
+
+async def export_roster(db):
+    """Списки участников всех активностей одним документом из одного запроса.
+
+    Возвращает (SpooledInputFile, число активностей, число участников).
+    """
+    now = datetime.now()
+    spool, activities, total = await write_roster_html(
+        db.iter_roster(), f"Списки участников на {now.strftime('%d.%m.%Y %H:%M')}"
+    )
+    return SpooledInputFile(spool, f"roster_{now.strftime('%Y-%m-%d_%H-%M')}.html"), activities, total
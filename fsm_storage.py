@@ -0,0 +1,124 @@
+"""Хранилище состояний FSM aiogram в базе бота.
+
+Состояния и данные FSM переживают перезапуск: пользователь, который
+остановился на середине регистрации, продолжит с того же шага.
+Чтения идут из кэша в памяти процесса (в базу — только при первом
+обращении к ключу), записи только меняют кэш и помечают ключ; фоновая
+задача раз в FSM_FLUSH_INTERVAL секунд пишет все помеченные ключи одной
+транзакцией. close() дописывает оставшееся, поэтому при штатной остановке
+ничего не теряется, при аварийной — изменения последнего интервала.
+"""
+import asyncio
+import json
+import logging
+from collections import OrderedDict
+from dataclasses import dataclass, field
+
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, DefaultKeyBuilder, StorageKey
+
+from config import FSM_FLUSH_INTERVAL, USER_CACHE_SIZE
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class FSMRecord:
+    state: str = None
+    data: dict = field(default_factory=dict)
+
+
+class DatabaseStorage(BaseStorage):
+    """FSM-хранилище aiogram поверх Database с отложенной записью"""
+
+    def __init__(self, db, flush_interval: float = FSM_FLUSH_INTERVAL, cache_size: int = USER_CACHE_SIZE):
+        self.db = db
+        self.flush_interval = flush_interval
+        self.cache_size = cache_size
+        self.key_builder = DefaultKeyBuilder(with_bot_id=True, with_business_connection_id=True, with_destiny=True)
+        self._cache = OrderedDict()  # строковый ключ -> FSMRecord
+        self._dirty = set()
+        self._flush_lock = asyncio.Lock()
+        self._task = None
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def close(self):
+        """Останавливает фоновую запись и дописывает изменения. Можно вызывать повторно"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except Exception:
+                logger.exception("Ошибка при записи состояний FSM")
+
+    async def flush(self):
+        """Пишет в базу все измененные с прошлой записи состояния"""
+        async with self._flush_lock:
+            if not self._dirty:
+                return
+            keys, self._dirty = self._dirty, set()
+            # Снимок берем до записи: изменения во время нее попадут в следующую
+            rows = [(key, self._cache[key].state, json.dumps(self._cache[key].data, ensure_ascii=False))
+                    for key in keys]
+            try:
+                await self.db.save_fsm_states(rows)
+            except BaseException:
+                self._dirty |= keys
+                raise
+            self._evict()
+
+    def _evict(self, keep: str = None):
+        """Вытесняет давно не использованные записи, которые уже лежат в базе (кроме keep)"""
+        while len(self._cache) > self.cache_size:
+            for key in self._cache:
+                if key not in self._dirty and key != keep:
+                    del self._cache[key]
+                    break
+            else:
+                return
+
+    async def _record(self, key: StorageKey) -> tuple:
+        """(строковый ключ, FSMRecord) из кэша или из базы"""
+        cache_key = self.key_builder.build(key)
+        record = self._cache.get(cache_key)
+        if record is not None:
+            self._cache.move_to_end(cache_key)
+            return cache_key, record
+
+        row = await self.db.load_fsm_state(cache_key)
+        # Пока шел запрос, запись могла уже появиться в кэше
+        record = self._cache.get(cache_key)
+        if record is None:
+            record = FSMRecord(row[0], json.loads(row[1])) if row else FSMRecord()
+            self._cache[cache_key] = record
+            self._evict(keep=cache_key)
+        return cache_key, record
+
+    async def set_state(self, key: StorageKey, state=None):
+        cache_key, record = await self._record(key)
+        record.state = state.state if isinstance(state, State) else state
+        self._dirty.add(cache_key)
+
+    async def get_state(self, key: StorageKey):
+        return (await self._record(key))[1].state
+
+    async def set_data(self, key: StorageKey, data: dict):
+        cache_key, record = await self._record(key)
+        record.data = data.copy()
+        self._dirty.add(cache_key)
+
+    async def get_data(self, key: StorageKey) -> dict:
+        return (await self._record(key))[1].data.copy()
@@ -0,0 +1,269 @@
+"""Журнал попыток записи на активность и сверка счетчиков мест.
+
+used_slots в activities — денормализованный счетчик: его меняют бронь,
+перевод из листа ожидания и удаление записи, и ошибка в любом из этих путей
+(или ручная правка базы) молча расходит его с таблицей votes.
+
+Записи и снятия записей (reserve с итогом success, promote, unvote, repair)
+хранилище пишет в reservation_journal в той же транзакции, что и саму
+перемену, поэтому журнал не теряет их и при аварии. Неудачные попытки
+ReservationJournal копит в памяти и раз в JOURNAL_FLUSH_INTERVAL секунд
+дописывает одной транзакцией, в стороне от пачек броней; при аварийной
+остановке теряются только они. Строки журнала только добавляются.
+
+JournalStats читает журнал с последнего прочитанного seq и досчитывает по
+новым строкам сводку записей и итоги попыток — таблицу votes для статистики
+не пересчитываем. Сводку вместе с seq, до которого она посчитана, процессы
+сохраняют в journal_snapshot: после перезапуска журнал дочитывается с этого
+места, а не с начала.
+
+SlotReconciler раз в RECONCILE_INTERVAL секунд сверяет used_slots с
+COUNT(*) по votes, исправляет расхождения и пишет исправления в журнал:
+по строке repair сводка активности начинается заново с числа записей в votes.
+"""
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+
+from config import (
+    JOURNAL_FLUSH_INTERVAL, JOURNAL_READ_CHUNK, JOURNAL_STATS_INTERVAL, RECENT_SIGNUPS_MINUTES, RECONCILE_INTERVAL,
+)
+
+logger = logging.getLogger(__name__)
+
+
+class ReservationJournal:
+    """Буфер неудачных попыток записи с отложенной записью в reservation_journal"""
+
+    def __init__(self, db, flush_interval: float = JOURNAL_FLUSH_INTERVAL):
+        self.db = db
+        self.flush_interval = flush_interval
+        self._rows = []  # (at, event, activity_id, user_id, result, detail)
+        self._flush_lock = asyncio.Lock()
+        self._task = None
+        # Счетчик для наблюдения
+        self.written = 0
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def close(self):
+        """Останавливает фоновую запись и дописывает буфер. Можно вызывать повторно"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+
+    def record(self, event: str, activity_id: int, user_id: int, result: str, detail: str = None):
+        """Добавляет событие в буфер, в базу оно попадет со следующей записью"""
+        self._rows.append((time.time(), event, activity_id, user_id, result, detail))
+
+    @property
+    def pending(self) -> int:
+        return len(self._rows)
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except Exception:
+                logger.exception("Ошибка при записи журнала попыток записи")
+
+    async def flush(self):
+        """Пишет в базу все накопленные события"""
+        async with self._flush_lock:
+            if not self._rows:
+                return
+            rows, self._rows = self._rows, []
+            try:
+                await self.db.append_journal(rows)
+            except BaseException:
+                # Новые события встают после несохраненных: порядок в журнале не меняется
+                self._rows[:0] = rows
+                raise
+            self.written += len(rows)
+
+
+class JournalStats:
+    """Сводка записей и итоги попыток, которые досчитываются по новым строкам журнала"""
+
+    def __init__(self, db, interval: float = JOURNAL_STATS_INTERVAL,
+                 recent_minutes: int = RECENT_SIGNUPS_MINUTES, chunk_size: int = JOURNAL_READ_CHUNK):
+        self.db = db
+        self.interval = interval
+        self.recent_minutes = recent_minutes
+        self.chunk_size = chunk_size
+        self.offset = 0  # последний учтенный seq
+        self.votes = {}  # activity_id -> записей
+        self.attempts = {}  # (event, result) -> число попыток записи и в лист ожидания
+        self.repairs = 0
+        self._recent = OrderedDict()  # user_id -> (at, activity_id) записавшихся за окно
+        self._loaded = False
+        self._saved_offset = 0
+        self._lock = asyncio.Lock()
+        self._task = None
+
+    def start(self):
+        if self._task is None and self.interval:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.catch_up()
+            except Exception:
+                logger.exception("Ошибка при чтении журнала попыток записи")
+
+    async def catch_up(self) -> int:
+        """Учитывает строки журнала после offset и сохраняет сводку. Возвращает число строк"""
+        async with self._lock:
+            if not self._loaded:
+                await self._load()
+                self._loaded = True
+            total = 0
+            while True:
+                rows = await self.db.read_journal(self.offset, self.chunk_size)
+                for row in rows:
+                    self._apply(*row)
+                total += len(rows)
+                if len(rows) < self.chunk_size:
+                    break
+            if self.offset > self._saved_offset:
+                try:
+                    await self.db.save_journal_snapshot(self.offset, self._snapshot_rows())
+                    self._saved_offset = self.offset
+                except Exception:
+                    # Сводка в памяти верна, сохраним ее в следующий раз
+                    logger.exception("Ошибка при сохранении сводки журнала")
+            return total
+
+    async def _load(self):
+        """Берет сохраненную сводку, а окно недавних записей — из хвоста журнала до ее offset"""
+        for kind, key, value in await self.db.load_journal_snapshot():
+            if kind == "offset":
+                self.offset = value
+            elif kind == "votes":
+                self.votes[int(key)] = value
+            elif kind == "attempts":
+                self.attempts[tuple(key.split(":", 1))] = value
+            elif kind == "repairs":
+                self.repairs = value
+        self._saved_offset = self.offset
+
+        cutoff = time.time() - self.recent_minutes * 60
+        tail = []
+        before = self.offset
+        while before > 0:
+            rows = await self.db.read_journal_before(before, self.chunk_size)
+            tail += rows
+            if len(rows) < self.chunk_size or rows[-1][1] < cutoff:
+                break
+            before = rows[-1][0] - 1
+        for seq, at, event, activity_id, user_id, result, detail in reversed(tail):
+            self._apply_recent(at, event, activity_id, user_id, result)
+
+    def _snapshot_rows(self) -> list:
+        """Сводка строками (kind, key, value) для journal_snapshot"""
+        return [
+            *(("votes", str(activity_id), count) for activity_id, count in self.votes.items()),
+            *(("attempts", f"{event}:{result}", count) for (event, result), count in self.attempts.items()),
+            ("repairs", "", self.repairs),
+        ]
+
+    def _apply(self, seq: int, at: float, event: str, activity_id: int, user_id: int, result: str, detail: str):
+        self.offset = seq
+        if event in ("reserve", "waitlist"):
+            self.attempts[(event, result)] = self.attempts.get((event, result), 0) + 1
+        if (event in ("reserve", "import") and result == "success") or event == "promote":
+            self.votes[activity_id] = self.votes.get(activity_id, 0) + 1
+        elif event == "unvote":
+            self.votes[activity_id] = self.votes.get(activity_id, 0) - 1
+        elif event == "repair":
+            # detail «было -> стало»: строка записана в транзакции исправления, и в этой
+            # точке журнала записей на активность ровно «стало» — в том числе сделанных мимо бота
+            self.votes[activity_id] = int(detail.split(" -> ")[1])
+            self.repairs += 1
+        self._apply_recent(at, event, activity_id, user_id, result)
+
+    def _apply_recent(self, at: float, event: str, activity_id: int, user_id: int, result: str):
+        if (event in ("reserve", "import") and result == "success") or event == "promote":
+            self._recent[user_id] = (at, activity_id)
+            self._recent.move_to_end(user_id)
+        elif event == "unvote":
+            self._recent.pop(user_id, None)
+
+    async def vote_summary(self) -> dict:
+        """{activity_id: (всего записей, записей за последние recent_minutes минут)}"""
+        await self.catch_up()
+        cutoff = time.time() - self.recent_minutes * 60
+        # Журнал пишут несколько процессов, поэтому время в нем растет лишь примерно
+        while self._recent and next(iter(self._recent.values()))[0] < cutoff:
+            self._recent.popitem(last=False)
+        recent = {}
+        for at, activity_id in self._recent.values():
+            if at >= cutoff:
+                recent[activity_id] = recent.get(activity_id, 0) + 1
+        # Записи, удаленные мимо бота, могли остаться в окне после сверки
+        return {
+            activity_id: (count, min(count, recent.get(activity_id, 0)))
+            for activity_id, count in self.votes.items() if count
+        }
+
+
+class SlotReconciler:
+    """Фоновая сверка счетчиков used_slots с таблицей votes (см. Database.reconcile_slots)"""
+
+    def __init__(self, db, interval: float = RECONCILE_INTERVAL):
+        self.db = db
+        self.interval = interval
+        self._task = None
+        # Счетчики для админ-панели
+        self.runs = 0
+        self.repaired = 0
+
+    def start(self):
+        if self._task is None and self.interval:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.reconcile()
+            except Exception:
+                logger.exception("Ошибка при сверке счетчиков мест")
+
+    async def reconcile(self) -> tuple:
+        """Одна сверка. Возвращает ([(activity_id, было, стало)], [user_id переведенных])"""
+        drift, promoted = await self.db.reconcile_slots()
+        self.runs += 1
+        self.repaired += len(drift)
+        return drift, promoted
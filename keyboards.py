@@ -1,6 +1,6 @@
 from aiogram.types import ReplyKeyboardMarkup, KeyboardButton, InlineKeyboardMarkup, InlineKeyboardButton
 from aiogram.utils.keyboard import InlineKeyboardBuilder
-from database import Database
+from render import render_cache
 
 def get_main_keyboard():
     """Основная клавиатура"""
@@ -23,9 +23,16 @@ def get_registration_keyboard():
         resize_keyboard=True
     )
 
-async def create_activities_keyboard():
+async def create_activities_keyboard(db):
+    """Инлайн-клавиатура с активностями (из кэша, пока места не менялись)"""
+    version = db.slots_version
+    markup = render_cache.get("activities_keyboard", version)
+    if markup is None:
+        markup = render_cache.put("activities_keyboard", version, await build_activities_keyboard(db))
+    return markup
+
+async def build_activities_keyboard(db):
     """Создает инлайн-клавиатуру с активностями"""
-    db = Database()
     activities = await db.get_activities()
     
     builder = InlineKeyboardBuilder()
@@ -36,7 +43,8 @@ async def create_activities_keyboard():
         slots_text = f"({used_slots}/{max_slots})"
         
         button_text = f"{emoji} {name} {slots_text}"
-        callback_data = f"vote_{activity_id}" if not is_full else "full"
+        # Нажатие на заполненную активность ставит в лист ожидания
+        callback_data = f"vote_{activity_id}" if not is_full else f"full_{activity_id}"
         
         if not is_full:
             builder.add(InlineKeyboardButton(
@@ -45,8 +53,8 @@ async def create_activities_keyboard():
             ))
         else:
             builder.add(InlineKeyboardButton(
-                text=button_text,
-                callback_data="full"
+                text=f"{button_text} · в лист ожидания",
+                callback_data=callback_data
             ))
     
     builder.add(InlineKeyboardButton(
@@ -56,3 +64,44 @@ async def create_activities_keyboard():
     
     builder.adjust(1)  # По одной кнопке в ряду
     return builder.as_markup()
+
+def get_users_pager_keyboard(rows, has_prev: bool, has_next: bool):
+    """Кнопки листания списка пользователей"""
+    builder = InlineKeyboardBuilder()
+    
+    if has_prev:
+        first_id, *_, first_registered = rows[0]
+        builder.add(InlineKeyboardButton(text="⏮", callback_data="users_first"))
+        builder.add(InlineKeyboardButton(text="◀️", callback_data=f"users_prev_{first_registered}_{first_id}"))
+    if has_next:
+        last_id, *_, last_registered = rows[-1]
+        builder.add(InlineKeyboardButton(text="▶️", callback_data=f"users_next_{last_registered}_{last_id}"))
+        builder.add(InlineKeyboardButton(text="⏭", callback_data="users_last"))
+    
+    return builder.as_markup()
+
+def get_roster_keyboard(activities):
+    """Выбор активности для просмотра списка участников (для админа)"""
+    builder = InlineKeyboardBuilder()
+    for activity_id, name, max_slots, used_slots in activities:
+        builder.add(InlineKeyboardButton(
+            text=f"{name} ({used_slots}/{max_slots})",
+            callback_data=f"roster_{activity_id}"
+        ))
+    builder.add(InlineKeyboardButton(text="📄 Все списки одним файлом", callback_data="roster_all"))
+    builder.adjust(1)
+    return builder.as_markup()
+
+def get_live_stats_keyboard(live: bool):
+    """Кнопка включения/выключения автообновления статистики"""
+    if live:
+        button = InlineKeyboardButton(text="⏹ Остановить обновление", callback_data="live_off")
+    else:
+        button = InlineKeyboardButton(text="🔴 Следить онлайн", callback_data="live_on")
+    return InlineKeyboardMarkup(inline_keyboard=[[button]])
+
+def get_waitlist_keyboard():
+    """Кнопка выхода из листа ожидания"""
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="🚪 Покинуть лист ожидания", callback_data="wait_leave")]
+    ])
@@ -0,0 +1,141 @@
+"""Живая статистика: сообщения, которые бот сам обновляет при изменении мест.
+
+Пользователь включает обновление кнопкой под «📊 Статистика», и сообщение
+попадает в реестр. Фоновая задача раз в секунду собирает свежий текст
+(не чаще раза в LIVE_EDIT_INTERVAL) и правит только те сообщения, которые
+не правились последние LIVE_EDIT_INTERVAL секунд и показывают устаревший
+текст. Промежуточные изменения при этом схлопываются в последнее состояние.
+Реестр ограничен LIVE_MAX_VIEWERS, записи живут LIVE_VIEW_TTL секунд.
+"""
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramAPIError, TelegramBadRequest, TelegramForbiddenError
+
+from config import LIVE_EDIT_INTERVAL, LIVE_VIEW_TTL, LIVE_MAX_VIEWERS
+from keyboards import get_live_stats_keyboard
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class LiveView:
+    """Сообщение под автообновлением"""
+    fingerprint: int
+    edited_at: float
+    expires_at: float
+
+
+class LiveStats:
+    """Реестр сообщений живой статистики и задача, которая их правит"""
+
+    def __init__(self, bot: Bot, db, render, interval: float = LIVE_EDIT_INTERVAL,
+                 ttl: float = LIVE_VIEW_TTL, max_viewers: int = LIVE_MAX_VIEWERS):
+        self.bot = bot
+        self.db = db
+        self.render = render  # async render(db) -> текст сообщения
+        self.interval = interval
+        self.ttl = ttl
+        self.max_viewers = max_viewers
+        self.tick = min(1.0, interval)
+        self._views = OrderedDict()  # (chat_id, message_id) -> LiveView
+        self._text = None
+        self._rendered_at = 0.0
+        self._task = None
+        # Счетчики для наблюдения
+        self.edits = 0
+        self.skipped = 0
+
+    def __len__(self):
+        return len(self._views)
+
+    def watch(self, chat_id: int, message_id: int, text: str):
+        """Включает обновление сообщения, которое сейчас показывает text"""
+        now = time.monotonic()
+        key = (chat_id, message_id)
+        self._views[key] = LiveView(hash(text), now, now + self.ttl)
+        self._views.move_to_end(key)
+        while len(self._views) > self.max_viewers:
+            self._views.popitem(last=False)
+
+    def unwatch(self, chat_id: int, message_id: int) -> bool:
+        return self._views.pop((chat_id, message_id), None) is not None
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.tick)
+            try:
+                await self.flush()
+            except Exception:
+                logger.exception("Ошибка при обновлении живой статистики")
+
+    async def _current_text(self, now: float) -> str:
+        # Один рендер на всех зрителей и не чаще интервала правок
+        if self._text is None or now - self._rendered_at >= self.interval:
+            self._text = await self.render(self.db)
+            self._rendered_at = now
+        return self._text
+
+    async def flush(self):
+        """Одна итерация: снимает истекшие сообщения и правит устаревшие"""
+        now = time.monotonic()
+        expired = [key for key, view in self._views.items() if view.expires_at <= now]
+        for key in expired:
+            del self._views[key]
+        due = [key for key, view in self._views.items() if now - view.edited_at >= self.interval]
+        if not expired and not due:
+            return
+
+        text = await self._current_text(now)
+        if text is None:
+            return
+        fingerprint = hash(text)
+
+        edits = []
+        for key in due:
+            view = self._views[key]
+            if view.fingerprint == fingerprint:
+                self.skipped += 1
+                continue
+            view.fingerprint = fingerprint
+            view.edited_at = now
+            edits.append(self._edit(key, text, live=True))
+        # Истекшее сообщение получает последнее состояние и кнопку повторного включения
+        edits += [self._edit(key, text, live=False) for key in expired]
+        await asyncio.gather(*edits)
+
+    async def _edit(self, key, text: str, live: bool):
+        chat_id, message_id = key
+        try:
+            await self.bot.edit_message_text(
+                text, chat_id=chat_id, message_id=message_id, reply_markup=get_live_stats_keyboard(live)
+            )
+            self.edits += 1
+        except TelegramBadRequest as e:
+            if "not modified" in str(e):
+                self.skipped += 1
+                return
+            # Сообщение удалено или слишком старое для правки
+            self._views.pop(key, None)
+        except TelegramForbiddenError:
+            self._views.pop(key, None)
+        except TelegramAPIError as e:
+            logger.warning(f"Не удалось обновить живую статистику в чате {chat_id}: {e}")
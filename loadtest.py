@@ -0,0 +1,461 @@
+"""Нагрузочный тест бота на локальном фейковом Telegram Bot API.
+
+Поднимает aiohttp-заглушку Bot API, направляет на нее настоящие `bot` и `dp`
+из bot.py и прогоняет сценарий наплыва: N пользователей делают /start,
+отправляют контакт, открывают «🎯 Выбрать активность» и нажимают vote_<id>.
+
+С --workers N апдейты раздает Supervisor из workers.py N процессам-обработчикам,
+как при WORKERS=N; время фазы тогда считается до первого ответа бота каждому
+пользователю, а задержка диспетчера не замеряется.
+
+С --repeat R каждое нажатие vote_<id> сразу повторяется еще R раз, как при
+двойном нажатии на медленной связи: видно, что повторы получают настоящий
+итог первой записи (VoteDeduplicator), а не «уже записаны на другую».
+
+С --views K во время нажатий vote_<id> другие пользователи в среднем K раз на
+каждое нажатие открывают «📊 Статистика»: видно, как классы приоритета
+(AdmissionControlMiddleware) держат задержку записи и сколько просмотров отклонено.
+
+Пример:
+    python loadtest.py --users 5000 --hot 0.5
+    python loadtest.py --users 5000 --workers 4
+    python loadtest.py --users 5000 --views 3
+    python loadtest.py --users 5000 --repeat 2
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import logging
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+from collections import Counter, defaultdict
+
+from aiohttp import web
+
+os.environ.setdefault("BOT_TOKEN", "123456:LOADTEST")
+
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+
+import bot as bot_module
+from config import ACTIVITIES
+from database import Database
+from workers import Supervisor
+
+FIRST_USER_ID = 10_000_000
+FIRST_VIEWER_ID = 20_000_000
+BOT_USER = {"id": 123456, "is_bot": True, "first_name": "LoadTestBot", "username": "loadtest_bot"}
+
+
+def quiet_logs():
+    """Построчные логи апдейтов и access-лог заглушки заглушили бы отчет"""
+    for name in ("aiogram.event", "aiohttp.access", "__main__", "__mp_main__", "bot"):
+        logging.getLogger(name).setLevel(logging.WARNING)
+
+
+def quiet_worker_main(queue, ready):
+    """Процесс-обработчик для --workers: bot.worker_main без построчных логов"""
+    quiet_logs()
+    bot_module.worker_main(queue, ready)
+
+
+def percentile(values, q):
+    """Перцентиль q (0..100) по отсортированному списку"""
+    if not values:
+        return 0.0
+    index = min(len(values) - 1, max(0, round(q / 100 * (len(values) - 1))))
+    return values[index]
+
+
+class FakeTelegramAPI:
+    """Заглушка Bot API: отдает апдейты через getUpdates и запоминает ответы бота"""
+
+    def __init__(self):
+        self._updates = []
+        self._new_updates = asyncio.Event()
+        self._message_ids = itertools.count(1)
+        self._update_ids = itertools.count(1)
+        self.calls = Counter()
+        self.callback_answers = {}
+        self.edited = defaultdict(list)
+        # on_reply(user_id) — при каждом сообщении или ответе на callback пользователю
+        self.on_reply = None
+
+    def push(self, payload: dict) -> int:
+        """Ставит апдейт в очередь getUpdates"""
+        update_id = next(self._update_ids)
+        self._updates.append({"update_id": update_id, **payload})
+        self._new_updates.set()
+        return update_id
+
+    def _message(self, chat_id, text=None, message_id=None):
+        return {
+            "message_id": message_id or next(self._message_ids),
+            "date": int(time.time()),
+            "chat": {"id": int(chat_id), "type": "private"},
+            "from": BOT_USER,
+            "text": text or "",
+        }
+
+    async def handle(self, request: web.Request):
+        method = request.match_info["method"]
+        params = await request.post()
+        self.calls[method] += 1
+
+        if method == "getMe":
+            result = BOT_USER
+        elif method == "getUpdates":
+            result = await self._get_updates(params)
+        elif method in ("sendMessage", "sendDocument"):
+            result = self._message(params["chat_id"], params.get("text") or params.get("caption"))
+            if self.on_reply:
+                self.on_reply(int(params["chat_id"]))
+        elif method == "editMessageText":
+            self.edited[int(params["chat_id"])].append(params.get("text"))
+            result = self._message(params["chat_id"], params.get("text"), int(params["message_id"]))
+        elif method == "answerCallbackQuery":
+            callback_id = params["callback_query_id"]
+            self.callback_answers[callback_id] = params.get("text") or ""
+            result = True
+            # Повторные нажатия (--repeat) не входят в апдейты фазы
+            if self.on_reply and callback_id.startswith("cb"):
+                self.on_reply(int(callback_id.removeprefix("cb")))
+        else:
+            result = True
+        return web.json_response({"ok": True, "result": result})
+
+    async def _get_updates(self, params):
+        offset = int(params.get("offset") or 0)
+        limit = int(params.get("limit") or 100)
+        timeout = min(float(params.get("timeout") or 0), 1.0)
+
+        # Подтвержденные апдейты удаляем, как это делает Telegram
+        self._updates = [u for u in self._updates if u["update_id"] >= offset]
+        if not self._updates and timeout:
+            self._new_updates.clear()
+            try:
+                await asyncio.wait_for(self._new_updates.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        return self._updates[:limit]
+
+
+class LoadTest:
+    def __init__(self, users: int, hot: float, seed: int, db_path: str, scale: float = 1.0, workers: int = 1,
+                 views: float = 0, repeat: int = 0):
+        self.users = users
+        self.workers = workers
+        self.scale = scale
+        self.hot = hot
+        self.random = random.Random(seed)
+        self.db_path = db_path
+        self.api = FakeTelegramAPI()
+        self.latencies = defaultdict(list)
+        self.end_to_end = []
+        self.pushed_at = {}
+        # user_id -> время последнего апдейта, на который еще не было ответа (для --workers)
+        self.waiting_reply = {}
+        self.handled = 0
+        self._handled_changed = asyncio.Event()
+        self.vote_callbacks = {}
+        self.views = views
+        self.repeat = repeat
+        self.repeat_callbacks = {}
+        self.viewer_ids = itertools.count(FIRST_VIEWER_ID)
+        self.views_sent = 0
+
+    async def timing_middleware(self, handler, event, data):
+        """Замеряет время обработки апдейта диспетчером"""
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        finally:
+            finished = time.perf_counter()
+            self.latencies[event.event_type].append(finished - started)
+            pushed = self.pushed_at.pop(event.update_id, None)
+            # Фоновые просмотры (--views) не входят в апдейты фазы
+            if pushed is not None:
+                self.end_to_end.append(finished - pushed)
+                self.handled += 1
+                self._handled_changed.set()
+
+    def replied(self, user_id):
+        """Первый ответ пользователю после его апдейта: апдейт обработан (для --workers)"""
+        pushed = self.waiting_reply.pop(user_id, None)
+        if pushed is None:
+            return
+        self.end_to_end.append(time.perf_counter() - pushed)
+        self.handled += 1
+        self._handled_changed.set()
+
+    def _user(self, user_id):
+        return {"id": user_id, "is_bot": False, "first_name": f"User{user_id}", "username": f"user{user_id}"}
+
+    def _push_message(self, user_id, **fields):
+        update_id = self.api.push({"message": {
+            "message_id": user_id,
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"},
+            "from": self._user(user_id),
+            **fields,
+        }})
+        self.pushed_at[update_id] = self.waiting_reply[user_id] = time.perf_counter()
+
+    def _push_vote(self, user_id, activity_id, repeat: int = None):
+        """Нажатие vote_<id>; repeat — номер повторного нажатия, его не ждет фаза"""
+        if repeat is None:
+            callback_id = f"cb{user_id}"
+            self.vote_callbacks[callback_id] = (user_id, activity_id)
+        else:
+            callback_id = f"re{user_id}_{repeat}"
+            self.repeat_callbacks[callback_id] = (user_id, activity_id)
+        update_id = self.api.push({"callback_query": {
+            "id": callback_id,
+            "from": self._user(user_id),
+            "chat_instance": str(user_id),
+            "data": f"vote_{activity_id}",
+            "message": {
+                "message_id": user_id,
+                "date": int(time.time()),
+                "chat": {"id": user_id, "type": "private"},
+                "from": BOT_USER,
+                "text": "🎯 Выберите активность:",
+            },
+        }})
+        if repeat is None:
+            self.pushed_at[update_id] = self.waiting_reply[user_id] = time.perf_counter()
+
+    def _push_votes(self, user_id):
+        """Нажатие vote_<id> с повторами и фоновыми просмотрами"""
+        activity_id = self.choices[user_id]
+        self._push_vote(user_id, activity_id)
+        for repeat in range(self.repeat):
+            self._push_vote(user_id, activity_id, repeat)
+        self._push_views()
+
+    def _push_views(self):
+        """Фоновые «📊 Статистика» от незарегистрированных пользователей: в среднем views штук"""
+        count = int(self.views) + (self.random.random() < self.views % 1)
+        for _ in range(count):
+            viewer_id = next(self.viewer_ids)
+            self.api.push({"message": {
+                "message_id": viewer_id,
+                "date": int(time.time()),
+                "chat": {"id": viewer_id, "type": "private"},
+                "from": self._user(viewer_id),
+                "text": "📊 Статистика",
+            }})
+            self.views_sent += 1
+
+    async def _wait_handled(self, target):
+        while self.handled < target:
+            self._handled_changed.clear()
+            await self._handled_changed.wait()
+
+    async def run_phase(self, name, push):
+        """Отправляет апдейт от каждого пользователя и ждет их обработки"""
+        target = self.handled + self.users
+        started = time.perf_counter()
+        for user_id in self.user_ids:
+            push(user_id)
+        await self._wait_handled(target)
+        elapsed = time.perf_counter() - started
+        print(f"  {name:<12} {self.users} апдейтов за {elapsed:.2f} c ({self.users / elapsed:.0f}/c)")
+        return elapsed
+
+    async def run(self):
+        app = web.Application()
+        app.router.add_post("/bot{token}/{method}", self.api.handle)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        site = web.TCPSite(runner, "127.0.0.1", 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+
+        api_url = f"http://127.0.0.1:{port}"
+        bot_module.bot.session = AiohttpSession(api=TelegramAPIServer.from_base(api_url))
+        for activity in ACTIVITIES.values():
+            activity["max_slots"] = max(1, int(activity["max_slots"] * self.scale))
+
+        activity_ids = list(ACTIVITIES)
+        hot_activity = max(activity_ids, key=lambda activity_id: ACTIVITIES[activity_id]["max_slots"])
+        self.user_ids = [FIRST_USER_ID + i for i in range(self.users)]
+        self.choices = {
+            user_id: hot_activity if self.random.random() < self.hot else self.random.choice(activity_ids)
+            for user_id in self.user_ids
+        }
+
+        supervisor = None
+        if self.workers > 1:
+            supervisor = await self.start_workers(api_url)
+            polling = asyncio.create_task(supervisor.run_polling(
+                bot_module.bot, allowed_updates=bot_module.dp.resolve_used_update_types(), timeout=1
+            ))
+        else:
+            bot_module.db = Database(self.db_path)
+            bot_module.fsm_storage.db = bot_module.db
+            await bot_module.db.init_db()
+            bot_module.dp.update.outer_middleware(self.timing_middleware)
+            polling = asyncio.create_task(bot_module.dp.start_polling(
+                bot_module.bot, handle_signals=False, close_bot_session=False, polling_timeout=1
+            ))
+        try:
+            print(f"Процессов-обработчиков: {self.workers}")
+            print(f"Пользователей: {self.users}, доля на «горячую» активность {hot_activity}: {self.hot:.0%}")
+            await self.run_phase("/start", lambda u: self._push_message(
+                u, text="/start", entities=[{"type": "bot_command", "offset": 0, "length": 6}]
+            ))
+            await self.run_phase("контакт", lambda u: self._push_message(
+                u, contact={"phone_number": f"+7{u}", "first_name": f"User{u}", "user_id": u}
+            ))
+            await self.run_phase("меню", lambda u: self._push_message(u, text="🎯 Выбрать активность"))
+
+            self.latencies.clear()
+            self.end_to_end.clear()
+            vote_time = await self.run_phase("vote_<id>", self._push_votes)
+        finally:
+            if supervisor is not None:
+                polling.cancel()
+                await polling
+                await supervisor.stop()
+            else:
+                await bot_module.dp.stop_polling()
+                await polling
+                await bot_module.db.close()
+            await bot_module.bot.session.close()
+            await runner.cleanup()
+
+        return self.report(vote_time)
+
+    async def start_workers(self, api_url):
+        """Запускает процессы-обработчики на заглушке Bot API и базе теста"""
+        catalog_path = self.db_path + ".activities.json"
+        with open(catalog_path, "w", encoding="utf-8") as f:
+            json.dump({"activities": [
+                {"id": activity_id, **activity} for activity_id, activity in ACTIVITIES.items()
+            ]}, f, ensure_ascii=False)
+        # Процессы-обработчики читают конфиг из окружения при запуске
+        os.environ.update({
+            "DATABASE_URL": f"sqlite:///{self.db_path}",
+            "ACTIVITIES_FILE": catalog_path,
+            "TELEGRAM_API_URL": api_url,
+            "METRICS_PORT": "0",
+            "WORKERS": str(self.workers),
+            # Как и в режиме одного процесса, где сессия бота подменяется без лимитера,
+            # меряем сам бот, а не лимиты Telegram
+            "OUTBOUND_GLOBAL_RATE": "1000000",
+            "OUTBOUND_CHAT_RATE": "1000000",
+            "OUTBOUND_CHAT_BURST": "1000000",
+        })
+        self.api.on_reply = self.replied
+        supervisor = Supervisor(quiet_worker_main, workers=self.workers)
+        await supervisor.start()
+        return supervisor
+
+    def report(self, vote_time):
+        with sqlite3.connect(self.db_path) as conn:
+            activities = conn.execute("SELECT id, name, max_slots, used_slots FROM activities ORDER BY id").fetchall()
+            votes = dict(conn.execute("SELECT activity_id, COUNT(*) FROM votes GROUP BY activity_id").fetchall())
+
+        successes = sum(votes.values())
+        free_at_end = {activity_id for activity_id, _, max_slots, _ in activities if votes.get(activity_id, 0) < max_slots}
+        answers = Counter()
+        false_full = 0
+        for callback_id, (user_id, activity_id) in self.vote_callbacks.items():
+            text = self.api.callback_answers.get(callback_id)
+            if text is None:
+                answers["нет ответа"] += 1
+            elif not text:
+                answers["успех"] += 1
+            elif "нет свободных мест" in text or "Свободных мест нет" in text:
+                # Пользователь с ответом «мест нет» попадает в лист ожидания
+                answers["мест нет"] += 1
+                if activity_id in free_at_end:
+                    false_full += 1
+            else:
+                answers[text[:40]] += 1
+
+        print("\nЗадержка обработки vote_<id> (диспетчер):")
+        for event_type, values in self.latencies.items():
+            values.sort()
+            print(
+                f"  {event_type}: p50 {percentile(values, 50) * 1000:.1f} мс, "
+                f"p95 {percentile(values, 95) * 1000:.1f} мс, p99 {percentile(values, 99) * 1000:.1f} мс"
+            )
+        self.end_to_end.sort()
+        print(
+            f"  от getUpdates до ответа: p50 {percentile(self.end_to_end, 50) * 1000:.1f} мс, "
+            f"p95 {percentile(self.end_to_end, 95) * 1000:.1f} мс, p99 {percentile(self.end_to_end, 99) * 1000:.1f} мс"
+        )
+
+        print(
+            f"\nУспешных записей: {successes}, {successes / vote_time:.0f} записей/c, "
+            f"решений по vote_<id>: {len(self.vote_callbacks) / vote_time:.0f}/c"
+        )
+        print("Ответы на vote_<id>: " + ", ".join(f"{k}: {v}" for k, v in answers.most_common()))
+        print(f"Ложных «мест нет» (активность не заполнилась): {false_full}")
+        if self.repeat_callbacks:
+            repeats = Counter()
+            for callback_id in self.repeat_callbacks:
+                text = self.api.callback_answers.get(callback_id)
+                if text is None:
+                    repeats["нет ответа"] += 1
+                elif not text or "Вы записаны на" in text:
+                    repeats["успех"] += 1
+                elif "Свободных мест нет" in text:
+                    repeats["лист ожидания"] += 1
+                else:
+                    repeats[text[:40]] += 1
+            print("Ответы на повторные нажатия: " + ", ".join(f"{k}: {v}" for k, v in repeats.most_common()))
+            if self.workers == 1:
+                dedupe = bot_module.vote_dedupe
+                print(f"  дождались первого нажатия: {dedupe.joined}, ответ из кэша итогов: {dedupe.cached}")
+        if self.views_sent:
+            print(f"Фоновых «📊 Статистика»: {self.views_sent}")
+            # Счетчики классов есть только у диспетчера этого процесса
+            if self.workers == 1:
+                for lane in bot_module.admission.lanes.values():
+                    print(f"  {lane.name:<10} принято {lane.admitted}, отклонено {lane.shed}")
+
+        oversubscribed = 0
+        print("\nАктивность                  votes / max_slots (used_slots)")
+        for activity_id, name, max_slots, used_slots in activities:
+            count = votes.get(activity_id, 0)
+            mark = ""
+            if count > max_slots or count != used_slots:
+                oversubscribed += 1
+                mark = "  ❗"
+            print(f"  {name:<25} {count:>5} / {max_slots:<5} ({used_slots}){mark}")
+        print(f"Переполненных или рассинхронизированных активностей: {oversubscribed}")
+        return oversubscribed == 0 and false_full == 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--users", type=int, default=2000, help="число пользователей в наплыве")
+    parser.add_argument("--hot", type=float, default=0.3, help="доля пользователей, выбирающих самую большую активность")
+    parser.add_argument("--scale", type=float, default=1.0, help="множитель max_slots всех активностей")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--db", help="путь к SQLite (по умолчанию временный файл)")
+    parser.add_argument("--workers", type=int, default=1, help="число процессов-обработчиков (как WORKERS)")
+    parser.add_argument("--repeat", type=int, default=0, help="повторных нажатий на каждое vote_<id>")
+    parser.add_argument("--views", type=float, default=0, help="фоновых «📊 Статистика» на одно нажатие vote_<id>")
+    args = parser.parse_args()
+
+    quiet_logs()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db_path = args.db or os.path.join(tmp, "loadtest.db")
+        test = LoadTest(args.users, args.hot, args.seed, db_path, args.scale, args.workers, args.views,
+                        args.repeat)
+        ok = asyncio.run(test.run())
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,229 @@
+"""Метрики бота в текстовом формате Prometheus.
+
+Счетчики, гистограммы и «живые» метрики, которые вычисляются в момент
+запроса. Отдаются по HTTP на METRICS_HOST:METRICS_PORT/metrics
+(METRICS_PORT=0 отключает сервер).
+
+Гистограммы задержек:
+    bot_handler_seconds{handler}        обработчики aiogram
+    bot_db_method_seconds{method}       методы Database
+    bot_api_request_seconds{method}     запросы к Bot API (без ожидания лимитов)
+"""
+import functools
+import logging
+import time
+
+from aiogram import BaseMiddleware
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiohttp import web
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(names, values, extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    kind = "untyped"
+
+    def __init__(self, name: str, documentation: str, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        REGISTRY.append(self)
+
+    def header(self) -> list:
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+
+    def samples(self) -> list:
+        raise NotImplementedError
+
+    def render(self) -> list:
+        return self.header() + self.samples()
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def __init__(self, name, documentation, labelnames=()):
+        super().__init__(name, documentation, labelnames)
+        self._values = {}
+
+    def inc(self, *labels, amount: float = 1):
+        self._values[labels] = self._values.get(labels, 0) + amount
+
+    def get(self, *labels):
+        return self._values.get(labels, 0)
+
+    def samples(self):
+        return [
+            f"{self.name}{_format_labels(self.labelnames, labels)} {_format_value(value)}"
+            for labels, value in sorted(self._values.items())
+        ]
+
+
+class Gauge(Metric):
+    """Значение вычисляется при каждом запросе метрик функцией collect() -> {метки: значение}"""
+    kind = "gauge"
+
+    def __init__(self, name, documentation, labelnames=(), collect=None):
+        super().__init__(name, documentation, labelnames)
+        self.collect = collect
+
+    def set_function(self, collect):
+        self.collect = collect
+
+    def samples(self):
+        if self.collect is None:
+            return []
+        try:
+            values = self.collect()
+        except Exception:
+            logger.exception(f"Ошибка при сборе метрики {self.name}")
+            return []
+        if not isinstance(values, dict):
+            values = {(): values}
+        return [
+            f"{self.name}{_format_labels(self.labelnames, labels)} {_format_value(value)}"
+            for labels, value in sorted(values.items())
+        ]
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets) + (float("inf"),)
+        self._series = {}  # метки -> [счетчики по корзинам, сумма, количество]
+
+    def observe(self, value: float, *labels):
+        series = self._series.get(labels)
+        if series is None:
+            series = self._series[labels] = [[0] * len(self.buckets), 0.0, 0]
+        counts = series[0]
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                counts[i] += 1
+                break
+        series[1] += value
+        series[2] += 1
+
+    def count(self, *labels) -> int:
+        series = self._series.get(labels)
+        return series[2] if series else 0
+
+    def samples(self):
+        lines = []
+        for labels, (counts, total, count) in sorted(self._series.items()):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                le = f'le="{_format_value(bound)}"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, labels, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labelnames, labels)} {_format_value(total)}")
+            lines.append(f"{self.name}_count{_format_labels(self.labelnames, labels)} {count}")
+        return lines
+
+
+REGISTRY = []
+
+HANDLER_SECONDS = Histogram("bot_handler_seconds", "Время работы обработчиков aiogram", ["handler"])
+HANDLER_ERRORS = Counter("bot_handler_errors_total", "Исключения в обработчиках aiogram", ["handler"])
+DB_METHOD_SECONDS = Histogram("bot_db_method_seconds", "Время выполнения методов Database", ["method"])
+RESERVATIONS = Counter("bot_reservations_total", "Итоги попыток записи на активность", ["result"])
+API_REQUEST_SECONDS = Histogram("bot_api_request_seconds", "Время запросов к Telegram Bot API", ["method"])
+API_ERRORS = Counter("bot_api_errors_total", "Ошибки запросов к Telegram Bot API", ["method", "error"])
+UPDATES_IN_FLIGHT = Gauge("bot_updates_in_flight", "Апдейты в обработке или в очереди на обработку")
+ADMISSION_IN_FLIGHT = Gauge("bot_admission_in_flight", "Апдейты в обработке по классам приоритета", ["lane"])
+ADMISSION_QUEUE_DEPTH = Gauge("bot_admission_queue_depth", "Апдейты в очереди на обработку по классам приоритета", ["lane"])
+UPDATES_SHED = Counter("bot_updates_shed_total", "Апдейты, отклоненные при перегрузке", ["lane"])
+ACTIVITY_SLOTS_USED = Gauge("bot_activity_slots_used", "Занято мест на активности", ["activity"])
+ACTIVITY_SLOTS_MAX = Gauge("bot_activity_slots_max", "Всего мест на активности", ["activity"])
+SLOT_REPAIRS = Counter("bot_slot_repairs_total", "Исправленные расхождения used_slots с таблицей votes", ["activity"])
+
+
+def render() -> str:
+    """Все метрики в текстовом формате Prometheus"""
+    lines = []
+    for metric in REGISTRY:
+        lines += metric.render()
+    return "\n".join(lines) + "\n"
+
+
+def timed(histogram: Histogram):
+    """Декоратор корутины: время выполнения в histogram с меткой — именем функции"""
+    def decorator(func):
+        name = func.__name__
+
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return await func(*args, **kwargs)
+            finally:
+                histogram.observe(time.perf_counter() - started, name)
+        return wrapper
+    return decorator
+
+
+class HandlerMetricsMiddleware(BaseMiddleware):
+    """Внутренняя middleware наблюдателей: время и ошибки каждого обработчика"""
+
+    async def __call__(self, handler, event, data):
+        handler_object = data.get("handler")
+        name = getattr(getattr(handler_object, "callback", None), "__name__", "unknown")
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        except Exception:
+            HANDLER_ERRORS.inc(name)
+            raise
+        finally:
+            HANDLER_SECONDS.observe(time.perf_counter() - started, name)
+
+
+class ApiMetricsMiddleware(BaseRequestMiddleware):
+    """Middleware сессии бота: время и ошибки запросов к Bot API"""
+
+    async def __call__(self, make_request, bot, method):
+        name = type(method).__name__
+        started = time.perf_counter()
+        try:
+            return await make_request(bot, method)
+        except Exception as e:
+            API_ERRORS.inc(name, type(e).__name__)
+            raise
+        finally:
+            API_REQUEST_SECONDS.observe(time.perf_counter() - started, name)
+
+
+async def handle_metrics(request: web.Request) -> web.Response:
+    return web.Response(text=render(), content_type="text/plain", charset="utf-8")
+
+
+async def start_metrics_server(host: str, port: int):
+    """Запускает HTTP-сервер с /metrics. Возвращает AppRunner для остановки"""
+    app = web.Application()
+    app.router.add_get("/metrics", handle_metrics)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    logger.info(f"Метрики доступны на http://{host}:{port}/metrics")
+    return runner
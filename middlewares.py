@@ -0,0 +1,134 @@
+import asyncio
+import logging
+from collections import deque
+
+from aiogram import BaseMiddleware
+
+logger = logging.getLogger(__name__)
+
+
+class Lane:
+    """Класс приоритета апдейтов для AdmissionControlMiddleware.
+
+    limit — сколько апдейтов класса обрабатываются одновременно;
+    queue_limit — сколько могут ждать очереди (None — без ограничения);
+    max_wait — сколько секунд апдейт ждет очереди (None — сколько нужно).
+    Апдейт, которому не хватило места в очереди или времени, отклоняется.
+    """
+
+    def __init__(self, name: str, limit: int, queue_limit: int = None, max_wait: float = None):
+        self.name = name
+        self.limit = limit
+        self.queue_limit = queue_limit
+        self.max_wait = max_wait
+        self.in_flight = 0
+        self._waiters = deque()
+        # Счетчики для наблюдения
+        self.admitted = 0
+        self.shed = 0
+
+    @property
+    def queued(self) -> int:
+        return len(self._waiters)
+
+
+class AdmissionControlMiddleware(BaseMiddleware):
+    """Допуск апдейтов к обработке по классам приоритета.
+
+    Одновременно обрабатываются не больше limit апдейтов, и у каждого
+    класса (Lane) есть свой предел. Освободившееся место получает первый
+    ждущий апдейт самого приоритетного класса, которому хватает его предела.
+    Отклоненный апдейт не обрабатывается: on_shed(lane, event, data)
+    отвечает на него быстро (например, «бот занят» или устаревшим ответом
+    из кэша). При остановке wait_idle() позволяет дождаться уже принятых
+    апдейтов перед закрытием базы.
+    """
+
+    def __init__(self, limit: int, lanes: list, classify, on_shed=None):
+        self.limit = limit
+        # По убыванию приоритета
+        self.lanes = {lane.name: lane for lane in lanes}
+        self.classify = classify
+        self.on_shed = on_shed
+        self.in_flight = 0
+        self.pending = 0  # обрабатываются или ждут очереди
+        self._idle = asyncio.Event()
+        self._idle.set()
+
+    async def __call__(self, handler, event, data):
+        lane = self.lanes[self.classify(event)]
+        self.pending += 1
+        self._idle.clear()
+        try:
+            if not await self._admit(lane):
+                lane.shed += 1
+                if self.on_shed is not None:
+                    try:
+                        await self.on_shed(lane, event, data)
+                    except Exception:
+                        logger.exception(f"Ошибка при ответе на отклоненный апдейт ({lane.name})")
+                return None
+            try:
+                return await handler(event, data)
+            finally:
+                self._release(lane)
+        finally:
+            self.pending -= 1
+            if not self.pending:
+                self._idle.set()
+
+    def _can_run(self, lane: Lane) -> bool:
+        return self.in_flight < self.limit and lane.in_flight < lane.limit
+
+    def _take(self, lane: Lane):
+        lane.in_flight += 1
+        lane.admitted += 1
+        self.in_flight += 1
+
+    async def _admit(self, lane: Lane) -> bool:
+        """True, когда апдейт можно обрабатывать; False — апдейт отклонен"""
+        # Очередь своего класса обходить нельзя; ждущие более приоритетных классов
+        # либо упираются в свой предел, либо в общий, и тогда _can_run ложно
+        if not lane._waiters and self._can_run(lane):
+            self._take(lane)
+            return True
+        if lane.queue_limit is not None and lane.queued >= lane.queue_limit:
+            return False
+
+        waiter = asyncio.get_running_loop().create_future()
+        lane._waiters.append(waiter)
+        try:
+            # shield: по таймауту решаем сами, успел ли апдейт получить место
+            await asyncio.wait_for(asyncio.shield(waiter), lane.max_wait)
+        except asyncio.TimeoutError:
+            if waiter.done():
+                return True
+            waiter.cancel()
+            lane._waiters.remove(waiter)
+            return False
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                self._release(lane)
+            else:
+                waiter.cancel()
+                lane._waiters.remove(waiter)
+            raise
+        return True
+
+    def _release(self, lane: Lane):
+        lane.in_flight -= 1
+        self.in_flight -= 1
+        for candidate in self.lanes.values():
+            while candidate._waiters and self._can_run(candidate):
+                waiter = candidate._waiters.popleft()
+                self._take(candidate)
+                waiter.set_result(None)
+            if self.in_flight >= self.limit:
+                return
+
+    async def wait_idle(self, timeout: float):
+        """Ждет завершения всех принятых апдейтов, но не дольше timeout"""
+        try:
+            await asyncio.wait_for(self._idle.wait(), timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"Остановка: не дождались {self.pending} апдейтов за {timeout} c")
@@ -0,0 +1,253 @@
+"""Версионированные миграции схемы SQLite.
+
+Текущая версия схемы хранится в PRAGMA user_version. Каждый шаг применяется
+в своей транзакции BEGIN IMMEDIATE вместе с увеличением версии, поэтому
+несколько процессов, стартующих одновременно, не применят шаг дважды.
+
+Проверка планов запросов:
+    python migrations.py votes.db
+"""
+import asyncio
+import logging
+import sys
+
+logger = logging.getLogger(__name__)
+
+# (версия, описание, SQL-операторы). Добавлять только в конец, уже выпущенные шаги не менять.
+MIGRATIONS = [
+    (1, "Базовая схема: users, activities, votes", [
+        '''
+        CREATE TABLE IF NOT EXISTS users (
+            telegram_id INTEGER PRIMARY KEY,
+            username TEXT,
+            full_name TEXT,
+            phone TEXT,
+            registered_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS activities (
+            id INTEGER PRIMARY KEY,
+            name TEXT NOT NULL,
+            max_slots INTEGER NOT NULL,
+            used_slots INTEGER DEFAULT 0
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS votes (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            activity_id INTEGER NOT NULL,
+            voted_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users (telegram_id),
+            FOREIGN KEY (activity_id) REFERENCES activities (id),
+            UNIQUE(user_id, activity_id)
+        )
+        ''',
+    ]),
+    (2, "Индексы для списков, выгрузок и статистики", [
+        # Постраничный просмотр и сортировка пользователей
+        'CREATE INDEX IF NOT EXISTS idx_users_registered ON users (registered_at, telegram_id)',
+        # Участники активности по времени записи и сводка по активностям
+        'CREATE INDEX IF NOT EXISTS idx_votes_activity ON votes (activity_id, voted_at)',
+        # Все записи по времени
+        'CREATE INDEX IF NOT EXISTS idx_votes_voted_at ON votes (voted_at)',
+    ]),
+    (3, "Рассылки и их получатели", [
+        '''
+        CREATE TABLE IF NOT EXISTS broadcasts (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            admin_id INTEGER NOT NULL,
+            target TEXT NOT NULL,
+            text TEXT NOT NULL,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            finished_at DATETIME
+        )
+        ''',
+        # status: pending, sent или failed
+        '''
+        CREATE TABLE IF NOT EXISTS broadcast_recipients (
+            broadcast_id INTEGER NOT NULL,
+            chat_id INTEGER NOT NULL,
+            status TEXT NOT NULL DEFAULT 'pending',
+            PRIMARY KEY (broadcast_id, chat_id)
+        )
+        ''',
+        'CREATE INDEX IF NOT EXISTS idx_broadcast_recipients_status '
+        'ON broadcast_recipients (broadcast_id, status, chat_id)',
+    ]),
+    (4, "Лист ожидания", [
+        # position — сквозной порядковый номер: очередь активности идет по возрастанию.
+        # promoted_at заполняется при переводе в участники, строка удаляется после уведомления
+        '''
+        CREATE TABLE IF NOT EXISTS waitlist (
+            position INTEGER PRIMARY KEY AUTOINCREMENT,
+            activity_id INTEGER NOT NULL,
+            user_id INTEGER NOT NULL UNIQUE,
+            joined_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            promoted_at DATETIME
+        )
+        ''',
+        # Очередь активности по порядку и место в ней
+        'CREATE INDEX IF NOT EXISTS idx_waitlist_queue ON waitlist (activity_id, promoted_at, position)',
+        # Переведенные, которых еще не уведомили
+        'CREATE INDEX IF NOT EXISTS idx_waitlist_promoted ON waitlist (promoted_at, position) '
+        'WHERE promoted_at IS NOT NULL',
+    ]),
+    (5, "Состояния FSM", [
+        # key — ключ aiogram StorageKey (см. fsm_storage.py), data — JSON
+        '''
+        CREATE TABLE IF NOT EXISTS fsm_states (
+            key TEXT PRIMARY KEY,
+            state TEXT,
+            data TEXT NOT NULL DEFAULT '{}',
+            updated_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+        ''',
+    ]),
+    (6, "Журнал сброса кэшей между процессами", [
+        # Пользователи, чью запись изменил не их собственный процесс (перевод из листа
+        # ожидания, /unvote). Процессы читают журнал по seq и сбрасывают их из кэша
+        '''
+        CREATE TABLE IF NOT EXISTS cache_invalidations (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL
+        )
+        ''',
+    ]),
+    (7, "Журнал попыток записи", [
+        # Только дописывается (см. journal.py): event — reserve, waitlist, promote, unvote,
+        # repair или import, result — итог (ReserveResult, WaitlistResult и т.п.), at — unix-время
+        '''
+        CREATE TABLE IF NOT EXISTS reservation_journal (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            at REAL NOT NULL,
+            event TEXT NOT NULL,
+            activity_id INTEGER,
+            user_id INTEGER,
+            result TEXT NOT NULL,
+            detail TEXT
+        )
+        ''',
+        # Записи, сделанные до журнала: счетчики по журналу сходятся с votes с первого дня
+        '''
+        INSERT INTO reservation_journal (at, event, activity_id, user_id, result)
+        SELECT CAST(strftime('%s', voted_at) AS REAL), 'import', activity_id, user_id, 'success'
+        FROM votes
+        ORDER BY voted_at
+        ''',
+    ]),
+    (8, "Позиции чтения журнала сброса кэшей", [
+        # Последний примененный seq cache_invalidations каждого процесса-обработчика:
+        # журнал чистится только до позиции самого отстающего
+        '''
+        CREATE TABLE IF NOT EXISTS cache_readers (
+            worker INTEGER PRIMARY KEY,
+            seq INTEGER NOT NULL
+        )
+        ''',
+    ]),
+    (9, "Читатели журнала сброса кэшей по имени процесса", [
+        # У экземпляров бота на общей базе одинаковые номера обработчиков: позиция
+        # хранится под именем процесса (CACHE_READER_ID) вместе с unix-временем
+        # последней отметки, и журнал ждет только недавно отметившихся
+        'DROP TABLE IF EXISTS cache_readers',
+        '''
+        CREATE TABLE cache_readers (
+            reader TEXT PRIMARY KEY,
+            seq INTEGER NOT NULL,
+            seen_at REAL NOT NULL
+        )
+        ''',
+    ]),
+    (10, "Сводка журнала попыток записи", [
+        # Счетчики JournalStats, посчитанные до seq из строки ('offset', ''): после
+        # перезапуска журнал дочитывается с этого места, а не с начала
+        '''
+        CREATE TABLE IF NOT EXISTS journal_snapshot (
+            kind TEXT NOT NULL,
+            key TEXT NOT NULL,
+            value INTEGER NOT NULL,
+            PRIMARY KEY (kind, key)
+        )
+        ''',
+    ]),
+]
+
+# Каталог активностей, список рассылок, читатели журнала сброса кэшей и сводка журнала —
+# несколько строк, полный проход по ним дешевле индекса
+ALLOWED_FULL_SCANS = {"activities", "broadcasts", "cache_readers", "journal_snapshot"}
+
+
+async def get_schema_version(db) -> int:
+    cursor = await db.execute('PRAGMA user_version')
+    return (await cursor.fetchone())[0]
+
+
+async def migrate(pool):
+    """Применяет недостающие миграции. Возвращает список примененных версий"""
+    applied = []
+    for version, description, statements in MIGRATIONS:
+        async def apply(db):
+            # Версию проверяем внутри транзакции: другой процесс мог успеть раньше
+            if await get_schema_version(db) >= version:
+                return False
+            for statement in statements:
+                await db.execute(statement)
+            await db.execute(f'PRAGMA user_version = {version}')
+            return True
+
+        if await pool.run_write(apply):
+            logger.info(f"Миграция {version} применена: {description}")
+            applied.append(version)
+    return applied
+
+
+async def find_plan_problems(db, checks):
+    """Проверяет EXPLAIN QUERY PLAN запросов.
+
+    Проблема — полный проход по таблице без индекса (кроме ALLOWED_FULL_SCANS)
+    или сортировка через временное B-дерево. Возвращает список (название, строка плана).
+    """
+    # EXPLAIN не читает файл базы и работает по закэшированной схеме соединения;
+    # обычный запрос заставляет перечитать схему после миграций из другого соединения
+    await db.execute('SELECT COUNT(*) FROM sqlite_master')
+
+    problems = []
+    for name, sql, params in checks:
+        cursor = await db.execute(f'EXPLAIN QUERY PLAN {sql}', params)
+        for row in await cursor.fetchall():
+            detail = row[-1]
+            if "TEMP B-TREE" in detail:
+                problems.append((name, detail))
+            elif detail.startswith("SCAN ") and " USING " not in detail:
+                table = detail.split()[1]
+                if table not in ALLOWED_FULL_SCANS and table != "CONSTANT":
+                    problems.append((name, detail))
+    return problems
+
+
+async def check_database(db_path: str) -> bool:
+    from sqlite_storage import ConnectionPool, query_plan_checks
+
+    pool = ConnectionPool(db_path, size=1)
+    await pool.open()
+    try:
+        applied = await migrate(pool)
+        async with pool.acquire() as db:
+            version = await get_schema_version(db)
+            problems = await find_plan_problems(db, query_plan_checks())
+    finally:
+        await pool.close()
+
+    print(f"Версия схемы: {version} (применено сейчас: {applied or 'ничего'})")
+    for name, detail in problems:
+        print(f"❗ {name}: {detail}")
+    if not problems:
+        print("✅ Все запросы используют индексы и не сортируют во временном B-дереве")
+    return not problems
+
+
+if __name__ == "__main__":
+    ok = asyncio.run(check_database(sys.argv[1] if len(sys.argv) > 1 else "votes.db"))
+    sys.exit(0 if ok else 1)
@@ -0,0 +1,112 @@
+"""Ограничение исходящих запросов к Telegram Bot API.
+
+OutboundLimiter — middleware сессии бота (bot.session.middleware): каждый
+запрос с chat_id (sendMessage, editMessageText, sendDocument, ...) ждет токен
+в общем ведре и в ведре своего чата. Ответ 429 с retry_after приостанавливает
+все исходящие сообщения на указанное время, после чего запрос повторяется.
+"""
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.exceptions import TelegramRetryAfter
+
+from config import OUTBOUND_GLOBAL_RATE, OUTBOUND_CHAT_RATE, OUTBOUND_CHAT_BURST, OUTBOUND_RETRIES
+
+logger = logging.getLogger(__name__)
+
+
+class TokenBucket:
+    """Ведро токенов: rate токенов в секунду, не больше capacity про запас.
+
+    Токен выдается сразу в долг, поэтому ждущие получают время отправки
+    в порядке обращения и не опрашивают ведро в цикле.
+    """
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def reserve(self) -> float:
+        """Забирает токен и возвращает, сколько секунд ждать до его появления"""
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= 1
+        return max(0.0, -self.tokens / self.rate)
+
+    @property
+    def is_idle(self) -> bool:
+        """Ведро заполнено бы до краев — его можно выбросить без потери ограничения"""
+        return self.tokens + (time.monotonic() - self.updated) * self.rate >= self.capacity
+
+    async def acquire(self):
+        delay = self.reserve()
+        if delay:
+            await asyncio.sleep(delay)
+
+
+class OutboundLimiter(BaseRequestMiddleware):
+    """Общий и початовый лимиты на исходящие сообщения с учетом retry_after"""
+
+    def __init__(self, global_rate: float = OUTBOUND_GLOBAL_RATE, chat_rate: float = OUTBOUND_CHAT_RATE,
+                 chat_burst: int = OUTBOUND_CHAT_BURST, retries: int = OUTBOUND_RETRIES,
+                 max_chats: int = 10_000):
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.retries = retries
+        self.max_chats = max_chats
+        self._chats = OrderedDict()
+        self._paused_until = 0.0
+        # Счетчики для наблюдения
+        self.waiting = 0
+        self.sent = 0
+        self.retried = 0
+
+    def _chat_bucket(self, chat_id) -> TokenBucket:
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            bucket = self._chats[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+            # Вытесняем самое давнее ведро, только если оно уже восстановилось
+            if len(self._chats) > self.max_chats:
+                oldest_id, oldest = next(iter(self._chats.items()))
+                if oldest.is_idle:
+                    del self._chats[oldest_id]
+        self._chats.move_to_end(chat_id)
+        return bucket
+
+    async def _wait_turn(self, chat_id):
+        self.waiting += 1
+        try:
+            pause = self._paused_until - time.monotonic()
+            if pause > 0:
+                await asyncio.sleep(pause)
+            await self._chat_bucket(chat_id).acquire()
+            await self.global_bucket.acquire()
+        finally:
+            self.waiting -= 1
+
+    async def __call__(self, make_request, bot, method):
+        chat_id = getattr(method, "chat_id", None)
+        if chat_id is None:
+            # getUpdates, answerCallbackQuery и т.п. под лимиты сообщений не попадают
+            return await make_request(bot, method)
+
+        for attempt in range(self.retries + 1):
+            await self._wait_turn(chat_id)
+            try:
+                response = await make_request(bot, method)
+            except TelegramRetryAfter as e:
+                if attempt == self.retries:
+                    raise
+                self.retried += 1
+                logger.warning(f"429 от Telegram для чата {chat_id}: пауза {e.retry_after} c")
+                self._paused_until = max(self._paused_until, time.monotonic() + e.retry_after)
+                continue
+            self.sent += 1
+            return response
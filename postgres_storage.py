@@ -0,0 +1,899 @@
+"""Хранилище на PostgreSQL (asyncpg).
+
+Используется, если DATABASE_URL начинается с postgres:// или postgresql://.
+Соединения берутся из пула asyncpg; бронь места — атомарный
+UPDATE ... RETURNING и вставка записи в одной транзакции, поэтому несколько
+процессов бота могут работать с одной базой. Время хранится в UTC
+без часового пояса и отдается строками, как в SQLite.
+"""
+import asyncio
+import logging
+
+import asyncpg
+from tracing import leaf
+from storage import (
+    ReserveResult, StorageBackend, StorageBusyError, WaitlistResult, diff_catalog, journal_changes, journal_row,
+)
+from config import DB_POOL_SIZE, DB_WRITE_RETRIES, USERS_PAGE_SIZE
+
+logger = logging.getLogger(__name__)
+
+NOW_UTC = "(now() AT TIME ZONE 'utc')"
+
+# (версия, описание, SQL-операторы). Добавлять только в конец, уже выпущенные шаги не менять.
+MIGRATIONS = [
+    (1, "Базовая схема: users, activities, votes", [
+        f'''
+        CREATE TABLE IF NOT EXISTS users (
+            telegram_id BIGINT PRIMARY KEY,
+            username TEXT,
+            full_name TEXT,
+            phone TEXT,
+            registered_at TIMESTAMP(0) DEFAULT {NOW_UTC}
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS activities (
+            id INTEGER PRIMARY KEY,
+            name TEXT NOT NULL,
+            max_slots INTEGER NOT NULL,
+            used_slots INTEGER DEFAULT 0
+        )
+        ''',
+        # Внешние ключи не объявлены, как и в SQLite, где они не включены:
+        # заявка незарегистрированного пользователя не должна валить всю пачку.
+        # UNIQUE (user_id) — одна запись на пользователя даже при нескольких процессах
+        f'''
+        CREATE TABLE IF NOT EXISTS votes (
+            id BIGSERIAL PRIMARY KEY,
+            user_id BIGINT NOT NULL UNIQUE,
+            activity_id INTEGER NOT NULL,
+            voted_at TIMESTAMP(0) DEFAULT {NOW_UTC},
+            UNIQUE (user_id, activity_id)
+        )
+        ''',
+    ]),
+    (2, "Индексы для списков, выгрузок и статистики", [
+        'CREATE INDEX IF NOT EXISTS idx_users_registered ON users (registered_at, telegram_id)',
+        'CREATE INDEX IF NOT EXISTS idx_votes_activity ON votes (activity_id, voted_at)',
+        'CREATE INDEX IF NOT EXISTS idx_votes_voted_at ON votes (voted_at)',
+    ]),
+    (3, "Рассылки и их получатели", [
+        f'''
+        CREATE TABLE IF NOT EXISTS broadcasts (
+            id BIGSERIAL PRIMARY KEY,
+            admin_id BIGINT NOT NULL,
+            target TEXT NOT NULL,
+            text TEXT NOT NULL,
+            created_at TIMESTAMP(0) DEFAULT {NOW_UTC},
+            finished_at TIMESTAMP(0)
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS broadcast_recipients (
+            broadcast_id BIGINT NOT NULL,
+            chat_id BIGINT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'pending',
+            PRIMARY KEY (broadcast_id, chat_id)
+        )
+        ''',
+        'CREATE INDEX IF NOT EXISTS idx_broadcast_recipients_status '
+        'ON broadcast_recipients (broadcast_id, status, chat_id)',
+    ]),
+    (4, "Лист ожидания", [
+        f'''
+        CREATE TABLE IF NOT EXISTS waitlist (
+            position BIGSERIAL PRIMARY KEY,
+            activity_id INTEGER NOT NULL,
+            user_id BIGINT NOT NULL UNIQUE,
+            joined_at TIMESTAMP(0) DEFAULT {NOW_UTC},
+            promoted_at TIMESTAMP(0)
+        )
+        ''',
+        'CREATE INDEX IF NOT EXISTS idx_waitlist_queue ON waitlist (activity_id, promoted_at, position)',
+        'CREATE INDEX IF NOT EXISTS idx_waitlist_promoted ON waitlist (promoted_at, position) '
+        'WHERE promoted_at IS NOT NULL',
+    ]),
+    (5, "Состояния FSM", [
+        f'''
+        CREATE TABLE IF NOT EXISTS fsm_states (
+            key TEXT PRIMARY KEY,
+            state TEXT,
+            data TEXT NOT NULL DEFAULT '{{}}',
+            updated_at TIMESTAMP(0) DEFAULT {NOW_UTC}
+        )
+        ''',
+    ]),
+    (6, "Журнал сброса кэшей между процессами", [
+        '''
+        CREATE TABLE IF NOT EXISTS cache_invalidations (
+            seq BIGSERIAL PRIMARY KEY,
+            user_id BIGINT NOT NULL
+        )
+        ''',
+    ]),
+    (7, "Журнал попыток записи", [
+        '''
+        CREATE TABLE IF NOT EXISTS reservation_journal (
+            seq BIGSERIAL PRIMARY KEY,
+            at DOUBLE PRECISION NOT NULL,
+            event TEXT NOT NULL,
+            activity_id INTEGER,
+            user_id BIGINT,
+            result TEXT NOT NULL,
+            detail TEXT
+        )
+        ''',
+        '''
+        INSERT INTO reservation_journal (at, event, activity_id, user_id, result)
+        SELECT EXTRACT(EPOCH FROM voted_at), 'import', activity_id, user_id, 'success'
+        FROM votes
+        ORDER BY voted_at
+        ''',
+    ]),
+    (8, "Позиции чтения журнала сброса кэшей", [
+        '''
+        CREATE TABLE IF NOT EXISTS cache_readers (
+            worker INTEGER PRIMARY KEY,
+            seq BIGINT NOT NULL
+        )
+        ''',
+    ]),
+    (9, "Читатели журнала сброса кэшей по имени процесса", [
+        'DROP TABLE IF EXISTS cache_readers',
+        '''
+        CREATE TABLE cache_readers (
+            reader TEXT PRIMARY KEY,
+            seq BIGINT NOT NULL,
+            seen_at DOUBLE PRECISION NOT NULL
+        )
+        ''',
+    ]),
+    (10, "Сводка журнала попыток записи", [
+        '''
+        CREATE TABLE IF NOT EXISTS journal_snapshot (
+            kind TEXT NOT NULL,
+            key TEXT NOT NULL,
+            value BIGINT NOT NULL,
+            PRIMARY KEY (kind, key)
+        )
+        ''',
+    ]),
+]
+
+# Ключ pg_advisory_xact_lock, под которым процессы по очереди применяют миграции
+MIGRATION_LOCK_ID = 250_001
+# Ключ, под которым транзакции по очереди пишут в cache_invalidations: номера BIGSERIAL
+# выдаются до коммита, и без очереди читатель мог бы пропустить строку, закоммиченную позже
+INVALIDATION_LOCK_ID = 250_002
+# То же для reservation_journal: JournalStats читает журнал по seq. Транзакции, которые
+# пишут и в cache_invalidations, берут эту блокировку второй, после INVALIDATION_LOCK_ID
+JOURNAL_LOCK_ID = 250_003
+# Сессионная блокировка ведущего экземпляра: задачи в одном экземпляре на всю базу
+# выполняет процесс, который ее держит (см. claim_primary)
+PRIMARY_LOCK_ID = 250_004
+# Сводку журнала процессы сохраняют по очереди (см. save_journal_snapshot)
+JOURNAL_SNAPSHOT_LOCK_ID = 250_005
+
+SCHEMA_VERSION_TABLE_SQL = 'CREATE TABLE IF NOT EXISTS schema_version (version INTEGER NOT NULL)'
+
+SCHEMA_VERSION_SQL = 'SELECT COALESCE(MAX(version), 0) FROM schema_version'
+
+VOTED_USERS_SQL = 'SELECT user_id FROM votes WHERE user_id = ANY($1::bigint[])'
+
+RESERVE_SLOT_SQL = '''
+    UPDATE activities
+    SET used_slots = used_slots + 1
+    WHERE id = $1 AND used_slots < max_slots
+    RETURNING id
+'''
+
+RELEASE_SLOT_SQL = 'UPDATE activities SET used_slots = used_slots - 1 WHERE id = $1 AND used_slots > 0'
+
+INSERT_VOTE_SQL = '''
+    INSERT INTO votes (user_id, activity_id) VALUES ($1, $2)
+    ON CONFLICT DO NOTHING
+    RETURNING voted_at::text
+'''
+
+UPSERT_ACTIVITY_SQL = '''
+    INSERT INTO activities (id, name, max_slots) VALUES ($1, $2, $3)
+    ON CONFLICT (id) DO UPDATE SET name = EXCLUDED.name, max_slots = EXCLUDED.max_slots
+'''
+
+# Бронь и удаление записи меняют used_slots под блокировкой строки активности, поэтому
+# после этой блокировки число записей в votes не меняется до конца транзакции
+LOCK_ACTIVITIES_SQL = 'SELECT id FROM activities ORDER BY id FOR UPDATE'
+
+# Активности, у которых счетчик used_slots разошелся с числом записей в votes
+DRIFTED_SLOTS_SQL = '''
+    SELECT id, used_slots, counted
+    FROM (
+        SELECT id, used_slots, (SELECT COUNT(*) FROM votes WHERE votes.activity_id = activities.id) AS counted
+        FROM activities
+    ) counts
+    WHERE used_slots != counted
+'''
+
+FIX_SLOTS_SQL = 'UPDATE activities SET used_slots = $1 WHERE id = $2'
+
+ACTIVITIES_SQL = 'SELECT id, name, max_slots, used_slots FROM activities ORDER BY id'
+
+DELETE_ACTIVITIES_SQL = 'DELETE FROM activities WHERE id = ANY($1::int[])'
+
+DELETE_ACTIVITIES_WAITLIST_SQL = 'DELETE FROM waitlist WHERE activity_id = ANY($1::int[])'
+
+# Повторная регистрация перезаписывает строку целиком, как INSERT OR REPLACE в SQLite
+REGISTER_USER_SQL = f'''
+    INSERT INTO users (telegram_id, username, full_name, phone) VALUES ($1, $2, $3, $4)
+    ON CONFLICT (telegram_id) DO UPDATE SET
+        username = EXCLUDED.username,
+        full_name = EXCLUDED.full_name,
+        phone = EXCLUDED.phone,
+        registered_at = {NOW_UTC}
+'''
+
+USER_EXISTS_SQL = 'SELECT 1 FROM users WHERE telegram_id = $1'
+
+USER_STATUS_SQL = '''
+    SELECT a.name, v.voted_at::text
+    FROM users u
+    LEFT JOIN votes v ON v.user_id = u.telegram_id
+    LEFT JOIN activities a ON v.activity_id = a.id
+    WHERE u.telegram_id = $1
+    LIMIT 1
+'''
+
+TOTAL_USERS_SQL = 'SELECT COUNT(*) FROM users'
+
+ALL_USERS_SQL = '''
+    SELECT telegram_id, username, full_name, phone, registered_at::text
+    FROM users
+    ORDER BY registered_at
+'''
+
+VOTES_DETAILS_SQL = '''
+    SELECT
+        u.telegram_id,
+        u.username,
+        u.full_name,
+        u.phone,
+        a.name as activity_name,
+        v.voted_at::text
+    FROM votes v
+    JOIN users u ON v.user_id = u.telegram_id
+    JOIN activities a ON v.activity_id = a.id
+    ORDER BY v.voted_at
+'''
+
+ACTIVITY_PARTICIPANTS_SQL = '''
+    SELECT
+        u.telegram_id,
+        u.username,
+        u.full_name,
+        u.phone,
+        v.voted_at::text
+    FROM votes v
+    JOIN users u ON v.user_id = u.telegram_id
+    WHERE v.activity_id = $1
+    ORDER BY v.voted_at
+'''
+
+# Списки всех активностей одним проходом: активности по порядку, внутри — по времени записи.
+# Активность без участников дает одну строку с NULL вместо участника
+ROSTER_SQL = '''
+    SELECT
+        activities.id,
+        activities.name,
+        activities.max_slots,
+        u.telegram_id,
+        u.username,
+        u.full_name,
+        u.phone,
+        v.voted_at::text
+    FROM activities
+    LEFT JOIN votes v ON v.activity_id = activities.id
+    LEFT JOIN users u ON u.telegram_id = v.user_id
+    ORDER BY activities.id, v.voted_at
+'''
+
+USERS_WITHOUT_VOTE_SQL = '''
+    SELECT telegram_id, username, full_name, phone, registered_at::text
+    FROM users u
+    WHERE NOT EXISTS (SELECT 1 FROM votes v WHERE v.user_id = u.telegram_id)
+    ORDER BY registered_at
+'''
+
+INSERT_BROADCAST_SQL = 'INSERT INTO broadcasts (admin_id, target, text) VALUES ($1, $2, $3) RETURNING id'
+
+INSERT_RECIPIENTS_SQL = '''
+    INSERT INTO broadcast_recipients (broadcast_id, chat_id)
+    SELECT $1, unnest($2::bigint[])
+    ON CONFLICT DO NOTHING
+'''
+
+UNFINISHED_BROADCASTS_SQL = '''
+    SELECT id, admin_id, target, text
+    FROM broadcasts
+    WHERE finished_at IS NULL
+    ORDER BY id
+'''
+
+PENDING_RECIPIENTS_SQL = '''
+    SELECT chat_id
+    FROM broadcast_recipients
+    WHERE broadcast_id = $1 AND status = 'pending'
+    ORDER BY chat_id
+    LIMIT $2
+'''
+
+MARK_RECIPIENT_SQL = 'UPDATE broadcast_recipients SET status = $1 WHERE broadcast_id = $2 AND chat_id = $3'
+
+BROADCAST_PROGRESS_SQL = '''
+    SELECT status, COUNT(*)
+    FROM broadcast_recipients
+    WHERE broadcast_id = $1
+    GROUP BY status
+'''
+
+FINISH_BROADCAST_SQL = f'UPDATE broadcasts SET finished_at = {NOW_UTC} WHERE id = $1'
+
+FREE_SLOTS_SQL = 'SELECT max_slots - used_slots FROM activities WHERE id = $1'
+
+# SKIP LOCKED: двух ожидающих не переведет одновременно другой процесс
+NEXT_WAITING_SQL = '''
+    SELECT position, user_id
+    FROM waitlist
+    WHERE activity_id = $1 AND promoted_at IS NULL
+    ORDER BY position
+    LIMIT $2
+    FOR UPDATE SKIP LOCKED
+'''
+
+PROMOTE_WAITING_SQL = f'UPDATE waitlist SET promoted_at = {NOW_UTC} WHERE position = $1'
+
+DELETE_WAITING_SQL = 'DELETE FROM waitlist WHERE position = $1'
+
+USER_WAITLIST_SQL = 'SELECT position, activity_id FROM waitlist WHERE user_id = $1'
+
+JOIN_WAITLIST_SQL = '''
+    INSERT INTO waitlist (activity_id, user_id) VALUES ($1, $2)
+    ON CONFLICT (user_id) DO NOTHING
+'''
+
+LEAVE_WAITLIST_SQL = 'DELETE FROM waitlist WHERE user_id = $1 AND promoted_at IS NULL'
+
+WAITLIST_PLACE_SQL = '''
+    SELECT w.activity_id, (
+        SELECT COUNT(*) FROM waitlist q
+        WHERE q.activity_id = w.activity_id AND q.promoted_at IS NULL AND q.position <= w.position
+    )
+    FROM waitlist w
+    WHERE w.user_id = $1 AND w.promoted_at IS NULL
+'''
+
+WAITLIST_COUNTS_SQL = '''
+    SELECT activity_id, COUNT(*)
+    FROM waitlist
+    WHERE promoted_at IS NULL
+    GROUP BY activity_id
+'''
+
+DELETE_VOTE_SQL = 'DELETE FROM votes WHERE user_id = $1 RETURNING activity_id'
+
+PENDING_PROMOTIONS_SQL = '''
+    SELECT user_id, activity_id
+    FROM waitlist
+    WHERE promoted_at IS NOT NULL
+    ORDER BY promoted_at, position
+    LIMIT $1
+'''
+
+PROMOTIONS_NOTIFIED_SQL = 'DELETE FROM waitlist WHERE user_id = ANY($1::bigint[]) AND promoted_at IS NOT NULL'
+
+FSM_LOAD_SQL = 'SELECT state, data FROM fsm_states WHERE key = $1'
+
+FSM_SAVE_SQL = f'''
+    INSERT INTO fsm_states (key, state, data, updated_at) VALUES ($1, $2, $3, {NOW_UTC})
+    ON CONFLICT (key) DO UPDATE SET state = EXCLUDED.state, data = EXCLUDED.data, updated_at = EXCLUDED.updated_at
+'''
+
+FSM_DELETE_SQL = 'DELETE FROM fsm_states WHERE key = ANY($1::text[])'
+
+INVALIDATE_USER_SQL = 'INSERT INTO cache_invalidations (user_id) VALUES ($1)'
+
+INVALIDATIONS_SQL = 'SELECT seq, user_id FROM cache_invalidations WHERE seq > $1 ORDER BY seq'
+
+LAST_INVALIDATION_SQL = 'SELECT COALESCE(MAX(seq), 0) FROM cache_invalidations'
+
+SAVE_CACHE_POSITION_SQL = '''
+    INSERT INTO cache_readers (reader, seq, seen_at) VALUES ($1, $2, $3)
+    ON CONFLICT (reader) DO UPDATE SET seq = EXCLUDED.seq, seen_at = EXCLUDED.seen_at
+'''
+
+# Журнал чистится до позиции самого отстающего из процессов, отметившихся не раньше
+# seen_after; пока таких нет, MIN — NULL и ничего не удаляется
+PRUNE_INVALIDATIONS_SQL = '''
+    DELETE FROM cache_invalidations
+    WHERE seq <= (SELECT MIN(seq) FROM cache_readers WHERE seen_at >= $1)
+'''
+
+FORGET_CACHE_READERS_SQL = 'DELETE FROM cache_readers WHERE seen_at < $1'
+
+TRY_PRIMARY_LOCK_SQL = 'SELECT pg_try_advisory_lock($1)'
+
+PRUNE_ALL_INVALIDATIONS_SQL = 'DELETE FROM cache_invalidations'
+
+APPEND_JOURNAL_SQL = '''
+    INSERT INTO reservation_journal (at, event, activity_id, user_id, result, detail)
+    VALUES ($1, $2, $3, $4, $5, $6)
+'''
+
+JOURNAL_SINCE_SQL = '''
+    SELECT seq, at, event, activity_id, user_id, result, detail
+    FROM reservation_journal
+    WHERE seq > $1
+    ORDER BY seq
+    LIMIT $2
+'''
+
+JOURNAL_BEFORE_SQL = '''
+    SELECT seq, at, event, activity_id, user_id, result, detail
+    FROM reservation_journal
+    WHERE seq <= $1
+    ORDER BY seq DESC
+    LIMIT $2
+'''
+
+JOURNAL_SNAPSHOT_SQL = 'SELECT kind, key, value FROM journal_snapshot'
+
+JOURNAL_SNAPSHOT_OFFSET_SQL = "SELECT value FROM journal_snapshot WHERE kind = 'offset' AND key = ''"
+
+CLEAR_JOURNAL_SNAPSHOT_SQL = 'DELETE FROM journal_snapshot'
+
+INSERT_JOURNAL_SNAPSHOT_SQL = 'INSERT INTO journal_snapshot (kind, key, value) VALUES ($1, $2, $3)'
+
+
+def users_page_query(direction: str, cursor=None, query: str = None, limit: int = USERS_PAGE_SIZE):
+    """SQL и параметры страницы пользователей (см. Database.get_users_page)"""
+    conditions = []
+    params = []
+
+    def param(value):
+        params.append(value)
+        return f"${len(params)}"
+
+    if query:
+        prefix = query.lstrip("@+").replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+        p = param(prefix)
+        plus = param("+" + prefix)
+        conditions.append(
+            f"(full_name LIKE {p} ESCAPE '\\' OR username LIKE {p} ESCAPE '\\' "
+            f"OR phone LIKE {p} ESCAPE '\\' OR phone LIKE {plus} ESCAPE '\\')"
+        )
+    if direction in ("next", "prev"):
+        registered_at, telegram_id = cursor
+        op = ">" if direction == "next" else "<"
+        conditions.append(
+            f"(registered_at, telegram_id) {op} ({param(registered_at)}::text::timestamp, {param(telegram_id)})"
+        )
+
+    order = "DESC" if direction in ("prev", "last") else "ASC"
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+    sql = f'''
+        SELECT telegram_id, username, full_name, phone, registered_at::text
+        FROM users
+        {where}
+        ORDER BY registered_at {order}, telegram_id {order}
+        LIMIT {param(limit + 1)}
+    '''
+    return sql, params
+
+
+class PostgresBackend(StorageBackend):
+    """Хранилище в PostgreSQL"""
+
+    shared = True
+
+    def __init__(self, url: str, pool_size: int = DB_POOL_SIZE):
+        self.url = url
+        self.pool_size = pool_size
+        self._pool = None
+        # Отдельное соединение, сессия которого держит PRIMARY_LOCK_ID
+        self._lock_conn = None
+        self._primary = False
+
+    async def open(self):
+        if self._pool is None:
+            self._pool = await asyncpg.create_pool(self.url, min_size=1, max_size=self.pool_size + 1)
+
+    async def close(self):
+        if self._lock_conn is not None:
+            # Блокировка снимается вместе с сессией
+            await self._lock_conn.close()
+            self._lock_conn = None
+            self._primary = False
+        if self._pool is not None:
+            await self._pool.close()
+            self._pool = None
+
+    async def claim_primary(self) -> bool:
+        try:
+            if self._lock_conn is None or self._lock_conn.is_closed():
+                # Новая сессия блокировку еще не держит
+                self._lock_conn = await asyncpg.connect(self.url)
+                self._primary = False
+            if self._primary:
+                # Блокировка жива, пока жива сессия
+                await self._lock_conn.fetchval('SELECT 1')
+            else:
+                self._primary = await self._lock_conn.fetchval(TRY_PRIMARY_LOCK_SQL, PRIMARY_LOCK_ID)
+        except BaseException:
+            if self._lock_conn is not None:
+                self._lock_conn.terminate()
+                self._lock_conn = None
+            self._primary = False
+            raise
+        return self._primary
+
+    async def migrate(self) -> list:
+        applied = []
+        async with self._pool.acquire() as conn:
+            for version, description, statements in MIGRATIONS:
+                async with conn.transaction():
+                    # Версию проверяем под блокировкой: другой процесс мог успеть раньше
+                    await conn.execute('SELECT pg_advisory_xact_lock($1)', MIGRATION_LOCK_ID)
+                    await conn.execute(SCHEMA_VERSION_TABLE_SQL)
+                    if await conn.fetchval(SCHEMA_VERSION_SQL) >= version:
+                        continue
+                    for statement in statements:
+                        await conn.execute(statement)
+                    await conn.execute('INSERT INTO schema_version (version) VALUES ($1)', version)
+                logger.info(f"Миграция {version} применена: {description}")
+                applied.append(version)
+        return applied
+
+    async def _write(self, func, sql: str = None, retries: int = DB_WRITE_RETRIES):
+        """Выполняет func(conn) в транзакции, повторяя при взаимной блокировке"""
+        delay = 0.05
+        for attempt in range(retries + 1):
+            try:
+                with leaf("sql.write", sql=sql, attempt=attempt or None):
+                    async with self._pool.acquire() as conn, conn.transaction():
+                        return await func(conn)
+            except asyncpg.exceptions.TransactionRollbackError as e:
+                if attempt == retries:
+                    raise StorageBusyError(str(e)) from e
+                logger.warning(f"Транзакция откатилась, повтор {attempt + 1}/{retries}: {e}")
+                await asyncio.sleep(delay)
+                delay *= 2
+
+    async def _fix_drift(self, conn) -> list:
+        """Приводит used_slots к числу записей в votes. Возвращает [(activity_id, было, стало)]"""
+        # Блокировка строк activities держится до конца транзакции
+        await conn.execute(LOCK_ACTIVITIES_SQL)
+        drift = [tuple(row) for row in await conn.fetch(DRIFTED_SLOTS_SQL)]
+        if drift:
+            await conn.executemany(FIX_SLOTS_SQL, [(counted, activity_id) for activity_id, _, counted in drift])
+        return drift
+
+    async def _journal(self, conn, rows: list):
+        """Дописывает строки журнала в текущей транзакции (после записей в cache_invalidations)"""
+        if rows:
+            await conn.execute('SELECT pg_advisory_xact_lock($1)', JOURNAL_LOCK_ID)
+            await conn.executemany(APPEND_JOURNAL_SQL, rows)
+
+    async def reconcile_slots(self) -> tuple:
+        async def reconcile(conn):
+            drift = await self._fix_drift(conn)
+            promoted = []
+            for activity_id, _, _ in drift:
+                # Счетчик был завышен: освободившиеся места получают ожидающие
+                promoted += await self._promote(conn, activity_id)
+            await self._journal(conn, journal_changes(promoted, drift))
+            return [tuple(row) for row in await conn.fetch(ACTIVITIES_SQL)], promoted, drift
+
+        return await self._write(reconcile, DRIFTED_SLOTS_SQL)
+
+    async def sync_activities(self, activities: dict) -> tuple:
+        async def sync(conn):
+            # Сравниваем с точными used_slots: сначала сверяем их с таблицей votes
+            drift = await self._fix_drift(conn)
+            # CatalogError откатывает транзакцию целиком
+            diff = diff_catalog([tuple(row) for row in await conn.fetch(ACTIVITIES_SQL)], activities)
+            if diff.upserts:
+                await conn.executemany(UPSERT_ACTIVITY_SQL, diff.upserts)
+            if diff.removed:
+                # Записанных на удаляемые активности нет, остались только их листы ожидания
+                await conn.execute(DELETE_ACTIVITIES_WAITLIST_SQL, diff.removed)
+                await conn.execute(DELETE_ACTIVITIES_SQL, diff.removed)
+            # Если мест стало больше, их сразу получают ожидающие
+            promoted = []
+            for activity_id in activities:
+                promoted += await self._promote(conn, activity_id)
+            await self._journal(conn, journal_changes(promoted, drift))
+            return [tuple(row) for row in await conn.fetch(ACTIVITIES_SQL)], promoted, diff, drift
+
+        return await self._write(sync, UPSERT_ACTIVITY_SQL)
+
+    async def reserve_batch(self, requests: list) -> list:
+        async def decide(conn):
+            user_ids = list({user_id for _, user_id in requests})
+            voted = {row[0] for row in await conn.fetch(VOTED_USERS_SQL, user_ids)}
+
+            results = []
+            reserved = []
+            for activity_id, user_id in requests:
+                if user_id in voted:
+                    results.append((ReserveResult.ALREADY_VOTED, None))
+                    continue
+
+                if await conn.fetchval(RESERVE_SLOT_SQL, activity_id) is None:
+                    results.append((ReserveResult.FULL, None))
+                    continue
+
+                voted_at = await conn.fetchval(INSERT_VOTE_SQL, user_id, activity_id)
+                voted.add(user_id)
+                if voted_at is None:
+                    # Запись этого пользователя успел сделать другой процесс
+                    await conn.execute(RELEASE_SLOT_SQL, activity_id)
+                    results.append((ReserveResult.ALREADY_VOTED, None))
+                else:
+                    await conn.execute(LEAVE_WAITLIST_SQL, user_id)
+                    results.append((ReserveResult.SUCCESS, voted_at))
+                    reserved.append(journal_row("reserve", activity_id, user_id))
+            await self._journal(conn, reserved)
+            return results
+
+        return await self._write(decide, RESERVE_SLOT_SQL)
+
+    async def _promote(self, conn, activity_id: int) -> list:
+        """Записывает ожидающих по порядку, пока у активности есть свободные места"""
+        promoted = []
+        while True:
+            free = await conn.fetchval(FREE_SLOTS_SQL, activity_id) or 0
+            if free <= 0:
+                return promoted
+            waiting = await conn.fetch(NEXT_WAITING_SQL, activity_id, free)
+            if not waiting:
+                return promoted
+
+            for position, user_id in waiting:
+                if await conn.fetchval(RESERVE_SLOT_SQL, activity_id) is None:
+                    return promoted
+                voted_at = await conn.fetchval(INSERT_VOTE_SQL, user_id, activity_id)
+                if voted_at is None:
+                    # Пользователь уже записан сам
+                    await conn.execute(RELEASE_SLOT_SQL, activity_id)
+                    await conn.execute(DELETE_WAITING_SQL, position)
+                    continue
+                await conn.execute(PROMOTE_WAITING_SQL, position)
+                # Кэш переведенного держит процесс, который обслуживает его апдейты
+                await self._invalidate(conn, user_id)
+                promoted.append((activity_id, user_id, voted_at))
+
+    async def join_waitlist(self, requests: list) -> tuple:
+        async def join(conn):
+            user_ids = list({user_id for _, user_id in requests})
+            voted = {row[0] for row in await conn.fetch(VOTED_USERS_SQL, user_ids)}
+
+            results = []
+            promoted = []
+            for activity_id, user_id in requests:
+                if user_id in voted:
+                    results.append((WaitlistResult.ALREADY_VOTED, None))
+                    continue
+
+                row = await conn.fetchrow(USER_WAITLIST_SQL, user_id)
+                if row is None or row[1] != activity_id:
+                    if row is not None:
+                        await conn.execute(DELETE_WAITING_SQL, row[0])
+                    await conn.execute(JOIN_WAITLIST_SQL, activity_id, user_id)
+
+                # Место могло освободиться, пока пользователь смотрел на старый список
+                moved = await self._promote(conn, activity_id)
+                promoted += moved
+                voted.update(promoted_user for _, promoted_user, _ in moved)
+                if user_id in voted:
+                    # Пользователь узнает о записи из ответа, отдельное уведомление не нужно
+                    await conn.execute(PROMOTIONS_NOTIFIED_SQL, [user_id])
+                    results.append((WaitlistResult.PROMOTED, None))
+                    continue
+                row = await conn.fetchrow(WAITLIST_PLACE_SQL, user_id)
+                if row is None:
+                    # Пользователя успел перевести другой процесс
+                    results.append((WaitlistResult.ALREADY_VOTED, None))
+                else:
+                    results.append((WaitlistResult.WAITING, row[1]))
+            await self._journal(conn, journal_changes(promoted))
+            return results, promoted
+
+        return await self._write(join, JOIN_WAITLIST_SQL)
+
+    async def leave_waitlist(self, user_id: int) -> bool:
+        async def leave(conn):
+            return await conn.execute(LEAVE_WAITLIST_SQL, user_id) != "DELETE 0"
+
+        return await self._write(leave, LEAVE_WAITLIST_SQL)
+
+    async def waitlist_place(self, user_id: int):
+        rows = await self._fetch_all(WAITLIST_PLACE_SQL, user_id)
+        return rows[0] if rows else None
+
+    async def waitlist_counts(self) -> list:
+        return await self._fetch_all(WAITLIST_COUNTS_SQL)
+
+    async def remove_vote(self, user_id: int) -> tuple:
+        async def remove(conn):
+            activity_id = await conn.fetchval(DELETE_VOTE_SQL, user_id)
+            if activity_id is None:
+                return None, []
+            await conn.execute(RELEASE_SLOT_SQL, activity_id)
+            await self._invalidate(conn, user_id)
+            promoted = await self._promote(conn, activity_id)
+            await self._journal(conn, [journal_row("unvote", activity_id, user_id), *journal_changes(promoted)])
+            return activity_id, promoted
+
+        return await self._write(remove, DELETE_VOTE_SQL)
+
+    async def pending_promotions(self, limit: int) -> list:
+        return await self._fetch_all(PENDING_PROMOTIONS_SQL, limit)
+
+    async def mark_promotions_notified(self, user_ids: list):
+        async def delete(conn):
+            await conn.execute(PROMOTIONS_NOTIFIED_SQL, list(user_ids))
+
+        await self._write(delete, PROMOTIONS_NOTIFIED_SQL)
+
+    async def load_fsm_state(self, key: str):
+        rows = await self._fetch_all(FSM_LOAD_SQL, key)
+        return rows[0] if rows else None
+
+    async def save_fsm_states(self, rows: list):
+        async def save(conn):
+            saved = [(key, state, data) for key, state, data in rows if state is not None or data != "{}"]
+            if saved:
+                await conn.executemany(FSM_SAVE_SQL, saved)
+            deleted = [key for key, state, data in rows if state is None and data == "{}"]
+            if deleted:
+                await conn.execute(FSM_DELETE_SQL, deleted)
+
+        await self._write(save, FSM_SAVE_SQL)
+
+    async def register_user(self, telegram_id: int, username: str, full_name: str, phone: str = None):
+        async def register(conn):
+            created = await conn.fetchval(USER_EXISTS_SQL, telegram_id) is None
+            await conn.execute(REGISTER_USER_SQL, telegram_id, username, full_name, phone)
+            return created
+
+        return await self._write(register, REGISTER_USER_SQL)
+
+    async def _invalidate(self, conn, user_id: int):
+        await conn.execute('SELECT pg_advisory_xact_lock($1)', INVALIDATION_LOCK_ID)
+        await conn.execute(INVALIDATE_USER_SQL, user_id)
+
+    async def cache_changes(self, after_seq: int) -> tuple:
+        with leaf("sql", sql=INVALIDATIONS_SQL):
+            async with self._pool.acquire() as conn:
+                rows = [tuple(row) for row in await conn.fetch(ACTIVITIES_SQL)]
+                return rows, [tuple(row) for row in await conn.fetch(INVALIDATIONS_SQL, after_seq)]
+
+    async def last_invalidation(self) -> int:
+        return (await self._fetch_all(LAST_INVALIDATION_SQL))[0][0]
+
+    async def save_cache_position(self, reader: str, seq: int, seen_at: float):
+        async def save(conn):
+            await conn.execute(SAVE_CACHE_POSITION_SQL, reader, seq, seen_at)
+
+        await self._write(save, SAVE_CACHE_POSITION_SQL)
+
+    async def prune_invalidations(self, seen_after: float = None):
+        async def prune(conn):
+            if seen_after is None:
+                await conn.execute(PRUNE_ALL_INVALIDATIONS_SQL)
+            else:
+                await conn.execute(FORGET_CACHE_READERS_SQL, seen_after)
+                await conn.execute(PRUNE_INVALIDATIONS_SQL, seen_after)
+
+        await self._write(prune, PRUNE_INVALIDATIONS_SQL)
+
+    async def append_journal(self, rows: list):
+        async def append(conn):
+            await conn.execute('SELECT pg_advisory_xact_lock($1)', JOURNAL_LOCK_ID)
+            await conn.executemany(APPEND_JOURNAL_SQL, rows)
+
+        await self._write(append, APPEND_JOURNAL_SQL)
+
+    async def journal_since(self, after_seq: int, limit: int) -> list:
+        return await self._fetch_all(JOURNAL_SINCE_SQL, after_seq, limit)
+
+    async def journal_before(self, before_seq: int, limit: int) -> list:
+        return await self._fetch_all(JOURNAL_BEFORE_SQL, before_seq, limit)
+
+    async def journal_snapshot(self) -> list:
+        return await self._fetch_all(JOURNAL_SNAPSHOT_SQL)
+
+    async def save_journal_snapshot(self, offset: int, rows: list) -> bool:
+        async def save(conn):
+            await conn.execute('SELECT pg_advisory_xact_lock($1)', JOURNAL_SNAPSHOT_LOCK_ID)
+            saved = await conn.fetchval(JOURNAL_SNAPSHOT_OFFSET_SQL)
+            if saved is not None and saved >= offset:
+                return False
+            await conn.execute(CLEAR_JOURNAL_SNAPSHOT_SQL)
+            await conn.executemany(INSERT_JOURNAL_SNAPSHOT_SQL, [("offset", "", offset), *rows])
+            return True
+
+        return await self._write(save, INSERT_JOURNAL_SNAPSHOT_SQL)
+
+    async def _fetch_all(self, sql: str, *args):
+        with leaf("sql", sql=sql):
+            async with self._pool.acquire() as conn:
+                return [tuple(row) for row in await conn.fetch(sql, *args)]
+
+    async def _iterate(self, sql: str, *args, chunk_size: int):
+        """Построчно отдает результат запроса через серверный курсор"""
+        with leaf("sql.iterate", sql=sql):
+            async with self._pool.acquire() as conn, conn.transaction(readonly=True):
+                async for row in conn.cursor(sql, *args, prefetch=chunk_size):
+                    yield tuple(row)
+
+    async def get_user_status(self, telegram_id: int):
+        rows = await self._fetch_all(USER_STATUS_SQL, telegram_id)
+        return rows[0] if rows else None
+
+    async def count_users(self) -> int:
+        with leaf("sql", sql=TOTAL_USERS_SQL):
+            async with self._pool.acquire() as conn:
+                return await conn.fetchval(TOTAL_USERS_SQL)
+
+
+    async def users_page(self, direction: str, cursor, query: str, limit: int) -> list:
+        sql, params = users_page_query(direction, cursor, query, limit)
+        return await self._fetch_all(sql, *params)
+
+    def iter_all_users(self, chunk_size: int):
+        return self._iterate(ALL_USERS_SQL, chunk_size=chunk_size)
+
+    def iter_votes_details(self, chunk_size: int):
+        return self._iterate(VOTES_DETAILS_SQL, chunk_size=chunk_size)
+
+    def iter_activity_participants(self, activity_id: int, chunk_size: int):
+        return self._iterate(ACTIVITY_PARTICIPANTS_SQL, activity_id, chunk_size=chunk_size)
+
+    def iter_roster(self, chunk_size: int):
+        return self._iterate(ROSTER_SQL, chunk_size=chunk_size)
+
+    def iter_users_without_vote(self, chunk_size: int):
+        return self._iterate(USERS_WITHOUT_VOTE_SQL, chunk_size=chunk_size)
+
+    async def create_broadcast(self, admin_id: int, target: str, text: str, chat_ids: list) -> int:
+        async def insert(conn):
+            broadcast_id = await conn.fetchval(INSERT_BROADCAST_SQL, admin_id, target, text)
+            await conn.execute(INSERT_RECIPIENTS_SQL, broadcast_id, list(chat_ids))
+            return broadcast_id
+
+        return await self._write(insert, INSERT_BROADCAST_SQL)
+
+    async def unfinished_broadcasts(self) -> list:
+        return await self._fetch_all(UNFINISHED_BROADCASTS_SQL)
+
+    async def pending_recipients(self, broadcast_id: int, limit: int) -> list:
+        rows = await self._fetch_all(PENDING_RECIPIENTS_SQL, broadcast_id, limit)
+        return [chat_id for chat_id, in rows]
+
+    async def mark_recipients(self, broadcast_id: int, results: list):
+        async def mark(conn):
+            await conn.executemany(
+                MARK_RECIPIENT_SQL, [(status, broadcast_id, chat_id) for chat_id, status in results]
+            )
+
+        await self._write(mark, MARK_RECIPIENT_SQL)
+
+    async def broadcast_progress(self, broadcast_id: int) -> dict:
+        return dict(await self._fetch_all(BROADCAST_PROGRESS_SQL, broadcast_id))
+
+    async def finish_broadcast(self, broadcast_id: int):
+        async def finish(conn):
+            await conn.execute(FINISH_BROADCAST_SQL, broadcast_id)
+
+        await self._write(finish, FINISH_BROADCAST_SQL)
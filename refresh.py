@@ -0,0 +1,56 @@
+"""Троттлинг кнопки «🔄 Обновить список» и пропуск правок без изменений.
+
+Для каждого сообщения со списком активностей запоминается отпечаток
+состояния, с которым была отправлена его клавиатура (Database.slots_version).
+Если с тех пор места не менялись, правка не отправляется. Повторные
+нажатия одного пользователя чаще REFRESH_THROTTLE_SECONDS отвечаются сразу.
+"""
+import time
+from collections import OrderedDict
+
+from config import REFRESH_THROTTLE_SECONDS, USER_CACHE_SIZE
+
+
+class RefreshGuard:
+    """Отпечатки отправленных клавиатур и время последнего обновления по пользователям"""
+
+    def __init__(self, interval: float = REFRESH_THROTTLE_SECONDS, max_entries: int = USER_CACHE_SIZE):
+        self.interval = interval
+        self.max_entries = max_entries
+        self._refreshed_at = OrderedDict()  # user_id -> time.monotonic()
+        self._fingerprints = OrderedDict()  # (chat_id, message_id) -> отпечаток
+        # Счетчики для админ-панели
+        self.edits = 0
+        self.skipped = 0
+        self.throttled = 0
+
+    def _put(self, cache: OrderedDict, key, value):
+        cache[key] = value
+        cache.move_to_end(key)
+        if len(cache) > self.max_entries:
+            cache.popitem(last=False)
+
+    def throttle(self, user_id: int) -> bool:
+        """True, если пользователь обновлял список меньше interval секунд назад"""
+        now = time.monotonic()
+        last = self._refreshed_at.get(user_id)
+        if last is not None and now - last < self.interval:
+            self.throttled += 1
+            return True
+        self._put(self._refreshed_at, user_id, now)
+        return False
+
+    def is_current(self, chat_id: int, message_id: int, fingerprint) -> bool:
+        """True, если сообщение уже показывает состояние fingerprint"""
+        if self._fingerprints.get((chat_id, message_id)) == fingerprint:
+            self.skipped += 1
+            return True
+        return False
+
+    def remember(self, chat_id: int, message_id: int, fingerprint):
+        """Запоминает отпечаток клавиатуры, отправленной в сообщение"""
+        self._put(self._fingerprints, (chat_id, message_id), fingerprint)
+
+    def forget(self, chat_id: int, message_id: int):
+        """Сообщение больше не содержит список активностей"""
+        self._fingerprints.pop((chat_id, message_id), None)
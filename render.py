@@ -0,0 +1,124 @@
+class RenderCache:
+    """Кэш готовых клавиатур и текстов, привязанный к версии состояния мест.
+
+    Пока Database.slots_version не изменилась, все вызывающие получают
+    один и тот же заранее собранный объект.
+    """
+
+    def __init__(self):
+        self._version = None
+        self._items = {}
+        self._latest = {}
+
+    def get(self, key, version):
+        """Возвращает объект для текущей версии или None"""
+        if version != self._version:
+            return None
+        return self._items.get(key)
+
+    def put(self, key, version, value):
+        """Сохраняет объект, сбрасывая кэш при смене версии"""
+        if version != self._version:
+            self._items = {}
+            self._version = version
+        self._items[key] = value
+        self._latest[key] = value
+        return value
+
+    def latest(self, key):
+        """Последний собранный объект независимо от версии (ответ при перегрузке) или None"""
+        return self._latest.get(key)
+
+
+render_cache = RenderCache()
+
+
+def build_progress_bars(stats) -> str:
+    """Прогресс-бары заполненности активностей"""
+    lines = []
+    for name, used_slots, max_slots, is_full in stats:
+        percentage = (used_slots / max_slots) * 100 if max_slots > 0 else 0
+        filled = int(percentage / 10)
+        bar = "█" * filled + "░" * (10 - filled)
+        lines.append(f"<b>{name}</b>\n{bar} {used_slots}/{max_slots} ({percentage:.1f}%)\n\n")
+    return "".join(lines)
+
+
+def build_slots_summary(stats) -> str:
+    """Краткий список «активность: занято/всего» для админ-панели"""
+    return "".join(f"• {name}: {used_slots}/{max_slots}\n" for name, used_slots, max_slots, is_full in stats)
+
+
+async def get_progress_bars(db) -> str:
+    """Прогресс-бары из кэша"""
+    version = db.slots_version
+    text = render_cache.get("progress_bars", version)
+    if text is None:
+        text = render_cache.put("progress_bars", version, build_progress_bars(await db.get_statistics()))
+    return text
+
+
+async def get_statistics_text(db):
+    """Текст «📊 Статистика» или None, если активностей нет"""
+    bars = await get_progress_bars(db)
+    if not bars:
+        return None
+    
+    version = db.slots_version
+    total_users = await db.get_total_users()
+    # Текст зависит и от числа пользователей: оно лежит в кэше рядом с текстом
+    if render_cache.get("statistics_users", version) == total_users:
+        return render_cache.get("statistics_text", version)
+    text = (
+        "📊 <b>Статистика записей на активности:</b>\n\n"
+        f"{bars}"
+        f"👥 <b>Всего зарегистрированных пользователей:</b> {total_users}"
+    )
+    render_cache.put("statistics_users", version, total_users)
+    return render_cache.put("statistics_text", version, text)
+
+
+async def get_slots_summary(db) -> str:
+    """Краткий список мест из кэша"""
+    version = db.slots_version
+    text = render_cache.get("slots_summary", version)
+    if text is None:
+        text = render_cache.put("slots_summary", version, build_slots_summary(await db.get_statistics()))
+    return text
+
+
+def build_attempts_summary(attempts: dict) -> str:
+    """Строка об итогах попыток записи из JournalStats.attempts {(event, result): число}"""
+    reserve = {result: count for (event, result), count in attempts.items() if event == "reserve"}
+    waitlist = sum(count for (event, result), count in attempts.items() if event == "waitlist")
+    return (
+        f"🧾 <b>Попыток записи:</b> {sum(reserve.values())} (успешно {reserve.get('success', 0)}, "
+        f"мест нет {reserve.get('full', 0)}, уже записаны {reserve.get('already_voted', 0)}, "
+        f"база занята {reserve.get('busy', 0)}), в лист ожидания {waitlist}"
+    )
+
+
+def build_full_stats(activities, summary, total_users: int, recent_minutes: int, waiting: dict = None) -> str:
+    """Текст полной статистики из агрегатов: размер не зависит от числа записей"""
+    total_votes = sum(count for count, recent in summary.values())
+    recent_votes = sum(recent for count, recent in summary.values())
+    waiting = waiting or {}
+    total_slots = sum(max_slots for activity_id, name, max_slots, used_slots in activities)
+    fill_rate = (total_votes / total_slots) * 100 if total_slots > 0 else 0
+    
+    lines = [
+        "📊 <b>Полная статистика:</b>\n",
+        f"👥 <b>Всего пользователей:</b> {total_users}",
+        f"🎯 <b>Всего записей на активности:</b> {total_votes} из {total_slots} мест ({fill_rate:.1f}%)",
+        f"⏱ <b>За последние {recent_minutes} мин:</b> {recent_votes}",
+        f"⏳ <b>В листе ожидания:</b> {sum(waiting.values())}\n",
+    ]
+    for activity_id, name, max_slots, used_slots in activities:
+        count, recent = summary.get(activity_id, (0, 0))
+        percentage = (count / max_slots) * 100 if max_slots > 0 else 0
+        filled = min(10, int(percentage / 10))
+        bar = "█" * filled + "░" * (10 - filled)
+        recent_text = f", +{recent} за {recent_minutes} мин" if recent else ""
+        waiting_text = f", ожидают {waiting[activity_id]}" if waiting.get(activity_id) else ""
+        lines.append(f"<b>{name}</b>\n{bar} {count}/{max_slots} ({percentage:.1f}%{recent_text}{waiting_text})\n")
+    return "\n".join(lines)
@@ -0,0 +1,835 @@
+"""Хранилище на SQLite (aiosqlite).
+
+Пул соединений в режиме WAL: читатели берут соединение из очереди, все записи
+идут через одно соединение-писатель в транзакциях BEGIN IMMEDIATE.
+"""
+import asyncio
+import logging
+import sqlite3
+from contextlib import asynccontextmanager
+
+import aiosqlite
+from migrations import migrate
+from tracing import leaf
+from storage import (
+    ReserveResult, StorageBackend, StorageBusyError, WaitlistResult, diff_catalog, journal_changes, journal_row,
+)
+from config import DB_POOL_SIZE, DB_BUSY_TIMEOUT_MS, DB_WRITE_RETRIES, EXPORT_CHUNK_SIZE, USERS_PAGE_SIZE
+
+logger = logging.getLogger(__name__)
+
+# Все запросы SQLiteBackend собраны здесь, чтобы query_plan_checks() мог проверить их планы
+
+VOTED_USERS_SQL = 'SELECT user_id FROM votes WHERE user_id IN ({placeholders})'
+
+RESERVE_SLOT_SQL = '''
+    UPDATE activities 
+    SET used_slots = used_slots + 1 
+    WHERE id = ? AND used_slots < max_slots
+    RETURNING id
+'''
+
+INSERT_VOTE_SQL = 'INSERT INTO votes (user_id, activity_id) VALUES (?, ?) RETURNING voted_at'
+
+UPSERT_ACTIVITY_SQL = '''
+    INSERT INTO activities (id, name, max_slots) VALUES (?, ?, ?)
+    ON CONFLICT (id) DO UPDATE SET name = excluded.name, max_slots = excluded.max_slots
+'''
+
+DELETE_ACTIVITY_SQL = 'DELETE FROM activities WHERE id = ?'
+
+DELETE_ACTIVITY_WAITLIST_SQL = 'DELETE FROM waitlist WHERE activity_id = ?'
+
+REGISTER_USER_SQL = '''
+    INSERT OR REPLACE INTO users (telegram_id, username, full_name, phone)
+    VALUES (?, ?, ?, ?)
+'''
+
+USER_EXISTS_SQL = 'SELECT 1 FROM users WHERE telegram_id = ?'
+
+ACTIVITIES_SQL = '''
+    SELECT id, name, max_slots, used_slots 
+    FROM activities 
+    ORDER BY id
+'''
+
+USER_STATUS_SQL = '''
+    SELECT a.name, v.voted_at
+    FROM users u
+    LEFT JOIN votes v ON v.user_id = u.telegram_id
+    LEFT JOIN activities a ON v.activity_id = a.id
+    WHERE u.telegram_id = ?
+    LIMIT 1
+'''
+
+TOTAL_USERS_SQL = 'SELECT COUNT(*) FROM users'
+
+ALL_USERS_SQL = '''
+    SELECT telegram_id, username, full_name, phone, registered_at 
+    FROM users 
+    ORDER BY registered_at
+'''
+
+VOTES_DETAILS_SQL = '''
+    SELECT 
+        u.telegram_id,
+        u.username,
+        u.full_name,
+        u.phone,
+        a.name as activity_name,
+        v.voted_at
+    FROM votes v
+    JOIN users u ON v.user_id = u.telegram_id
+    JOIN activities a ON v.activity_id = a.id
+    ORDER BY v.voted_at
+'''
+
+ACTIVITY_PARTICIPANTS_SQL = '''
+    SELECT 
+        u.telegram_id,
+        u.username,
+        u.full_name,
+        u.phone,
+        v.voted_at
+    FROM votes v
+    JOIN users u ON v.user_id = u.telegram_id
+    WHERE v.activity_id = ?
+    ORDER BY v.voted_at
+'''
+
+# Списки всех активностей одним проходом: активности по порядку, внутри — по времени записи.
+# Активность без участников дает одну строку с NULL вместо участника
+ROSTER_SQL = '''
+    SELECT
+        activities.id,
+        activities.name,
+        activities.max_slots,
+        u.telegram_id,
+        u.username,
+        u.full_name,
+        u.phone,
+        v.voted_at
+    FROM activities
+    LEFT JOIN votes v ON v.activity_id = activities.id
+    LEFT JOIN users u ON u.telegram_id = v.user_id
+    ORDER BY activities.id, v.voted_at
+'''
+
+USERS_WITHOUT_VOTE_SQL = '''
+    SELECT telegram_id, username, full_name, phone, registered_at
+    FROM users u
+    WHERE NOT EXISTS (SELECT 1 FROM votes v WHERE v.user_id = u.telegram_id)
+    ORDER BY registered_at
+'''
+
+INSERT_BROADCAST_SQL = 'INSERT INTO broadcasts (admin_id, target, text) VALUES (?, ?, ?) RETURNING id'
+
+INSERT_RECIPIENT_SQL = 'INSERT OR IGNORE INTO broadcast_recipients (broadcast_id, chat_id) VALUES (?, ?)'
+
+UNFINISHED_BROADCASTS_SQL = '''
+    SELECT id, admin_id, target, text
+    FROM broadcasts
+    WHERE finished_at IS NULL
+    ORDER BY id
+'''
+
+PENDING_RECIPIENTS_SQL = '''
+    SELECT chat_id
+    FROM broadcast_recipients
+    WHERE broadcast_id = ? AND status = 'pending'
+    ORDER BY chat_id
+    LIMIT ?
+'''
+
+MARK_RECIPIENT_SQL = 'UPDATE broadcast_recipients SET status = ? WHERE broadcast_id = ? AND chat_id = ?'
+
+BROADCAST_PROGRESS_SQL = '''
+    SELECT status, COUNT(*)
+    FROM broadcast_recipients
+    WHERE broadcast_id = ?
+    GROUP BY status
+'''
+
+FINISH_BROADCAST_SQL = 'UPDATE broadcasts SET finished_at = CURRENT_TIMESTAMP WHERE id = ?'
+
+FREE_SLOTS_SQL = 'SELECT max_slots - used_slots FROM activities WHERE id = ?'
+
+NEXT_WAITING_SQL = '''
+    SELECT position, user_id
+    FROM waitlist
+    WHERE activity_id = ? AND promoted_at IS NULL
+    ORDER BY position
+    LIMIT ?
+'''
+
+PROMOTE_WAITING_SQL = 'UPDATE waitlist SET promoted_at = CURRENT_TIMESTAMP WHERE position = ?'
+
+DELETE_WAITING_SQL = 'DELETE FROM waitlist WHERE position = ?'
+
+USER_WAITLIST_SQL = 'SELECT position, activity_id FROM waitlist WHERE user_id = ?'
+
+JOIN_WAITLIST_SQL = 'INSERT INTO waitlist (activity_id, user_id) VALUES (?, ?) RETURNING position'
+
+LEAVE_WAITLIST_SQL = 'DELETE FROM waitlist WHERE user_id = ? AND promoted_at IS NULL'
+
+WAITLIST_PLACE_SQL = '''
+    SELECT w.activity_id, (
+        SELECT COUNT(*) FROM waitlist q
+        WHERE q.activity_id = w.activity_id AND q.promoted_at IS NULL AND q.position <= w.position
+    )
+    FROM waitlist w
+    WHERE w.user_id = ? AND w.promoted_at IS NULL
+'''
+
+WAITLIST_COUNTS_SQL = '''
+    SELECT activity_id, COUNT(*)
+    FROM waitlist
+    WHERE promoted_at IS NULL
+    GROUP BY activity_id
+'''
+
+DELETE_VOTE_SQL = 'DELETE FROM votes WHERE user_id = ? RETURNING activity_id'
+
+RELEASE_SLOT_SQL = 'UPDATE activities SET used_slots = used_slots - 1 WHERE id = ? AND used_slots > 0'
+
+PENDING_PROMOTIONS_SQL = '''
+    SELECT user_id, activity_id
+    FROM waitlist
+    WHERE promoted_at IS NOT NULL
+    ORDER BY promoted_at, position
+    LIMIT ?
+'''
+
+PROMOTION_NOTIFIED_SQL = 'DELETE FROM waitlist WHERE user_id = ? AND promoted_at IS NOT NULL'
+
+FSM_LOAD_SQL = 'SELECT state, data FROM fsm_states WHERE key = ?'
+
+FSM_SAVE_SQL = '''
+    INSERT INTO fsm_states (key, state, data, updated_at) VALUES (?, ?, ?, CURRENT_TIMESTAMP)
+    ON CONFLICT (key) DO UPDATE SET state = excluded.state, data = excluded.data, updated_at = excluded.updated_at
+'''
+
+FSM_DELETE_SQL = 'DELETE FROM fsm_states WHERE key = ?'
+
+INVALIDATE_USER_SQL = 'INSERT INTO cache_invalidations (user_id) VALUES (?)'
+
+INVALIDATIONS_SQL = 'SELECT seq, user_id FROM cache_invalidations WHERE seq > ? ORDER BY seq'
+
+LAST_INVALIDATION_SQL = 'SELECT COALESCE(MAX(seq), 0) FROM cache_invalidations'
+
+SAVE_CACHE_POSITION_SQL = '''
+    INSERT INTO cache_readers (reader, seq, seen_at) VALUES (?, ?, ?)
+    ON CONFLICT (reader) DO UPDATE SET seq = excluded.seq, seen_at = excluded.seen_at
+'''
+
+# Журнал чистится до позиции самого отстающего из процессов, отметившихся не раньше
+# seen_after; пока таких нет, MIN — NULL и ничего не удаляется
+PRUNE_INVALIDATIONS_SQL = '''
+    DELETE FROM cache_invalidations
+    WHERE seq <= (SELECT MIN(seq) FROM cache_readers WHERE seen_at >= ?)
+'''
+
+# Остановленные процессы с именем по pid больше не отметятся
+FORGET_CACHE_READERS_SQL = 'DELETE FROM cache_readers WHERE seen_at < ?'
+
+# Один процесс с неразделяемой базой журнал не читает
+PRUNE_ALL_INVALIDATIONS_SQL = 'DELETE FROM cache_invalidations'
+
+APPEND_JOURNAL_SQL = '''
+    INSERT INTO reservation_journal (at, event, activity_id, user_id, result, detail)
+    VALUES (?, ?, ?, ?, ?, ?)
+'''
+
+JOURNAL_SINCE_SQL = '''
+    SELECT seq, at, event, activity_id, user_id, result, detail
+    FROM reservation_journal
+    WHERE seq > ?
+    ORDER BY seq
+    LIMIT ?
+'''
+
+JOURNAL_BEFORE_SQL = '''
+    SELECT seq, at, event, activity_id, user_id, result, detail
+    FROM reservation_journal
+    WHERE seq <= ?
+    ORDER BY seq DESC
+    LIMIT ?
+'''
+
+JOURNAL_SNAPSHOT_SQL = 'SELECT kind, key, value FROM journal_snapshot'
+
+JOURNAL_SNAPSHOT_OFFSET_SQL = "SELECT value FROM journal_snapshot WHERE kind = 'offset' AND key = ''"
+
+CLEAR_JOURNAL_SNAPSHOT_SQL = 'DELETE FROM journal_snapshot'
+
+INSERT_JOURNAL_SNAPSHOT_SQL = 'INSERT INTO journal_snapshot (kind, key, value) VALUES (?, ?, ?)'
+
+# Активности, у которых счетчик used_slots разошелся с числом записей в votes
+DRIFTED_SLOTS_SQL = '''
+    SELECT id, used_slots, counted
+    FROM (
+        SELECT id, used_slots, (SELECT COUNT(*) FROM votes WHERE votes.activity_id = activities.id) AS counted
+        FROM activities
+    )
+    WHERE used_slots != counted
+'''
+
+FIX_SLOTS_SQL = 'UPDATE activities SET used_slots = ? WHERE id = ?'
+
+
+def users_page_query(direction: str, cursor=None, query: str = None, limit: int = USERS_PAGE_SIZE):
+    """SQL и параметры страницы пользователей (см. Database.get_users_page)"""
+    conditions = []
+    params = []
+    if query:
+        prefix = query.lstrip("@+").replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+        conditions.append(
+            "(full_name LIKE ? ESCAPE '\\' OR username LIKE ? ESCAPE '\\' "
+            "OR phone LIKE ? ESCAPE '\\' OR phone LIKE ? ESCAPE '\\')"
+        )
+        params += [prefix, prefix, prefix, "+" + prefix]
+    if direction == "next":
+        conditions.append("(registered_at, telegram_id) > (?, ?)")
+        params += list(cursor)
+    elif direction == "prev":
+        conditions.append("(registered_at, telegram_id) < (?, ?)")
+        params += list(cursor)
+    
+    order = "DESC" if direction in ("prev", "last") else "ASC"
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+    sql = f'''
+        SELECT telegram_id, username, full_name, phone, registered_at 
+        FROM users 
+        {where}
+        ORDER BY registered_at {order}, telegram_id {order}
+        LIMIT ?
+    '''
+    return sql, (*params, limit + 1)
+
+
+def query_plan_checks():
+    """(название, SQL, параметры) для всех запросов SQLiteBackend — для проверки EXPLAIN QUERY PLAN"""
+    cursor = ("2024-01-01 00:00:00", 1)
+    return [
+        ("voted_users", VOTED_USERS_SQL.format(placeholders="?, ?"), (1, 2)),
+        ("reserve_slot", RESERVE_SLOT_SQL, (1,)),
+        ("insert_vote", INSERT_VOTE_SQL, (1, 1)),
+        ("upsert_activity", UPSERT_ACTIVITY_SQL, (1, "Квиз", 40)),
+        ("delete_activity", DELETE_ACTIVITY_SQL, (1,)),
+        ("delete_activity_waitlist", DELETE_ACTIVITY_WAITLIST_SQL, (1,)),
+        ("register_user", REGISTER_USER_SQL, (1, "user", "Имя", "+7900")),
+        ("user_exists", USER_EXISTS_SQL, (1,)),
+        ("activities", ACTIVITIES_SQL, ()),
+        ("user_status", USER_STATUS_SQL, (1,)),
+        ("total_users", TOTAL_USERS_SQL, ()),
+        ("all_users", ALL_USERS_SQL, ()),
+        ("votes_details", VOTES_DETAILS_SQL, ()),
+        ("activity_participants", ACTIVITY_PARTICIPANTS_SQL, (1,)),
+        ("roster", ROSTER_SQL, ()),
+        ("append_journal", APPEND_JOURNAL_SQL, (0.0, "reserve", 1, 1, "success", None)),
+        ("journal_since", JOURNAL_SINCE_SQL, (0, 1000)),
+        ("journal_before", JOURNAL_BEFORE_SQL, (1000, 1000)),
+        ("journal_snapshot", JOURNAL_SNAPSHOT_SQL, ()),
+        ("journal_snapshot_offset", JOURNAL_SNAPSHOT_OFFSET_SQL, ()),
+        ("clear_journal_snapshot", CLEAR_JOURNAL_SNAPSHOT_SQL, ()),
+        ("insert_journal_snapshot", INSERT_JOURNAL_SNAPSHOT_SQL, ("votes", "1", 0)),
+        ("drifted_slots", DRIFTED_SLOTS_SQL, ()),
+        ("fix_slots", FIX_SLOTS_SQL, (1, 1)),
+        ("users_without_vote", USERS_WITHOUT_VOTE_SQL, ()),
+        ("insert_broadcast", INSERT_BROADCAST_SQL, (1, "all", "Текст")),
+        ("insert_recipient", INSERT_RECIPIENT_SQL, (1, 1)),
+        ("unfinished_broadcasts", UNFINISHED_BROADCASTS_SQL, ()),
+        ("pending_recipients", PENDING_RECIPIENTS_SQL, (1, 100)),
+        ("mark_recipient", MARK_RECIPIENT_SQL, ("sent", 1, 1)),
+        ("broadcast_progress", BROADCAST_PROGRESS_SQL, (1,)),
+        ("finish_broadcast", FINISH_BROADCAST_SQL, (1,)),
+        ("free_slots", FREE_SLOTS_SQL, (1,)),
+        ("next_waiting", NEXT_WAITING_SQL, (1, 10)),
+        ("promote_waiting", PROMOTE_WAITING_SQL, (1,)),
+        ("delete_waiting", DELETE_WAITING_SQL, (1,)),
+        ("user_waitlist", USER_WAITLIST_SQL, (1,)),
+        ("join_waitlist", JOIN_WAITLIST_SQL, (1, 1)),
+        ("leave_waitlist", LEAVE_WAITLIST_SQL, (1,)),
+        ("waitlist_place", WAITLIST_PLACE_SQL, (1,)),
+        ("waitlist_counts", WAITLIST_COUNTS_SQL, ()),
+        ("delete_vote", DELETE_VOTE_SQL, (1,)),
+        ("release_slot", RELEASE_SLOT_SQL, (1,)),
+        ("pending_promotions", PENDING_PROMOTIONS_SQL, (100,)),
+        ("promotion_notified", PROMOTION_NOTIFIED_SQL, (1,)),
+        ("fsm_load", FSM_LOAD_SQL, ("fsm:1:1:1:default",)),
+        ("fsm_save", FSM_SAVE_SQL, ("fsm:1:1:1:default", None, "{}")),
+        ("fsm_delete", FSM_DELETE_SQL, ("fsm:1:1:1:default",)),
+        ("invalidate_user", INVALIDATE_USER_SQL, (1,)),
+        ("invalidations", INVALIDATIONS_SQL, (0,)),
+        ("last_invalidation", LAST_INVALIDATION_SQL, ()),
+        ("save_cache_position", SAVE_CACHE_POSITION_SQL, ("host:1/0", 1, 0.0)),
+        ("prune_invalidations", PRUNE_INVALIDATIONS_SQL, (0.0,)),
+        ("forget_cache_readers", FORGET_CACHE_READERS_SQL, (0.0,)),
+        ("prune_all_invalidations", PRUNE_ALL_INVALIDATIONS_SQL, ()),
+        ("users_page_first", *users_page_query("first")),
+        ("users_page_next", *users_page_query("next", cursor)),
+        ("users_page_prev", *users_page_query("prev", cursor)),
+        ("users_page_last", *users_page_query("last")),
+        ("users_page_search", *users_page_query("next", cursor, "Ив")),
+    ]
+
+
+def is_busy_error(error: Exception) -> bool:
+    """Проверяет, что SQLite вернул SQLITE_BUSY / SQLITE_LOCKED"""
+    if not isinstance(error, sqlite3.OperationalError):
+        return False
+    message = str(error).lower()
+    return "locked" in message or "busy" in message
+
+
+class ConnectionPool:
+    """Пул долгоживущих соединений SQLite.
+
+    Читатели берут соединение из очереди, все записи идут через одно
+    соединение-писатель под asyncio.Lock в транзакции BEGIN IMMEDIATE.
+    """
+
+    def __init__(self, db_path: str, size: int = DB_POOL_SIZE, busy_timeout_ms: int = DB_BUSY_TIMEOUT_MS):
+        self.db_path = db_path
+        self.size = size
+        self.busy_timeout_ms = busy_timeout_ms
+        self._readers = asyncio.Queue()
+        self._all = []
+        self._writer = None
+        self._write_lock = asyncio.Lock()
+
+    async def _connect(self):
+        # isolation_level=None: транзакциями управляем сами (BEGIN IMMEDIATE / COMMIT)
+        conn = await aiosqlite.connect(self.db_path, isolation_level=None)
+        await conn.execute(f'PRAGMA busy_timeout = {int(self.busy_timeout_ms)}')
+        await conn.execute('PRAGMA journal_mode = WAL')
+        await conn.execute('PRAGMA synchronous = NORMAL')
+        self._all.append(conn)
+        return conn
+
+    async def open(self):
+        """Открывает соединения пула"""
+        if self._writer is not None:
+            return
+        self._writer = await self._connect()
+        for _ in range(self.size):
+            self._readers.put_nowait(await self._connect())
+
+    async def close(self):
+        """Закрывает все соединения пула"""
+        for conn in self._all:
+            await conn.close()
+        self._all.clear()
+        self._readers = asyncio.Queue()
+        self._writer = None
+
+    @property
+    def is_open(self) -> bool:
+        return self._writer is not None
+
+    @asynccontextmanager
+    async def acquire(self):
+        """Соединение для чтения"""
+        conn = await self._readers.get()
+        try:
+            yield conn
+        finally:
+            self._readers.put_nowait(conn)
+
+    @asynccontextmanager
+    async def transaction(self):
+        """Пишущая транзакция BEGIN IMMEDIATE на соединении-писателе"""
+        async with self._write_lock:
+            conn = self._writer
+            await conn.execute('BEGIN IMMEDIATE')
+            try:
+                yield conn
+                await conn.execute('COMMIT')
+            except BaseException:
+                if conn.in_transaction:
+                    await conn.execute('ROLLBACK')
+                raise
+
+    async def run_write(self, func, retries: int = DB_WRITE_RETRIES):
+        """Выполняет func(conn) в транзакции, повторяя при SQLITE_BUSY"""
+        delay = 0.05
+        for attempt in range(retries + 1):
+            try:
+                async with self.transaction() as conn:
+                    return await func(conn)
+            except sqlite3.OperationalError as e:
+                if not is_busy_error(e) or attempt == retries:
+                    raise
+                logger.warning(f"База занята, повтор {attempt + 1}/{retries}: {e}")
+                await asyncio.sleep(delay)
+                delay *= 2
+
+
+class SQLiteBackend(StorageBackend):
+    """Хранилище в файле SQLite"""
+
+    def __init__(self, db_path: str, pool_size: int = DB_POOL_SIZE):
+        self.db_path = db_path
+        self.pool = ConnectionPool(db_path, pool_size)
+
+    async def open(self):
+        await self.pool.open()
+
+    async def close(self):
+        await self.pool.close()
+
+    async def migrate(self) -> list:
+        return await migrate(self.pool)
+
+    async def _write(self, func, sql: str = None):
+        """run_write, но исчерпанные повторы SQLITE_BUSY превращаются в StorageBusyError.
+
+        sql — основной запрос транзакции, только для трассировки.
+        """
+        try:
+            with leaf("sql.write", sql=sql):
+                return await self.pool.run_write(func)
+        except sqlite3.OperationalError as e:
+            if is_busy_error(e):
+                raise StorageBusyError(str(e)) from e
+            raise
+
+    async def _fix_drift(self, db) -> list:
+        """Приводит used_slots к числу записей в votes. Возвращает [(activity_id, было, стало)]"""
+        cursor = await db.execute(DRIFTED_SLOTS_SQL)
+        drift = await cursor.fetchall()
+        if drift:
+            await db.executemany(FIX_SLOTS_SQL, [(counted, activity_id) for activity_id, _, counted in drift])
+        return drift
+
+    async def _journal(self, db, rows: list):
+        """Дописывает строки журнала в текущей транзакции"""
+        if rows:
+            await db.executemany(APPEND_JOURNAL_SQL, rows)
+
+    async def reconcile_slots(self) -> tuple:
+        async def reconcile(db):
+            drift = await self._fix_drift(db)
+            promoted = []
+            for activity_id, _, _ in drift:
+                # Счетчик был завышен: освободившиеся места получают ожидающие
+                promoted += await self._promote(db, activity_id)
+            await self._journal(db, journal_changes(promoted, drift))
+            cursor = await db.execute(ACTIVITIES_SQL)
+            return await cursor.fetchall(), promoted, drift
+
+        return await self._write(reconcile, DRIFTED_SLOTS_SQL)
+
+    async def sync_activities(self, activities: dict) -> tuple:
+        async def sync(db):
+            # Сравниваем с точными used_slots: сначала сверяем их с таблицей votes
+            drift = await self._fix_drift(db)
+            cursor = await db.execute(ACTIVITIES_SQL)
+            # CatalogError откатывает транзакцию целиком
+            diff = diff_catalog(await cursor.fetchall(), activities)
+            if diff.upserts:
+                await db.executemany(UPSERT_ACTIVITY_SQL, diff.upserts)
+            for activity_id in diff.removed:
+                # Записанных на удаляемую активность нет, остался только ее лист ожидания
+                await db.execute(DELETE_ACTIVITY_WAITLIST_SQL, (activity_id,))
+                await db.execute(DELETE_ACTIVITY_SQL, (activity_id,))
+            # Если мест стало больше, их сразу получают ожидающие
+            promoted = []
+            for activity_id in activities:
+                promoted += await self._promote(db, activity_id)
+            await self._journal(db, journal_changes(promoted, drift))
+            cursor = await db.execute(ACTIVITIES_SQL)
+            return await cursor.fetchall(), promoted, diff, drift
+
+        return await self._write(sync, UPSERT_ACTIVITY_SQL)
+
+    async def reserve_batch(self, requests: list) -> list:
+        async def decide(db):
+            user_ids = list({user_id for _, user_id in requests})
+            placeholders = ", ".join("?" * len(user_ids))
+            cursor = await db.execute(VOTED_USERS_SQL.format(placeholders=placeholders), user_ids)
+            voted = {row[0] for row in await cursor.fetchall()}
+            
+            results = []
+            reserved = []
+            for activity_id, user_id in requests:
+                if user_id in voted:
+                    results.append((ReserveResult.ALREADY_VOTED, None))
+                    continue
+                
+                cursor = await db.execute(RESERVE_SLOT_SQL, (activity_id,))
+                if not await cursor.fetchone():
+                    results.append((ReserveResult.FULL, None))
+                    continue
+                
+                cursor = await db.execute(INSERT_VOTE_SQL, (user_id, activity_id))
+                voted_at = (await cursor.fetchone())[0]
+                voted.add(user_id)
+                # Записавшийся сам больше не ждет места в другой очереди
+                await db.execute(LEAVE_WAITLIST_SQL, (user_id,))
+                results.append((ReserveResult.SUCCESS, voted_at))
+                reserved.append(journal_row("reserve", activity_id, user_id))
+            await self._journal(db, reserved)
+            return results
+        
+        return await self._write(decide, RESERVE_SLOT_SQL)
+
+    async def register_user(self, telegram_id: int, username: str, full_name: str, phone: str = None):
+        async def insert(db):
+            cursor = await db.execute(USER_EXISTS_SQL, (telegram_id,))
+            created = await cursor.fetchone() is None
+            await db.execute(REGISTER_USER_SQL, (telegram_id, username, full_name, phone))
+            return created
+        
+        return await self._write(insert, REGISTER_USER_SQL)
+
+    async def _promote(self, db, activity_id: int) -> list:
+        """Записывает ожидающих по порядку, пока у активности есть свободные места"""
+        promoted = []
+        while True:
+            cursor = await db.execute(FREE_SLOTS_SQL, (activity_id,))
+            row = await cursor.fetchone()
+            free = row[0] if row else 0
+            if free <= 0:
+                return promoted
+            cursor = await db.execute(NEXT_WAITING_SQL, (activity_id, free))
+            waiting = await cursor.fetchall()
+            if not waiting:
+                return promoted
+            
+            for position, user_id in waiting:
+                cursor = await db.execute(VOTED_USERS_SQL.format(placeholders="?"), (user_id,))
+                if await cursor.fetchone():
+                    await db.execute(DELETE_WAITING_SQL, (position,))
+                    continue
+                await db.execute(RESERVE_SLOT_SQL, (activity_id,))
+                cursor = await db.execute(INSERT_VOTE_SQL, (user_id, activity_id))
+                voted_at = (await cursor.fetchone())[0]
+                await db.execute(PROMOTE_WAITING_SQL, (position,))
+                # Кэш переведенного держит процесс, который обслуживает его апдейты
+                await db.execute(INVALIDATE_USER_SQL, (user_id,))
+                promoted.append((activity_id, user_id, voted_at))
+
+    async def join_waitlist(self, requests: list) -> tuple:
+        async def join(db):
+            user_ids = list({user_id for _, user_id in requests})
+            placeholders = ", ".join("?" * len(user_ids))
+            cursor = await db.execute(VOTED_USERS_SQL.format(placeholders=placeholders), user_ids)
+            voted = {row[0] for row in await cursor.fetchall()}
+            
+            results = []
+            promoted = []
+            for activity_id, user_id in requests:
+                if user_id in voted:
+                    results.append((WaitlistResult.ALREADY_VOTED, None))
+                    continue
+                
+                cursor = await db.execute(USER_WAITLIST_SQL, (user_id,))
+                row = await cursor.fetchone()
+                if row is None or row[1] != activity_id:
+                    if row is not None:
+                        await db.execute(DELETE_WAITING_SQL, (row[0],))
+                    await db.execute(JOIN_WAITLIST_SQL, (activity_id, user_id))
+                
+                # Место могло освободиться, пока пользователь смотрел на старый список
+                moved = await self._promote(db, activity_id)
+                promoted += moved
+                voted.update(promoted_user for _, promoted_user, _ in moved)
+                if user_id in voted:
+                    # Пользователь узнает о записи из ответа, отдельное уведомление не нужно
+                    await db.execute(PROMOTION_NOTIFIED_SQL, (user_id,))
+                    results.append((WaitlistResult.PROMOTED, None))
+                    continue
+                cursor = await db.execute(WAITLIST_PLACE_SQL, (user_id,))
+                results.append((WaitlistResult.WAITING, (await cursor.fetchone())[1]))
+            await self._journal(db, journal_changes(promoted))
+            return results, promoted
+        
+        return await self._write(join, JOIN_WAITLIST_SQL)
+
+    async def leave_waitlist(self, user_id: int) -> bool:
+        async def leave(db):
+            cursor = await db.execute(LEAVE_WAITLIST_SQL, (user_id,))
+            return cursor.rowcount > 0
+        
+        return await self._write(leave, LEAVE_WAITLIST_SQL)
+
+    async def waitlist_place(self, user_id: int):
+        rows = await self._fetch_all(WAITLIST_PLACE_SQL, (user_id,))
+        return rows[0] if rows else None
+
+    async def waitlist_counts(self) -> list:
+        return await self._fetch_all(WAITLIST_COUNTS_SQL)
+
+    async def remove_vote(self, user_id: int) -> tuple:
+        async def remove(db):
+            cursor = await db.execute(DELETE_VOTE_SQL, (user_id,))
+            rows = await cursor.fetchall()
+            if not rows:
+                return None, []
+            await db.execute(INVALIDATE_USER_SQL, (user_id,))
+            promoted = []
+            for activity_id, in rows:
+                await db.execute(RELEASE_SLOT_SQL, (activity_id,))
+                promoted += await self._promote(db, activity_id)
+            await self._journal(db, [
+                *(journal_row("unvote", activity_id, user_id) for activity_id, in rows),
+                *journal_changes(promoted),
+            ])
+            return rows[0][0], promoted
+        
+        return await self._write(remove, DELETE_VOTE_SQL)
+
+    async def pending_promotions(self, limit: int) -> list:
+        return await self._fetch_all(PENDING_PROMOTIONS_SQL, (limit,))
+
+    async def mark_promotions_notified(self, user_ids: list):
+        async def delete(db):
+            await db.executemany(PROMOTION_NOTIFIED_SQL, [(user_id,) for user_id in user_ids])
+        
+        await self._write(delete, PROMOTION_NOTIFIED_SQL)
+
+    async def load_fsm_state(self, key: str):
+        rows = await self._fetch_all(FSM_LOAD_SQL, (key,))
+        return rows[0] if rows else None
+
+    async def save_fsm_states(self, rows: list):
+        async def save(db):
+            await db.executemany(FSM_SAVE_SQL, [
+                (key, state, data) for key, state, data in rows if state is not None or data != "{}"
+            ])
+            await db.executemany(FSM_DELETE_SQL, [
+                (key,) for key, state, data in rows if state is None and data == "{}"
+            ])
+        
+        await self._write(save, FSM_SAVE_SQL)
+
+    async def cache_changes(self, after_seq: int) -> tuple:
+        return await self._fetch_all(ACTIVITIES_SQL), await self._fetch_all(INVALIDATIONS_SQL, (after_seq,))
+
+    async def last_invalidation(self) -> int:
+        return (await self._fetch_all(LAST_INVALIDATION_SQL))[0][0]
+
+    async def save_cache_position(self, reader: str, seq: int, seen_at: float):
+        async def save(db):
+            await db.execute(SAVE_CACHE_POSITION_SQL, (reader, seq, seen_at))
+
+        await self._write(save, SAVE_CACHE_POSITION_SQL)
+
+    async def prune_invalidations(self, seen_after: float = None):
+        async def prune(db):
+            if seen_after is None:
+                await db.execute(PRUNE_ALL_INVALIDATIONS_SQL)
+            else:
+                await db.execute(FORGET_CACHE_READERS_SQL, (seen_after,))
+                await db.execute(PRUNE_INVALIDATIONS_SQL, (seen_after,))
+
+        await self._write(prune, PRUNE_INVALIDATIONS_SQL)
+
+    async def append_journal(self, rows: list):
+        async def append(db):
+            await db.executemany(APPEND_JOURNAL_SQL, rows)
+
+        await self._write(append, APPEND_JOURNAL_SQL)
+
+    async def journal_since(self, after_seq: int, limit: int) -> list:
+        return await self._fetch_all(JOURNAL_SINCE_SQL, (after_seq, limit))
+
+    async def journal_before(self, before_seq: int, limit: int) -> list:
+        return await self._fetch_all(JOURNAL_BEFORE_SQL, (before_seq, limit))
+
+    async def journal_snapshot(self) -> list:
+        return await self._fetch_all(JOURNAL_SNAPSHOT_SQL)
+
+    async def save_journal_snapshot(self, offset: int, rows: list) -> bool:
+        async def save(db):
+            cursor = await db.execute(JOURNAL_SNAPSHOT_OFFSET_SQL)
+            row = await cursor.fetchone()
+            if row is not None and row[0] >= offset:
+                return False
+            await db.execute(CLEAR_JOURNAL_SNAPSHOT_SQL)
+            await db.executemany(INSERT_JOURNAL_SNAPSHOT_SQL, [("offset", "", offset), *rows])
+            return True
+
+        return await self._write(save, INSERT_JOURNAL_SNAPSHOT_SQL)
+
+    async def _fetch_all(self, sql: str, params=()):
+        with leaf("sql", sql=sql):
+            async with self.pool.acquire() as db:
+                cursor = await db.execute(sql, params)
+                return await cursor.fetchall()
+    
+    async def _iterate(self, sql: str, params=(), chunk_size: int = EXPORT_CHUNK_SIZE):
+        """Построчно отдает результат запроса, читая его пачками по chunk_size"""
+        with leaf("sql.iterate", sql=sql):
+            async with self.pool.acquire() as db:
+                cursor = await db.execute(sql, params)
+                try:
+                    while True:
+                        rows = await cursor.fetchmany(chunk_size)
+                        if not rows:
+                            break
+                        for row in rows:
+                            yield row
+                finally:
+                    await cursor.close()
+
+    async def get_user_status(self, telegram_id: int):
+        rows = await self._fetch_all(USER_STATUS_SQL, (telegram_id,))
+        return rows[0] if rows else None
+
+    async def count_users(self) -> int:
+        rows = await self._fetch_all(TOTAL_USERS_SQL)
+        return rows[0][0] if rows else 0
+
+
+    async def users_page(self, direction: str, cursor, query: str, limit: int) -> list:
+        return await self._fetch_all(*users_page_query(direction, cursor, query, limit))
+
+    def iter_all_users(self, chunk_size: int):
+        return self._iterate(ALL_USERS_SQL, chunk_size=chunk_size)
+
+    def iter_votes_details(self, chunk_size: int):
+        return self._iterate(VOTES_DETAILS_SQL, chunk_size=chunk_size)
+
+    def iter_activity_participants(self, activity_id: int, chunk_size: int):
+        return self._iterate(ACTIVITY_PARTICIPANTS_SQL, (activity_id,), chunk_size=chunk_size)
+
+    def iter_roster(self, chunk_size: int):
+        return self._iterate(ROSTER_SQL, chunk_size=chunk_size)
+
+    def iter_users_without_vote(self, chunk_size: int):
+        return self._iterate(USERS_WITHOUT_VOTE_SQL, chunk_size=chunk_size)
+
+    async def create_broadcast(self, admin_id: int, target: str, text: str, chat_ids: list) -> int:
+        async def insert(db):
+            cursor = await db.execute(INSERT_BROADCAST_SQL, (admin_id, target, text))
+            broadcast_id = (await cursor.fetchone())[0]
+            await db.executemany(INSERT_RECIPIENT_SQL, [(broadcast_id, chat_id) for chat_id in chat_ids])
+            return broadcast_id
+        
+        return await self._write(insert, INSERT_BROADCAST_SQL)
+
+    async def unfinished_broadcasts(self) -> list:
+        return await self._fetch_all(UNFINISHED_BROADCASTS_SQL)
+
+    async def pending_recipients(self, broadcast_id: int, limit: int) -> list:
+        rows = await self._fetch_all(PENDING_RECIPIENTS_SQL, (broadcast_id, limit))
+        return [chat_id for chat_id, in rows]
+
+    async def mark_recipients(self, broadcast_id: int, results: list):
+        async def update(db):
+            await db.executemany(
+                MARK_RECIPIENT_SQL, [(status, broadcast_id, chat_id) for chat_id, status in results]
+            )
+        
+        await self._write(update, MARK_RECIPIENT_SQL)
+
+    async def broadcast_progress(self, broadcast_id: int) -> dict:
+        return dict(await self._fetch_all(BROADCAST_PROGRESS_SQL, (broadcast_id,)))
+
+    async def finish_broadcast(self, broadcast_id: int):
+        async def update(db):
+            await db.execute(FINISH_BROADCAST_SQL, (broadcast_id,))
+        
+        await self._write(update, FINISH_BROADCAST_SQL)
@@ -0,0 +1,326 @@
+"""Интерфейс хранилища бота и выбор реализации по DATABASE_URL.
+
+Database (database.py) держит кэши и очередь писателя и обращается к базе
+только через методы StorageBackend. Реализации:
+    sqlite:///votes.db           — sqlite_storage.SQLiteBackend
+    postgresql://user@host/db    — postgres_storage.PostgresBackend (asyncpg)
+
+Записи и снятия записей (бронь, перевод из листа ожидания, /unvote,
+исправление счетчика сверкой) реализации пишут в reservation_journal в той
+же транзакции, что и саму перемену, — строками из journal_row. Остальные
+события журнала (неудачные попытки) копит ReservationJournal.
+"""
+import time
+from dataclasses import dataclass, field
+from enum import Enum
+
+
+class ReserveResult(Enum):
+    """Результат попытки записи на активность"""
+    SUCCESS = "success"
+    FULL = "full"
+    ALREADY_VOTED = "already_voted"
+    BUSY = "busy"
+    # Активности нет в каталоге: кнопка из списка до перезагрузки каталога
+    NOT_FOUND = "not_found"
+
+
+class WaitlistResult(Enum):
+    """Результат попытки встать в лист ожидания"""
+    WAITING = "waiting"
+    PROMOTED = "promoted"
+    ALREADY_VOTED = "already_voted"
+    BUSY = "busy"
+    NOT_FOUND = "not_found"
+
+
+def journal_row(event: str, activity_id: int, user_id: int = None, result: str = "success", detail: str = None):
+    """Строка reservation_journal (at, event, activity_id, user_id, result, detail)"""
+    return time.time(), event, activity_id, user_id, result, detail
+
+
+def journal_changes(promoted=(), drift=()) -> list:
+    """Строки журнала о переводах [(activity_id, user_id, voted_at)] и исправлениях [(activity_id, было, стало)]"""
+    return [
+        *(journal_row("repair", activity_id, None, "fixed", f"{old} -> {new}") for activity_id, old, new in drift),
+        *(journal_row("promote", activity_id, user_id) for activity_id, user_id, _ in promoted),
+    ]
+
+
+class StorageBusyError(Exception):
+    """База не приняла запись за отведенное число повторов"""
+
+
+class CatalogError(ValueError):
+    """Каталог активностей нельзя применить"""
+
+
+@dataclass
+class CatalogDiff:
+    """Отличия нового каталога от таблицы activities"""
+    added: list = field(default_factory=list)
+    changed: list = field(default_factory=list)
+    removed: list = field(default_factory=list)
+    # (id, name, max_slots) добавленных и измененных — для одного пакетного upsert
+    upserts: list = field(default_factory=list)
+
+    def __bool__(self):
+        return bool(self.added or self.changed or self.removed)
+
+
+def diff_catalog(rows, activities: dict) -> CatalogDiff:
+    """Сравнивает каталог {id: {'name', 'max_slots'}} со строками [(id, name, max_slots, used_slots)].
+
+    Бросает CatalogError, если новый max_slots меньше занятых мест или
+    удаляется активность, на которую уже записаны.
+    """
+    current = {activity_id: (name, max_slots, used_slots) for activity_id, name, max_slots, used_slots in rows}
+    diff = CatalogDiff()
+    errors = []
+    for activity_id, data in activities.items():
+        name, max_slots = data['name'], data['max_slots']
+        if activity_id not in current:
+            diff.added.append(activity_id)
+            diff.upserts.append((activity_id, name, max_slots))
+            continue
+        old_name, old_max_slots, used_slots = current[activity_id]
+        if (name, max_slots) == (old_name, old_max_slots):
+            continue
+        if max_slots < used_slots:
+            errors.append(f"«{name}» (id {activity_id}): max_slots {max_slots} меньше занятых мест ({used_slots})")
+        diff.changed.append(activity_id)
+        diff.upserts.append((activity_id, name, max_slots))
+    for activity_id, (name, max_slots, used_slots) in current.items():
+        if activity_id in activities:
+            continue
+        if used_slots:
+            errors.append(f"«{name}» (id {activity_id}) нельзя удалить: записано {used_slots}")
+        diff.removed.append(activity_id)
+    if errors:
+        raise CatalogError("Каталог не применен:\n" + "\n".join(errors))
+    return diff
+
+
+class StorageBackend:
+    """Операции с базой, которые нужны Database.
+
+    Строки возвращаются кортежами в том же порядке столбцов, что и у SQLite,
+    время — строками 'YYYY-MM-DD HH:MM:SS' в UTC. Методы, которые меняют
+    votes и activities (sync_activities, reconcile_slots, reserve_batch,
+    join_waitlist, remove_vote), вызывает только ReservationWriter.
+
+    Лист ожидания: когда у активности появляются свободные места, эти методы
+    в той же транзакции записывают ожидающих по порядку и возвращают
+    переведенных [(activity_id, user_id, voted_at)]. Переведенные остаются
+    в листе с отметкой, пока их не уведомят (pending_promotions).
+    """
+
+    # База доступна другим экземплярам бота (не только процессам одного супервизора)
+    shared = False
+
+    async def open(self):
+        raise NotImplementedError
+
+    async def close(self):
+        raise NotImplementedError
+
+    async def migrate(self) -> list:
+        """Применяет недостающие миграции. Возвращает список примененных версий"""
+        raise NotImplementedError
+
+    async def claim_primary(self) -> bool:
+        """Берет или подтверждает роль ведущего среди экземпляров на этой базе.
+
+        Неразделяемой базой пользуется один экземпляр, и ведущего среди его
+        процессов выбирает WORKER_INDEX, поэтому по умолчанию — True.
+        """
+        return True
+
+    async def sync_activities(self, activities: dict) -> tuple:
+        """Приводит activities к каталогу {id: {'name', 'max_slots'}} одной транзакцией.
+
+        Сверяет used_slots с votes, как reconcile_slots, сравнивает каталог
+        с таблицей (diff_catalog), одним пакетом записывает добавленные и
+        измененные активности и удаляет пропавшие. Возвращает
+        ([(id, name, max_slots, used_slots)] по возрастанию id,
+        переведенные из листа ожидания, CatalogDiff, исправленные счетчики).
+        """
+        raise NotImplementedError
+
+    async def reconcile_slots(self) -> tuple:
+        """Сверяет счетчики used_slots с числом записей в votes и исправляет расхождения.
+
+        Освободившиеся места получают ожидающие. Возвращает
+        ([(id, name, max_slots, used_slots)] по возрастанию id, переведенные,
+        [(activity_id, было, стало)] исправленных счетчиков).
+        """
+        raise NotImplementedError
+
+    async def reserve_batch(self, requests: list) -> list:
+        """Решает заявки [(activity_id, user_id)] по порядку в одной транзакции.
+
+        Возвращает [(ReserveResult, voted_at или None)] в том же порядке.
+        """
+        raise NotImplementedError
+
+    async def register_user(self, telegram_id: int, username: str, full_name: str, phone: str = None) -> bool:
+        """Регистрирует или перезаписывает пользователя. True — пользователя еще не было"""
+        raise NotImplementedError
+
+    async def join_waitlist(self, requests: list) -> tuple:
+        """Решает заявки [(activity_id, user_id)] по порядку в одной транзакции.
+
+        Пользователь встает в конец очереди активности (из очереди другой
+        активности уходит). Возвращает ([(WaitlistResult, место в очереди или None)]
+        в том же порядке, переведенные).
+        """
+        raise NotImplementedError
+
+    async def leave_waitlist(self, user_id: int) -> bool:
+        """Убирает пользователя из очереди. False, если его там не было"""
+        raise NotImplementedError
+
+    async def waitlist_place(self, user_id: int):
+        """(activity_id, место в очереди) или None"""
+        raise NotImplementedError
+
+    async def waitlist_counts(self) -> list:
+        """[(activity_id, число ожидающих)]"""
+        raise NotImplementedError
+
+    async def remove_vote(self, user_id: int) -> tuple:
+        """Удаляет запись пользователя и освобождает место.
+
+        Возвращает (activity_id или None, если записи не было, переведенные).
+        """
+        raise NotImplementedError
+
+    async def pending_promotions(self, limit: int) -> list:
+        """До limit [(user_id, activity_id)] переведенных, которых еще не уведомили"""
+        raise NotImplementedError
+
+    async def mark_promotions_notified(self, user_ids: list):
+        raise NotImplementedError
+
+    async def load_fsm_state(self, key: str):
+        """(state или None, data в JSON) или None, если состояния нет"""
+        raise NotImplementedError
+
+    async def save_fsm_states(self, rows: list):
+        """Записывает [(key, state, data в JSON)] одной транзакцией; пустые состояния удаляет"""
+        raise NotImplementedError
+
+    async def cache_changes(self, after_seq: int) -> tuple:
+        """Состояние для сверки кэшей процесса с базой.
+
+        Возвращает ([(id, name, max_slots, used_slots)] по возрастанию id,
+        [(seq, user_id)] из журнала cache_invalidations после after_seq).
+        В журнал пишут remove_vote (сам пользователь) и перевод из листа
+        ожидания (переведенные) — в той же транзакции, в порядке коммита.
+        """
+        raise NotImplementedError
+
+    async def last_invalidation(self) -> int:
+        """Последний seq журнала cache_invalidations, 0 — журнал пуст"""
+        raise NotImplementedError
+
+    async def save_cache_position(self, reader: str, seq: int, seen_at: float):
+        """Запоминает последний seq журнала, который применил процесс reader, и время отметки"""
+        raise NotImplementedError
+
+    async def prune_invalidations(self, seen_after: float = None):
+        """Удаляет строки журнала, которые прочитали все процессы, отметившиеся не раньше seen_after.
+
+        Остальных процессов забывает; пока живых нет, журнал не трогает.
+        seen_after=None — журнал никто не читает, удаляется целиком.
+        """
+        raise NotImplementedError
+
+    async def append_journal(self, rows: list):
+        """Дописывает в reservation_journal [(at, event, activity_id, user_id, result, detail)].
+
+        Строки журнала не меняются и не удаляются; seq растет в порядке коммита.
+        """
+        raise NotImplementedError
+
+    async def journal_before(self, before_seq: int, limit: int) -> list:
+        """До limit строк журнала с seq не больше before_seq, от новых к старым"""
+        raise NotImplementedError
+
+    async def journal_snapshot(self) -> list:
+        """Сохраненная сводка журнала [(kind, key, value)] (см. journal.JournalStats)"""
+        raise NotImplementedError
+
+    async def save_journal_snapshot(self, offset: int, rows: list) -> bool:
+        """Заменяет сводку строками [(kind, key, value)], посчитанными до seq offset.
+
+        Сводку, посчитанную дальше offset другим процессом, не трогает и возвращает False.
+        """
+        raise NotImplementedError
+
+    async def journal_since(self, after_seq: int, limit: int) -> list:
+        """До limit [(seq, at, event, activity_id, user_id, result, detail)] журнала после after_seq"""
+        raise NotImplementedError
+
+    async def get_user_status(self, telegram_id: int):
+        """(название активности или None, время записи или None) либо None, если не зарегистрирован"""
+        raise NotImplementedError
+
+    async def count_users(self) -> int:
+        raise NotImplementedError
+
+    async def users_page(self, direction: str, cursor, query: str, limit: int) -> list:
+        """До limit + 1 строк пользователей в порядке обхода (см. Database.get_users_page)"""
+        raise NotImplementedError
+
+    def iter_all_users(self, chunk_size: int):
+        raise NotImplementedError
+
+    def iter_votes_details(self, chunk_size: int):
+        raise NotImplementedError
+
+    def iter_activity_participants(self, activity_id: int, chunk_size: int):
+        raise NotImplementedError
+
+    def iter_roster(self, chunk_size: int):
+        """(activity_id, name, max_slots, telegram_id, username, full_name, phone, voted_at) по всем
+        активностям в порядке id и времени записи; у активности без участников — одна строка
+        с None вместо участника"""
+        raise NotImplementedError
+
+    def iter_users_without_vote(self, chunk_size: int):
+        raise NotImplementedError
+
+    async def create_broadcast(self, admin_id: int, target: str, text: str, chat_ids: list) -> int:
+        """Сохраняет рассылку и ее получателей со статусом pending. Возвращает id"""
+        raise NotImplementedError
+
+    async def unfinished_broadcasts(self) -> list:
+        """[(id, admin_id, target, text)] незавершенных рассылок"""
+        raise NotImplementedError
+
+    async def pending_recipients(self, broadcast_id: int, limit: int) -> list:
+        """До limit chat_id, которым рассылка еще не отправлена"""
+        raise NotImplementedError
+
+    async def mark_recipients(self, broadcast_id: int, results: list):
+        """Записывает статусы [(chat_id, 'sent' | 'failed' | 'pending')]"""
+        raise NotImplementedError
+
+    async def broadcast_progress(self, broadcast_id: int) -> dict:
+        """{статус: число получателей}"""
+        raise NotImplementedError
+
+    async def finish_broadcast(self, broadcast_id: int):
+        raise NotImplementedError
+
+
+def create_backend(url: str) -> StorageBackend:
+    """Создает хранилище по DATABASE_URL"""
+    if url.startswith("sqlite:///"):
+        from sqlite_storage import SQLiteBackend
+        return SQLiteBackend(url[len("sqlite:///"):])
+    if url.startswith(("postgres://", "postgresql://")):
+        from postgres_storage import PostgresBackend
+        return PostgresBackend(url)
+    raise ValueError(f"Неподдерживаемый DATABASE_URL: {url}")
@@ -0,0 +1,10 @@
+"""Общие настройки тестов: модули бота лежат в корне репозитория, config требует BOT_TOKEN.
+
+Запуск: pip install -r requirements-dev.txt && python -m pytest -q
+"""
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.environ.setdefault("BOT_TOKEN", "1:test")
@@ -0,0 +1,288 @@
+"""Одни и те же сценарии для обоих хранилищ.
+
+SQLite проверяется всегда (временный файл). PostgreSQL — только если задан
+TEST_DATABASE_URL, например postgresql://postgres@localhost/bot_test; схема
+public этой базы перед каждым тестом пересоздается.
+"""
+import asyncio
+import os
+
+import pytest
+
+from postgres_storage import PostgresBackend
+from sqlite_storage import SQLiteBackend
+from storage import ReserveResult, WaitlistResult
+
+TEST_DATABASE_URL = os.getenv("TEST_DATABASE_URL")
+
+CATALOG = {
+    1: {"name": "Теннис", "max_slots": 2},
+    2: {"name": "Квиз", "max_slots": 5},
+}
+
+
+async def _reset_postgres(url: str):
+    import asyncpg
+
+    conn = await asyncpg.connect(url)
+    try:
+        await conn.execute("DROP SCHEMA public CASCADE; CREATE SCHEMA public;")
+    finally:
+        await conn.close()
+
+
+@pytest.fixture(params=["sqlite", "postgres"])
+def backend(request, tmp_path):
+    if request.param == "sqlite":
+        return SQLiteBackend(str(tmp_path / "votes.db"))
+    if not TEST_DATABASE_URL:
+        pytest.skip("TEST_DATABASE_URL не задан")
+    asyncio.run(_reset_postgres(TEST_DATABASE_URL))
+    return PostgresBackend(TEST_DATABASE_URL)
+
+
+def run(backend, scenario):
+    """Открывает хранилище, применяет миграции и каталог CATALOG и выполняет scenario(backend)"""
+    async def main():
+        await backend.open()
+        try:
+            await backend.migrate()
+            await backend.sync_activities(CATALOG)
+            return await scenario(backend)
+        finally:
+            await backend.close()
+
+    return asyncio.run(main())
+
+
+async def used_slots(backend) -> dict:
+    rows, _ = await backend.cache_changes(0)
+    return {activity_id: used for activity_id, name, max_slots, used in rows}
+
+
+async def register(backend, *user_ids):
+    for user_id in user_ids:
+        await backend.register_user(user_id, f"user{user_id}", f"Иван {user_id}", f"+7900{user_id}")
+
+
+def test_register_user_reports_new_users(backend):
+    async def scenario(backend):
+        assert await backend.register_user(10, "user10", "Иван", None) is True
+        assert await backend.register_user(10, "ivan", "Иван", "+7900") is False
+        assert await backend.count_users() == 1
+
+    run(backend, scenario)
+
+
+def test_reserve_batch_does_not_oversubscribe(backend):
+    async def scenario(backend):
+        await register(backend, 10, 11, 12)
+        decided = await backend.reserve_batch([(1, 10), (1, 11), (1, 12), (1, 10)])
+        assert [result for result, voted_at in decided] == [
+            ReserveResult.SUCCESS, ReserveResult.SUCCESS, ReserveResult.FULL, ReserveResult.ALREADY_VOTED,
+        ]
+        assert all(voted_at for result, voted_at in decided[:2])
+        assert await used_slots(backend) == {1: 2, 2: 0}
+
+    run(backend, scenario)
+
+
+def test_reserve_batch_already_voted_across_batches(backend):
+    async def scenario(backend):
+        await register(backend, 10)
+        assert (await backend.reserve_batch([(2, 10)]))[0][0] is ReserveResult.SUCCESS
+        assert (await backend.reserve_batch([(1, 10)]))[0][0] is ReserveResult.ALREADY_VOTED
+        assert await used_slots(backend) == {1: 0, 2: 1}
+        assert (await backend.get_user_status(10))[0] == "Квиз"
+
+    run(backend, scenario)
+
+
+def test_waitlist_promotion_on_remove_vote(backend):
+    async def scenario(backend):
+        await register(backend, 10, 11, 20, 21)
+        await backend.reserve_batch([(1, 10), (1, 11)])
+        decided, promoted = await backend.join_waitlist([(1, 20), (1, 21)])
+        assert decided == [(WaitlistResult.WAITING, 1), (WaitlistResult.WAITING, 2)]
+        assert promoted == []
+        assert await backend.waitlist_counts() == [(1, 2)]
+
+        activity_id, promoted = await backend.remove_vote(10)
+        assert activity_id == 1
+        assert [(activity, user) for activity, user, voted_at in promoted] == [(1, 20)]
+        assert await used_slots(backend) == {1: 2, 2: 0}
+        assert await backend.waitlist_place(21) == (1, 1)
+
+        assert await backend.pending_promotions(10) == [(20, 1)]
+        await backend.mark_promotions_notified([20])
+        assert await backend.pending_promotions(10) == []
+
+    run(backend, scenario)
+
+
+def test_join_waitlist_promotes_when_slot_is_free(backend):
+    async def scenario(backend):
+        await register(backend, 10)
+        decided, promoted = await backend.join_waitlist([(1, 10)])
+        assert decided == [(WaitlistResult.PROMOTED, None)]
+        assert [(activity, user) for activity, user, voted_at in promoted] == [(1, 10)]
+        # Пользователь узнал о записи из ответа — отдельного уведомления нет
+        assert await backend.pending_promotions(10) == []
+        assert await used_slots(backend) == {1: 1, 2: 0}
+
+    run(backend, scenario)
+
+
+def test_remove_vote(backend):
+    async def scenario(backend):
+        await register(backend, 10)
+        assert await backend.remove_vote(10) == (None, [])
+        await backend.reserve_batch([(2, 10)])
+        activity_id, promoted = await backend.remove_vote(10)
+        assert (activity_id, promoted) == (2, [])
+        assert await used_slots(backend) == {1: 0, 2: 0}
+        assert await backend.get_user_status(10) == (None, None)
+        # После удаления можно записаться снова
+        assert (await backend.reserve_batch([(1, 10)]))[0][0] is ReserveResult.SUCCESS
+
+    run(backend, scenario)
+
+
+def test_users_page_cursors(backend):
+    async def scenario(backend):
+        await register(backend, 1, 2, 3, 4, 5)
+
+        async def page(direction, cursor=None, query=None):
+            return [row[0] for row in await backend.users_page(direction, cursor, query, 2)]
+
+        rows = await backend.users_page("first", None, None, 2)
+        assert [row[0] for row in rows] == [1, 2, 3]
+        cursor = (rows[1][4], rows[1][0])
+        assert await page("next", cursor) == [3, 4, 5]
+        rows = await backend.users_page("next", cursor, None, 2)
+        assert await page("prev", (rows[0][4], rows[0][0])) == [2, 1]
+        assert await page("last") == [5, 4, 3]
+        assert await page("first", query="user4") == [4]
+        assert await page("first", query="+79003") == [3]
+
+    run(backend, scenario)
+
+
+def test_iter_exports(backend):
+    async def scenario(backend):
+        await register(backend, 10, 11, 12)
+        await backend.reserve_batch([(1, 10), (2, 11)])
+
+        async def collect(rows):
+            return [row async for row in rows]
+
+        assert [row[0] for row in await collect(backend.iter_all_users(2))] == [10, 11, 12]
+        details = await collect(backend.iter_votes_details(1))
+        assert [(row[0], row[4]) for row in details] == [(10, "Теннис"), (11, "Квиз")]
+        assert [row[0] for row in await collect(backend.iter_activity_participants(2, 2))] == [11]
+        assert [row[0] for row in await collect(backend.iter_users_without_vote(2))] == [12]
+
+        roster = await collect(backend.iter_roster(1))
+        assert [(row[0], row[1], row[2], row[3]) for row in roster] == [(1, "Теннис", 2, 10), (2, "Квиз", 5, 11)]
+
+        await backend.sync_activities({**CATALOG, 3: {"name": "Мафия", "max_slots": 15}})
+        roster = await collect(backend.iter_roster(2))
+        assert roster[-1][:4] == (3, "Мафия", 15, None)
+
+    run(backend, scenario)
+
+
+def test_broadcast_recipients(backend):
+    async def scenario(backend):
+        broadcast_id = await backend.create_broadcast(1, "all", "Текст", [10, 11, 12])
+        assert await backend.unfinished_broadcasts() == [(broadcast_id, 1, "all", "Текст")]
+        assert await backend.pending_recipients(broadcast_id, 10) == [10, 11, 12]
+        await backend.mark_recipients(broadcast_id, [(10, "sent"), (11, "failed")])
+        assert await backend.pending_recipients(broadcast_id, 10) == [12]
+        assert await backend.broadcast_progress(broadcast_id) == {"sent": 1, "failed": 1, "pending": 1}
+        await backend.finish_broadcast(broadcast_id)
+        assert await backend.unfinished_broadcasts() == []
+
+    run(backend, scenario)
+
+
+def test_prune_invalidations_waits_for_slowest_live_reader(backend):
+    async def scenario(backend):
+        await register(backend, 10, 11)
+        await backend.reserve_batch([(2, 10), (2, 11)])
+        await backend.remove_vote(10)
+        await backend.remove_vote(11)
+        _, invalidations = await backend.cache_changes(0)
+        first, last = invalidations[0][0], invalidations[-1][0]
+
+        # Пока ни один процесс не отметился, журнал не трогаем
+        await backend.prune_invalidations(100.0)
+        assert (await backend.cache_changes(0))[1] == invalidations
+
+        # Экземпляры на общей базе различаются именем, а не номером обработчика
+        await backend.save_cache_position("host-a:1/0", last, 200.0)
+        await backend.save_cache_position("host-b:1/0", first, 200.0)
+        await backend.prune_invalidations(100.0)
+        assert (await backend.cache_changes(0))[1] == invalidations[1:]
+
+        # Давно не отмечавшийся процесс журнал больше не ждет
+        await backend.save_cache_position("host-a:1/0", last, 400.0)
+        await backend.prune_invalidations(300.0)
+        assert (await backend.cache_changes(0))[1] == []
+
+        await backend.prune_invalidations()
+        assert (await backend.cache_changes(0))[1] == []
+
+    run(backend, scenario)
+
+
+def test_claim_primary_single_holder(backend):
+    async def scenario(backend):
+        if not backend.shared:
+            assert await backend.claim_primary()
+            return
+        other = PostgresBackend(TEST_DATABASE_URL)
+        await other.open()
+        try:
+            assert await backend.claim_primary()
+            assert not await other.claim_primary()
+            # Блокировка остается у первого, пока жива его сессия
+            assert await backend.claim_primary()
+            # Сессия ведущего оборвалась — роль переходит к другому
+            await backend._lock_conn.close()
+            assert await other.claim_primary()
+            assert not await backend.claim_primary()
+        finally:
+            await other.close()
+
+    run(backend, scenario)
+
+
+def test_vote_changes_are_journaled_in_their_transaction(backend):
+    async def scenario(backend):
+        await register(backend, 10, 11, 12)
+        await backend.reserve_batch([(1, 10), (1, 11), (1, 12)])
+        await backend.join_waitlist([(1, 12)])
+        await backend.remove_vote(10)
+
+        rows = await backend.journal_since(0, 100)
+        assert [(event, activity_id, user_id, result) for _, _, event, activity_id, user_id, result, _ in rows] == [
+            ("reserve", 1, 10, "success"),
+            ("reserve", 1, 11, "success"),
+            ("unvote", 1, 10, "success"),
+            ("promote", 1, 12, "success"),
+        ]
+        assert [row[0] for row in await backend.journal_before(rows[-1][0], 2)] == [rows[-1][0], rows[-2][0]]
+
+    run(backend, scenario)
+
+
+def test_journal_snapshot_keeps_the_newest(backend):
+    async def scenario(backend):
+        assert await backend.journal_snapshot() == []
+        assert await backend.save_journal_snapshot(5, [("votes", "1", 2), ("repairs", "", 0)])
+        # Другой процесс посчитал сводку до более раннего seq — ее не сохраняем
+        assert not await backend.save_journal_snapshot(3, [("votes", "1", 1)])
+        assert sorted(await backend.journal_snapshot()) == [("offset", "", 5), ("repairs", "", 0), ("votes", "1", 2)]
+
+    run(backend, scenario)
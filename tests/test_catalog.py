@@ -0,0 +1,47 @@
+"""Каталог активностей: текущий — снимок в Database.activities, config.ACTIVITIES не меняется"""
+import asyncio
+
+from catalog import describe_diff
+from config import ACTIVITIES
+from database import Database
+from storage import ReserveResult, WaitlistResult
+
+
+def test_catalog_snapshot_is_replaced_not_mutated(tmp_path):
+    default = {activity_id: dict(activity) for activity_id, activity in ACTIVITIES.items()}
+
+    async def scenario():
+        db = Database(str(tmp_path / "votes.db"))
+        await db.init_db({1: {"name": "Квиз", "max_slots": 5}})
+        try:
+            before = db.activities
+            assert before == {1: {"name": "Квиз", "max_slots": 5}}
+
+            diff = await db.update_activities({1: {"name": "Квиз", "max_slots": 5}, 2: {"name": "Мафия", "max_slots": 15}})
+            assert describe_diff(diff, db.activities) == "➕ Добавлены: Мафия"
+            # Старый снимок остался прежним: его можно было читать во время await
+            assert before == {1: {"name": "Квиз", "max_slots": 5}}
+            assert db.activities[2] == {"name": "Мафия", "max_slots": 15}
+        finally:
+            await db.close()
+
+    asyncio.run(scenario())
+    assert ACTIVITIES == default
+
+
+def test_vote_for_removed_activity(tmp_path):
+    async def scenario():
+        db = Database(str(tmp_path / "votes.db"))
+        await db.init_db({1: {"name": "Квиз", "max_slots": 5}, 2: {"name": "Мафия", "max_slots": 15}})
+        try:
+            await db.register_user(10, "user10", "Иван")
+            await db.update_activities({1: {"name": "Квиз", "max_slots": 5}})
+            # Кнопки vote_2 и full_2 остались в списке, отправленном до перезагрузки
+            assert await db.try_reserve_slot(2, 10) is ReserveResult.NOT_FOUND
+            assert await db.join_waitlist(2, 10) == (WaitlistResult.NOT_FOUND, None)
+            assert not await db.has_user_voted(10)
+            assert await db.get_waitlist_place(10) is None
+        finally:
+            await db.close()
+
+    asyncio.run(scenario())
@@ -0,0 +1,89 @@
+"""Сводка записей по журналу: записи журналируются в своей транзакции, сводка переживает перезапуск"""
+import asyncio
+import sqlite3
+
+from database import Database
+from journal import JournalStats
+from storage import ReserveResult
+
+CATALOG = {1: {"name": "Теннис", "max_slots": 1}, 2: {"name": "Квиз", "max_slots": 5}}
+
+
+def run(tmp_path, scenario):
+    async def main():
+        db = Database(str(tmp_path / "votes.db"))
+        await db.init_db(CATALOG)
+        try:
+            for user_id in (10, 11, 12):
+                await db.register_user(user_id, f"user{user_id}", f"Иван {user_id}")
+            await scenario(db)
+        finally:
+            await db.close()
+
+    asyncio.run(main())
+
+
+def test_votes_survive_lost_buffer(tmp_path):
+    async def scenario(db):
+        stats = JournalStats(db, interval=0)
+        assert await db.try_reserve_slot(1, 10) is ReserveResult.SUCCESS
+        assert await db.try_reserve_slot(1, 11) is ReserveResult.FULL
+        # Аварийная остановка: буфер неудачных попыток пропал, бронь уже в журнале
+        db.journal._rows.clear()
+
+        assert await stats.vote_summary() == {1: (1, 1)}
+        assert stats.attempts == {("reserve", "success"): 1}
+
+        await db.join_waitlist(1, 11)
+        await db.remove_vote(10)
+        await db.journal.flush()
+        assert await stats.vote_summary() == {1: (1, 1)}
+        assert stats.attempts == {("reserve", "success"): 1, ("waitlist", "waiting"): 1}
+
+    run(tmp_path, scenario)
+
+
+def test_restart_continues_from_snapshot(tmp_path):
+    async def scenario(db):
+        stats = JournalStats(db, interval=0)
+        await db.try_reserve_slot(1, 10)
+        await db.try_reserve_slot(2, 11)
+        await db.journal.flush()
+        summary = await stats.vote_summary()
+        assert summary == {1: (1, 1), 2: (1, 1)}
+
+        read_from = []
+        read_journal = db.read_journal
+
+        async def reading(after_seq, limit):
+            read_from.append(after_seq)
+            return await read_journal(after_seq, limit)
+
+        db.read_journal = reading
+        restarted = JournalStats(db, interval=0)
+        assert await restarted.vote_summary() == summary
+        assert restarted.attempts == stats.attempts
+        # Журнал читается с места сводки, а не с начала
+        assert read_from == [stats.offset]
+
+    run(tmp_path, scenario)
+
+
+def test_repair_rebases_votes_changed_outside_bot(tmp_path):
+    async def scenario(db):
+        stats = JournalStats(db, interval=0)
+        await db.try_reserve_slot(2, 10)
+        await db.try_reserve_slot(2, 11)
+        assert await stats.vote_summary() == {2: (2, 2)}
+
+        # Ручная правка базы мимо бота
+        conn = sqlite3.connect(db.backend.db_path)
+        conn.execute("DELETE FROM votes WHERE user_id = 11")
+        conn.commit()
+        conn.close()
+        drift, promoted = await db.reconcile_slots()
+        assert drift == [(2, 2, 1)]
+        assert await stats.vote_summary() == {2: (1, 1)}
+        assert stats.repairs == 1
+
+    run(tmp_path, scenario)
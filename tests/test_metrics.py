@@ -0,0 +1,20 @@
+"""Замеры методов Database: каждый вызов снаружи считается один раз"""
+import asyncio
+
+from database import Database
+from metrics import DB_METHOD_SECONDS
+
+
+def test_wrapper_methods_are_observed_once(tmp_path):
+    async def scenario():
+        db = Database(str(tmp_path / "votes.db"))
+        await db.init_db({1: {"name": "Квиз", "max_slots": 5}})
+        try:
+            before = {name: DB_METHOD_SECONDS.count(name) for name in ("is_user_registered", "get_user_status")}
+            await db.is_user_registered(1)
+            assert DB_METHOD_SECONDS.count("is_user_registered") == before["is_user_registered"] + 1
+            assert DB_METHOD_SECONDS.count("get_user_status") == before["get_user_status"]
+        finally:
+            await db.close()
+
+    asyncio.run(scenario())
@@ -0,0 +1,39 @@
+"""Планы запросов SQLite на последней версии схемы: индексы и сортировка без временного B-дерева"""
+import asyncio
+
+import pytest
+
+from migrations import MIGRATIONS, find_plan_problems, get_schema_version, migrate
+from sqlite_storage import ConnectionPool, query_plan_checks
+
+
+async def _plan_problems(db_path: str) -> tuple:
+    pool = ConnectionPool(db_path, size=1)
+    await pool.open()
+    try:
+        await migrate(pool)
+        async with pool.acquire() as db:
+            return await get_schema_version(db), await find_plan_problems(db, query_plan_checks())
+    finally:
+        await pool.close()
+
+
+@pytest.fixture(scope="module")
+def plan_result(tmp_path_factory):
+    return asyncio.run(_plan_problems(str(tmp_path_factory.mktemp("plans") / "votes.db")))
+
+
+def test_migrated_to_latest_schema(plan_result):
+    version, _ = plan_result
+    assert version == MIGRATIONS[-1][0]
+
+
+@pytest.mark.parametrize("name", [name for name, sql, params in query_plan_checks()])
+def test_query_plan_uses_indexes(plan_result, name):
+    _, problems = plan_result
+    assert [detail for problem, detail in problems if problem == name] == []
+
+
+def test_no_plan_problems(plan_result):
+    _, problems = plan_result
+    assert problems == []
@@ -0,0 +1,40 @@
+"""Текст «📊 Статистика» собирается заново только при изменении мест или числа пользователей"""
+import asyncio
+
+from database import Database
+from render import get_statistics_text
+
+
+def test_statistics_text_is_cached(tmp_path):
+    async def scenario():
+        db = Database(str(tmp_path / "votes.db"))
+        await db.init_db({1: {"name": "Квиз", "max_slots": 5}})
+        counted = []
+        count_users = db.backend.count_users
+
+        async def counting():
+            counted.append(1)
+            return await count_users()
+
+        db.backend.count_users = counting
+        try:
+            await db.register_user(10, "user10", "Иван")
+            text = await get_statistics_text(db)
+            assert text.endswith("пользователей:</b> 1")
+            assert await get_statistics_text(db) is text
+
+            await db.register_user(11, "user11", "Петр")
+            # Повторная регистрация не добавляет пользователя
+            await db.register_user(11, "user11", "Петр")
+            text = await get_statistics_text(db)
+            assert text.endswith("пользователей:</b> 2")
+            assert await get_statistics_text(db) is text
+            assert len(counted) == 1
+
+            await db.sync_caches()
+            assert len(counted) == 2
+            assert await get_statistics_text(db) is text
+        finally:
+            await db.close()
+
+    asyncio.run(scenario())
@@ -0,0 +1,52 @@
+"""Выбор ведущего процесса для задач в одном экземпляре на всю базу"""
+import asyncio
+
+from workers import PrimaryElection
+
+
+class FakeBackend:
+    shared = True
+
+
+class FakeDatabase:
+    def __init__(self, answers):
+        self.backend = FakeBackend()
+        self.answers = list(answers)
+
+    async def claim_primary(self):
+        answer = self.answers.pop(0)
+        if isinstance(answer, Exception):
+            raise answer
+        return answer
+
+
+def test_election_starts_and_stops_primary_jobs():
+    events = []
+
+    async def elected():
+        events.append("elected")
+
+    async def lost():
+        events.append("lost")
+
+    async def scenario():
+        db = FakeDatabase([False, True, True, ConnectionError("сессия оборвалась"), True])
+        election = PrimaryElection(db, elected, lost, interval=0)
+        await election.start()
+        assert not election.is_primary
+        for _ in range(4):
+            await election._claim()
+        assert election.is_primary
+
+    asyncio.run(scenario())
+    assert events == ["elected", "lost", "elected"]
+
+
+def test_only_candidate_claims():
+    async def scenario():
+        db = FakeDatabase([])
+        election = PrimaryElection(db, None, None, candidate=False)
+        await election.start()
+        assert not election.is_primary
+
+    asyncio.run(scenario())
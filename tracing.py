@@ -0,0 +1,208 @@
+"""Трассировка медленных апдейтов и профилировщик по запросу.
+
+При TRACE_ENABLED каждый апдейт получает дерево спанов: обработчик,
+вызовы Database (вместе с SQL-запросами хранилища) и запросы к Bot API.
+Апдейты дольше TRACE_SLOW_MS пишутся в лог одной JSON-строкой.
+
+Спаны привязаны к задаче через contextvars: вне трассируемого апдейта
+(например, в задаче ReservationWriter, которая пишет пачки сразу за многих
+пользователей) span() ничего не делает.
+
+Profiler — сэмплирующий профилировщик главного потока в формате collapsed
+stacks (по строке «кадр;кадр;кадр число» на стек), который понимают
+flamegraph.pl и speedscope.
+"""
+import functools
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from aiogram import BaseMiddleware
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+
+from config import TRACE_ENABLED, TRACE_SLOW_MS, PROFILE_INTERVAL_MS
+
+logger = logging.getLogger(__name__)
+
+# Длинные SQL в логе обрезаем
+MAX_ATTR_LENGTH = 300
+
+_current_span = ContextVar("current_span", default=None)
+
+
+class Span:
+    __slots__ = ("name", "attrs", "started", "finished", "children")
+
+    def __init__(self, name: str, attrs: dict):
+        self.name = name
+        self.attrs = attrs
+        self.started = time.perf_counter()
+        self.finished = None
+        self.children = []
+
+    @property
+    def duration(self) -> float:
+        return (self.finished or time.perf_counter()) - self.started
+
+    def to_dict(self, origin: float) -> dict:
+        data = {
+            "name": self.name,
+            "start_ms": round((self.started - origin) * 1000, 2),
+            "ms": round(self.duration * 1000, 2),
+        }
+        if self.attrs:
+            data["attrs"] = self.attrs
+        if self.children:
+            data["children"] = [child.to_dict(origin) for child in self.children]
+        return data
+
+
+def _clean_attrs(attrs: dict) -> dict:
+    cleaned = {}
+    for key, value in attrs.items():
+        if value is None:
+            continue
+        if isinstance(value, str):
+            value = " ".join(value.split())
+            if len(value) > MAX_ATTR_LENGTH:
+                value = value[:MAX_ATTR_LENGTH] + "…"
+        cleaned[key] = value
+    return cleaned
+
+
+@contextmanager
+def span(name: str, **attrs):
+    """Дочерний спан текущего; без активной трассировки ничего не делает"""
+    parent = _current_span.get()
+    if parent is None:
+        yield None
+        return
+
+    child = Span(name, _clean_attrs(attrs))
+    parent.children.append(child)
+    token = _current_span.set(child)
+    try:
+        yield child
+    except BaseException as e:
+        child.attrs["error"] = type(e).__name__
+        raise
+    finally:
+        child.finished = time.perf_counter()
+        _current_span.reset(token)
+
+
+@contextmanager
+def leaf(name: str, **attrs):
+    """Спан без вложенных: не становится текущим, поэтому годится внутри асинхронных генераторов"""
+    parent = _current_span.get()
+    if parent is None:
+        yield None
+        return
+
+    child = Span(name, _clean_attrs(attrs))
+    parent.children.append(child)
+    try:
+        yield child
+    finally:
+        child.finished = time.perf_counter()
+
+
+def traced(func):
+    """Декоратор корутины: вызов становится спаном апдейта с именем func.__qualname__"""
+    name = func.__qualname__
+
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        with span(name):
+            return await func(*args, **kwargs)
+    return wrapper
+
+
+class TracingMiddleware(BaseMiddleware):
+    """Внешняя middleware апдейтов: корневой спан и лог медленных апдейтов"""
+
+    def __init__(self, slow_ms: float = TRACE_SLOW_MS):
+        self.slow_ms = slow_ms
+
+    async def __call__(self, handler, event, data):
+        root = Span("update", {"update_id": event.update_id, "type": event.event_type})
+        token = _current_span.set(root)
+        try:
+            return await handler(event, data)
+        finally:
+            root.finished = time.perf_counter()
+            _current_span.reset(token)
+            duration_ms = root.duration * 1000
+            if duration_ms >= self.slow_ms:
+                logger.warning(json.dumps(
+                    {"slow_update": root.to_dict(root.started), "threshold_ms": self.slow_ms},
+                    ensure_ascii=False, default=str,
+                ))
+
+
+class HandlerTracingMiddleware(BaseMiddleware):
+    """Внутренняя middleware наблюдателей: спан выбранного обработчика"""
+
+    async def __call__(self, handler, event, data):
+        handler_object = data.get("handler")
+        name = getattr(getattr(handler_object, "callback", None), "__name__", "unknown")
+        with span(f"handler.{name}"):
+            return await handler(event, data)
+
+
+class TracingRequestMiddleware(BaseRequestMiddleware):
+    """Middleware сессии бота: спан на каждый запрос к Bot API"""
+
+    async def __call__(self, make_request, bot, method):
+        with span(f"api.{type(method).__name__}", chat_id=getattr(method, "chat_id", None)):
+            return await make_request(bot, method)
+
+
+def setup_tracing(dp, session):
+    """Подключает трассировку к диспетчеру и сессии бота, если она включена"""
+    if not TRACE_ENABLED:
+        return False
+    dp.update.outer_middleware(TracingMiddleware())
+    dp.message.middleware(HandlerTracingMiddleware())
+    dp.callback_query.middleware(HandlerTracingMiddleware())
+    session.middleware(TracingRequestMiddleware())
+    return True
+
+
+class Profiler:
+    """Сэмплирующий профилировщик потока: раз в interval снимает его стек"""
+
+    def __init__(self, thread_id: int = None, interval: float = PROFILE_INTERVAL_MS / 1000):
+        self.thread_id = thread_id or threading.main_thread().ident
+        self.interval = interval
+        self.stacks = Counter()
+        self.samples = 0
+
+    @staticmethod
+    def _frame_label(frame) -> str:
+        code = frame.f_code
+        return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})".replace(";", ":")
+
+    def run(self, seconds: float):
+        """Собирает сэмплы seconds секунд. Вызывать из отдельного потока"""
+        deadline = time.monotonic() + seconds
+        while time.monotonic() < deadline:
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is not None:
+                stack = []
+                while frame is not None:
+                    stack.append(self._frame_label(frame))
+                    frame = frame.f_back
+                self.stacks[";".join(reversed(stack))] += 1
+                self.samples += 1
+            time.sleep(self.interval)
+
+    def collapsed(self) -> str:
+        """Стеки в формате collapsed, самые частые первыми"""
+        return "".join(f"{stack} {count}\n" for stack, count in self.stacks.most_common())
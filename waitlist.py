@@ -0,0 +1,95 @@
+"""Уведомления о переводе из листа ожидания.
+
+Перевод делает база в той же транзакции, в которой освободилось место
+(см. StorageBackend), и оставляет переведенного в листе с отметкой.
+WaitlistNotifier просыпается по Database.promotions_pending (а на случай
+переводов другим процессом — раз в WAITLIST_POLL_INTERVAL секунд),
+отправляет каждому переведенному одно сообщение и снимает отметку.
+После перезапуска неотправленные уведомления уходят при первом проходе.
+"""
+import asyncio
+import logging
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramAPIError, TelegramNetworkError, TelegramRetryAfter
+
+from config import WAITLIST_NOTIFY_CHUNK, WAITLIST_POLL_INTERVAL
+
+logger = logging.getLogger(__name__)
+
+
+class WaitlistNotifier:
+    """Фоновая задача, которая уведомляет переведенных из листа ожидания"""
+
+    def __init__(self, bot: Bot, db, chunk_size: int = WAITLIST_NOTIFY_CHUNK,
+                 poll_interval: float = WAITLIST_POLL_INTERVAL):
+        self.bot = bot
+        self.db = db
+        self.chunk_size = chunk_size
+        self.poll_interval = poll_interval
+        self._task = None
+        # Счетчик для наблюдения
+        self.notified = 0
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+    async def _run(self):
+        event = self.db.promotions_pending
+        while True:
+            event.clear()
+            try:
+                await self.flush()
+            except Exception:
+                logger.exception("Ошибка при уведомлении из листа ожидания")
+            try:
+                await asyncio.wait_for(event.wait(), self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+
+    async def flush(self):
+        """Уведомляет всех переведенных, которых еще не уведомили"""
+        names = {activity_id: name for activity_id, name, *_ in await self.db.get_activities()}
+        while True:
+            pending = await self.db.get_pending_promotions(self.chunk_size)
+            if not pending:
+                return
+            results = await asyncio.gather(*(
+                self._send(user_id, names.get(activity_id, "активность")) for user_id, activity_id in pending
+            ))
+            done = [user_id for (user_id, _), sent in zip(pending, results) if sent is not None]
+            if done:
+                await self.db.mark_promotions_notified(done)
+            if len(done) < len(pending):
+                # Остальные попробуем в следующий проход
+                return
+
+    async def _send(self, user_id: int, activity_name: str):
+        """True — отправлено, False — не доставить никогда, None — повторить позже"""
+        try:
+            await self.bot.send_message(
+                user_id,
+                "🎉 <b>Освободилось место!</b>\n\n"
+                f"Вы были в листе ожидания и теперь записаны на активность: <b>{activity_name}</b>\n\n"
+                "Ждем вас на активности!",
+            )
+        except (TelegramRetryAfter, TelegramNetworkError) as e:
+            logger.warning(f"Уведомление из листа ожидания для {user_id} отложено: {e}")
+            return None
+        except TelegramAPIError as e:
+            # Бот заблокирован или чат не найден — запись сделана, сообщить некому
+            logger.info(f"Уведомление из листа ожидания для {user_id} не доставлено: {e}")
+            return False
+        self.notified += 1
+        return True
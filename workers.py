@@ -0,0 +1,382 @@
+"""Несколько процессов-обработчиков апдейтов.
+
+При WORKERS > 1 процесс bot.py становится супервизором: сам получает
+апдейты (getUpdates или вебхук) и раздает их процессам-обработчикам по
+from_user.id % WORKERS, поэтому все апдейты пользователя и его состояние
+FSM остаются в одном процессе. Обработчик — обычный бот со своим циклом
+событий, пулом соединений к базе и кэшами.
+
+Согласованность между процессами:
+- места бронирует база: условный UPDATE used_slots < max_slots в транзакции
+  (SQLite — BEGIN IMMEDIATE, Postgres — блокировка строки), поэтому
+  переполнения нет при любом числе процессов; таблица мест в памяти только
+  отсекает заведомо полные активности;
+- CacheSync раз в CACHE_SYNC_INTERVAL секунд заменяет таблицу мест строками
+  из базы и сбрасывает из кэша пользователей, чью запись изменил другой
+  процесс (журнал cache_invalidations, см. Database.sync_caches). Свою
+  позицию в журнале каждый процесс сохраняет в cache_readers под
+  CACHE_READER_ID, и журнал чистится только до позиции самого отстающего
+  из отметившихся за последние CACHE_READER_TTL секунд;
+- задачи, которым нужен один экземпляр (досылка рассылок, уведомления из
+  листа ожидания, слежение за каталогом, сверка мест, чистка журнала),
+  выполняет ведущий процесс (PrimaryElection): обработчик 0, а на общей
+  базе с несколькими экземплярами бота — тот, кто держит блокировку в базе.
+
+Запуск: сначала обработчик 0 (он применяет миграции и каталог), затем
+остальные; апдейты супервизор начинает получать, когда готовы все.
+Остановка: супервизор перестает получать апдейты, обработчики дорабатывают
+все полученные и выключаются штатно. Упавший обработчик перезапускается
+и продолжает с апдейтов, ждавших в его очереди.
+"""
+import asyncio
+import hmac
+import logging
+import multiprocessing
+import os
+import queue as queue_module
+import threading
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramAPIError
+from aiohttp import web
+
+from config import CACHE_READER_ID, CACHE_SYNC_INTERVAL, SHUTDOWN_TIMEOUT, WORKER_START_TIMEOUT, WORKERS
+
+logger = logging.getLogger(__name__)
+
+# Таймаут long polling getUpdates в супервизоре (секунды)
+POLLING_TIMEOUT = 30
+# Как часто чистить прочитанные строки журнала cache_invalidations (секунды)
+INVALIDATIONS_PRUNE_INTERVAL = 600
+# Процесс, не отмечавшийся в cache_readers столько секунд, считается остановленным
+# и журнал его не ждет; живой отмечается хотя бы раз в треть этого срока
+CACHE_READER_TTL = 60
+# Как часто кандидаты пробуют стать ведущим, а ведущий проверяет блокировку (секунды)
+PRIMARY_CLAIM_INTERVAL = 5
+
+
+def shard_for(update: dict, workers: int) -> int:
+    """Номер обработчика для апдейта Bot API в виде словаря из JSON.
+
+    Апдейты одного пользователя всегда попадают в один процесс; апдейты
+    без пользователя (посты каналов) — по чату, остальные — в обработчик 0.
+    """
+    for key, event in update.items():
+        if key == "update_id" or not isinstance(event, dict):
+            continue
+        user = event.get("from") or event.get("user")
+        if user:
+            return user["id"] % workers
+        chat = event.get("chat") or (event.get("message") or {}).get("chat")
+        if chat:
+            return chat["id"] % workers
+    return 0
+
+
+class Supervisor:
+    """Запускает процессы-обработчики и раздает им апдейты.
+
+    target(queue, ready) — точка входа обработчика (bot.worker_main): берет
+    апдейты из queue до None и взводит ready, когда готов их принимать.
+    Номер обработчика он получает в переменной окружения WORKER_INDEX.
+    """
+
+    def __init__(self, target, workers: int = WORKERS, start_timeout: float = WORKER_START_TIMEOUT,
+                 stop_timeout: float = SHUTDOWN_TIMEOUT + 5):
+        self.target = target
+        self.workers = workers
+        self.start_timeout = start_timeout
+        self.stop_timeout = stop_timeout
+        # spawn: обработчик начинает с чистого интерпретатора и читает конфиг заново
+        self._context = multiprocessing.get_context("spawn")
+        self._queues = [self._context.Queue() for _ in range(workers)]
+        self._processes = [None] * workers
+        self._ready = [None] * workers
+        self._monitor = None
+        # Счетчики для наблюдения
+        self.dispatched = [0] * workers
+        self.restarts = 0
+
+    def _spawn(self, index: int):
+        ready = self._context.Event()
+        # Процесс получает копию окружения в момент запуска
+        os.environ["WORKER_INDEX"] = str(index)
+        try:
+            process = self._context.Process(
+                target=self.target, args=(self._queues[index], ready), name=f"bot-worker-{index}",
+            )
+            process.start()
+        finally:
+            del os.environ["WORKER_INDEX"]
+        self._processes[index] = process
+        self._ready[index] = ready
+
+    async def _wait_ready(self, index: int):
+        loop = asyncio.get_running_loop()
+        process, ready = self._processes[index], self._ready[index]
+        deadline = loop.time() + self.start_timeout
+        while not await loop.run_in_executor(None, ready.wait, 0.5):
+            if not process.is_alive():
+                raise RuntimeError(f"Обработчик {index} завершился при запуске с кодом {process.exitcode}")
+            if loop.time() > deadline:
+                raise RuntimeError(f"Обработчик {index} не запустился за {self.start_timeout:.0f} c")
+
+    async def start(self):
+        """Запускает обработчики и ждет готовности всех"""
+        # Обработчик 0 применяет миграции и каталог до того, как к базе придут остальные
+        self._spawn(0)
+        await self._wait_ready(0)
+        for index in range(1, self.workers):
+            self._spawn(index)
+        await asyncio.gather(*(self._wait_ready(index) for index in range(1, self.workers)))
+        self._monitor = asyncio.create_task(self._watch())
+        logger.info(f"Запущено обработчиков: {self.workers}")
+
+    async def stop(self):
+        """Останавливает обработчики: каждый дорабатывает полученные апдейты"""
+        if self._monitor is not None:
+            self._monitor.cancel()
+            try:
+                await self._monitor
+            except asyncio.CancelledError:
+                pass
+            self._monitor = None
+
+        loop = asyncio.get_running_loop()
+        for queue in self._queues:
+            queue.put(None)
+        deadline = loop.time() + self.stop_timeout
+        for index, process in enumerate(self._processes):
+            if process is None:
+                continue
+            await loop.run_in_executor(None, process.join, max(0.0, deadline - loop.time()))
+            if process.is_alive():
+                logger.warning(f"Обработчик {index} не остановился за {self.stop_timeout:.0f} c, завершаем")
+                process.kill()
+                await loop.run_in_executor(None, process.join)
+        logger.info("Обработчики остановлены")
+
+    async def _watch(self):
+        """Перезапускает упавшие обработчики"""
+        while True:
+            await asyncio.sleep(1)
+            for index, process in enumerate(self._processes):
+                if process.is_alive():
+                    continue
+                logger.error(f"Обработчик {index} завершился с кодом {process.exitcode}, перезапускаем")
+                self.restarts += 1
+                self._spawn(index)
+                try:
+                    await self._wait_ready(index)
+                except RuntimeError as e:
+                    # Попробуем снова на следующем круге
+                    logger.error(str(e))
+
+    def dispatch(self, update: dict):
+        """Отдает апдейт обработчику его пользователя"""
+        index = shard_for(update, self.workers)
+        self._queues[index].put(update)
+        self.dispatched[index] += 1
+
+    async def run_polling(self, bot: Bot, allowed_updates=None, timeout: int = POLLING_TIMEOUT):
+        """Получает апдейты через getUpdates, пока задачу не отменят"""
+        offset = None
+        delay = 1
+        try:
+            while True:
+                try:
+                    updates = await bot.get_updates(offset=offset, timeout=timeout, allowed_updates=allowed_updates)
+                except TelegramAPIError as e:
+                    logger.warning(f"Ошибка getUpdates, повтор через {delay} c: {e}")
+                    await asyncio.sleep(delay)
+                    delay = min(delay * 2, 30)
+                    continue
+                delay = 1
+                for update in updates:
+                    self.dispatch(update.model_dump(mode="json", by_alias=True, exclude_none=True))
+                    offset = update.update_id + 1
+        except asyncio.CancelledError:
+            logger.info("Получение апдейтов остановлено")
+
+    def webhook_handler(self, secret_token: str):
+        """Обработчик aiohttp для вебхука Telegram: проверяет секрет и раздает апдейты"""
+        async def handle(request: web.Request) -> web.Response:
+            received = request.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+            if not hmac.compare_digest(received, secret_token):
+                return web.Response(status=401, text="Unauthorized")
+            self.dispatch(await request.json())
+            return web.Response()
+        return handle
+
+
+async def feed_from_queue(dp, bot: Bot, queue, drain_timeout: float = SHUTDOWN_TIMEOUT):
+    """Обрабатывает апдейты из очереди супервизора, пока не придет None.
+
+    Очередь multiprocessing блокирующая, поэтому ее читает отдельный поток
+    и передает апдейты в цикл событий. Каждый апдейт обрабатывается своей
+    задачей, как при handle_in_background в polling; одновременность
+    ограничивает AdmissionControlMiddleware. Если супервизор умер, не
+    прислав None, обработчик тоже останавливается.
+    """
+    loop = asyncio.get_running_loop()
+    updates = asyncio.Queue()
+    parent = multiprocessing.parent_process()
+
+    def read():
+        while True:
+            try:
+                update = queue.get(timeout=1)
+            except queue_module.Empty:
+                if parent is None or parent.is_alive():
+                    continue
+                logger.error("Супервизор завершился, останавливаем обработчик")
+                update = None
+            loop.call_soon_threadsafe(updates.put_nowait, update)
+            if update is None:
+                return
+
+    threading.Thread(target=read, name="updates-reader", daemon=True).start()
+
+    async def process(update: dict):
+        try:
+            await dp.feed_raw_update(bot, update)
+        except Exception:
+            logger.exception(f"Ошибка при обработке апдейта {update.get('update_id')}")
+
+    tasks = set()
+    while (update := await updates.get()) is not None:
+        task = asyncio.create_task(process(update))
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+    if tasks:
+        await asyncio.wait(tasks, timeout=drain_timeout)
+
+
+class CacheSync:
+    """Фоновая сверка кэшей процесса с базой (см. Database.sync_caches).
+
+    sync=False — базу меняет только этот процесс: сверять нечего, задача лишь
+    раз в INVALIDATIONS_PRUNE_INTERVAL очищает журнал, который никто не читает.
+    """
+
+    def __init__(self, db, interval: float = CACHE_SYNC_INTERVAL, reader: str = CACHE_READER_ID,
+                 sync: bool = True, prune: bool = True, reader_ttl: float = CACHE_READER_TTL):
+        self.db = db
+        self.interval = interval
+        self.reader = reader
+        self.reader_ttl = reader_ttl
+        self.sync = sync
+        # Чистить журнал достаточно одному процессу: флаг включает и выключает PrimaryElection
+        self.prune = prune
+        self._task = None
+        # Счетчик для наблюдения
+        self.invalidated = 0
+
+    def start(self):
+        if self._task is None and (self.interval or not self.sync):
+            self._task = asyncio.create_task(self._run() if self.sync else self._prune_only())
+
+    async def stop(self):
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        pruned_at = loop.time()
+        saved_seq = saved_at = None
+        while True:
+            try:
+                # Первая позиция сохраняется сразу, дальше — при движении и для отметки, что процесс жив
+                if self.db.invalidation_seq != saved_seq or loop.time() - saved_at >= self.reader_ttl / 3:
+                    saved_seq, saved_at = self.db.invalidation_seq, loop.time()
+                    await self.db.save_cache_position(self.reader)
+                if self.prune and loop.time() - pruned_at >= INVALIDATIONS_PRUNE_INTERVAL:
+                    await self.db.prune_cache_invalidations(self.reader_ttl)
+                    pruned_at = loop.time()
+            except Exception:
+                saved_seq = None
+                logger.exception("Ошибка при сохранении позиции в журнале сброса кэшей")
+            await asyncio.sleep(self.interval)
+            try:
+                self.invalidated += await self.db.sync_caches()
+            except Exception:
+                logger.exception("Ошибка при сверке кэшей с базой")
+
+    async def _prune_only(self):
+        while True:
+            await asyncio.sleep(INVALIDATIONS_PRUNE_INTERVAL)
+            if not self.prune:
+                continue
+            try:
+                await self.db.prune_cache_invalidations()
+            except Exception:
+                logger.exception("Ошибка при очистке журнала сброса кэшей")
+
+
+class PrimaryElection:
+    """Выбор ведущего процесса для задач в одном экземпляре на всю базу.
+
+    Кандидат среди процессов одного экземпляра — обработчик 0. Если база общая
+    (Postgres), экземпляров бота может быть несколько, и ведущим становится
+    кандидат, взявший блокировку в базе (Database.claim_primary). Остальные
+    кандидаты пробуют взять ее раз в interval секунд и подхватывают задачи,
+    когда ведущий пропадает; ведущий, потерявший соединение с блокировкой,
+    свои задачи останавливает. on_elected и on_lost — корутины без аргументов.
+    """
+
+    def __init__(self, db, on_elected, on_lost, candidate: bool = True, interval: float = PRIMARY_CLAIM_INTERVAL):
+        self.db = db
+        self.on_elected = on_elected
+        self.on_lost = on_lost
+        self.candidate = candidate
+        self.interval = interval
+        self.is_primary = False
+        self._task = None
+
+    async def start(self):
+        """Первая попытка стать ведущим; дальше, если база общая, — в фоне"""
+        if not self.candidate:
+            return
+        await self._claim()
+        if self._task is None and self.interval and self.db.backend.shared:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self._claim()
+            except Exception:
+                logger.exception("Ошибка при смене ведущего процесса")
+
+    async def _claim(self):
+        try:
+            primary = await self.db.claim_primary()
+        except Exception:
+            logger.exception("Ошибка при проверке блокировки ведущего процесса")
+            primary = False
+        if primary == self.is_primary:
+            return
+        self.is_primary = primary
+        if primary:
+            logger.info("Процесс стал ведущим")
+            await self.on_elected()
+        else:
+            logger.warning("Процесс больше не ведущий, останавливаем его задачи")
+            await self.on_lost()